@@ -50,6 +50,7 @@
 #include <ros/ros.h>
 #include <math.h>
 #include <joint_qualification_controllers/CounterbalanceTestData.h>
+#include <joint_qualification_controllers/CBRunData.h>
 #include <realtime_tools/realtime_publisher.h>
 #include <pr2_controller_interface/controller.h>
 #include <robot_mechanism_controllers/joint_position_controller.h>
@@ -84,6 +85,13 @@ public:
   void starting();
 
   bool sendData();
+
+  /*!
+   * \brief Copies one completed hold into the run message, and publishes it
+   *        once its lift position is complete, for incremental analysis.
+   *        Holds are copied one per update to bound time in the realtime loop
+   */
+  void copyRunData();
     
   bool done() { return state_ == DONE; }
   
@@ -117,9 +125,13 @@ private:
   uint lift_index_;
   uint flex_index_;
 
+  uint holds_done_;
+  uint holds_copied_;
+
   bool data_sent_;
 
   boost::scoped_ptr<realtime_tools::RealtimePublisher<joint_qualification_controllers::CounterbalanceTestData> > cb_data_pub_;
+  boost::scoped_ptr<realtime_tools::RealtimePublisher<joint_qualification_controllers::CBRunData> > cb_run_pub_;
 
 
 };
@@ -52,11 +52,14 @@ CounterbalanceTestController::CounterbalanceTestController() :
   robot_(NULL),
   initial_time_(0.0),
   start_time_(0.0),
-  cb_data_pub_(NULL)
+  cb_data_pub_(NULL),
+  cb_run_pub_(NULL)
 {
   timeout_ = 180;
   lift_index_ = 0;
   flex_index_ = 0;
+  holds_done_ = 0;
+  holds_copied_ = 0;
   data_sent_ = false;
 
   cb_test_data_.arg_name.resize(25);
@@ -426,6 +429,13 @@ bool CounterbalanceTestController::init(pr2_mechanism_model::RobotState *robot,
 
   cb_data_pub_.reset(new realtime_tools::RealtimePublisher<
                      joint_qualification_controllers::CounterbalanceTestData>(n, "/cb_test_data", 1, true));
+  cb_run_pub_.reset(new realtime_tools::RealtimePublisher<
+                    joint_qualification_controllers::CBRunData>(n, "/cb_run_data", 10));
+
+  // Size run message to a lift position row, so copies in update() don't allocate
+  cb_run_pub_->lock();
+  cb_run_pub_->msg_ = cb_test_data_.lift_data[0];
+  cb_run_pub_->unlock();
 
   //ROS_INFO("Initialized CB controller successfully!");
 
@@ -447,6 +457,8 @@ void CounterbalanceTestController::update()
 
   ros::Time time = robot_->getTime();
 
+  copyRunData();
+
   if ((time - initial_time_).toSec() > timeout_ && state_ != DONE)
   {
     ROS_WARN("CounterbalanceTestController timed out during test. Timeout: %f.", timeout_);
@@ -525,6 +537,7 @@ void CounterbalanceTestController::update()
   case NEXT:
     {
       // Increment flex, lift indices
+      ++holds_done_;
       ++flex_index_;
       if (flex_index_ >= cb_test_data_.lift_data[0].flex_data.size())
       {
@@ -573,3 +586,27 @@ bool CounterbalanceTestController::sendData()
   return false;
 }
 
+void CounterbalanceTestController::copyRunData()
+{
+  if (holds_copied_ >= holds_done_)
+    return;
+
+  // Lift positions are minutes apart, so publisher is free unless subscriber is stuck.
+  // Holds not copied now are copied on later updates
+  if (!cb_run_pub_->trylock())
+    return;
+
+  uint num_flexes = cb_test_data_.lift_data[0].flex_data.size();
+  uint lift_index = holds_copied_ / num_flexes;
+  uint flex_index = holds_copied_ % num_flexes;
+
+  // Message is preallocated to row size, so this copies one hold without allocating
+  cb_run_pub_->msg_.lift_position = cb_test_data_.lift_data[lift_index].lift_position;
+  cb_run_pub_->msg_.flex_data[flex_index] = cb_test_data_.lift_data[lift_index].flex_data[flex_index];
+  ++holds_copied_;
+
+  if (flex_index + 1 == num_flexes)
+    cb_run_pub_->unlockAndPublish();
+  else
+    cb_run_pub_->unlock();
+}
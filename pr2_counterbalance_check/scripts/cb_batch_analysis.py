@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Re-grades archived counterbalance bags in parallel, writes one summary table
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+import roslib
+roslib.load_manifest(PKG)
+
+import os, sys
+import csv
+import multiprocessing
+
+from pr2_counterbalance_check.bag_reader import CB_MSG_TYPE, read_cb_msg_stamped
+from pr2_counterbalance_check.counterbalance_analysis import *
+from pr2_counterbalance_check.fleet_archive import FleetArchive, arm_side, model_version
+from pr2_counterbalance_check.plot_cache import PlotCache
+
+from optparse import OptionParser
+
+COLUMNS = [ 'bag', 'robot', 'lift_joint', 'flex_joint', 'result', 'timeout_hit',
+            'lift_mse', 'lift_avg_abs', 'flex_mse', 'flex_avg_abs',
+            'secondary_turns', 'cb_bar_turns', 'summary' ]
+
+##\brief Robot serial of a bag in a fleet directory, <fleet dir>/<robot>/.../*.bag
+##
+## CB test data doesn't carry the robot serial, so it's the name of the
+## directory under the searched directory that holds the bag.
+##\return str : Robot serial, or None if the bag is directly in search_dir
+def bag_robot(bag_file, search_dir):
+    rel_dir = os.path.dirname(os.path.relpath(bag_file, search_dir))
+    if not rel_dir:
+        return None
+    return rel_dir.split(os.sep)[0]
+
+##\brief Finds all bags under the given files/directories
+##
+##\return [ (str, str) ] : Bag filename and robot serial from its directory,
+## None for bags given as files or directly in a given directory
+def find_bags(paths):
+    bags = []
+    for path in paths:
+        if os.path.isfile(path):
+            bags.append((path, None))
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith('.bag'):
+                    bag_file = os.path.join(root, f)
+                    bags.append((bag_file, bag_robot(bag_file, path)))
+    return bags
+
+##\brief Writes plots of a bag to plot_dir/<bag name>/<plot title>.<format>
+def write_plots(bag_file, params, data, plot_dir, plot_format, cache_dir):
+    cache = PlotCache(cache_dir)
+    plots = [ plot_efforts_by_lift_position(params, data, image_format = plot_format, cache = cache) ]
+    if params.flex_test:
+        plots.append(plot_effort_contour(params, data, True, image_format = plot_format, cache = cache))
+        plots.append(plot_effort_contour(params, data, False, image_format = plot_format, cache = cache))
+
+    out_dir = os.path.join(plot_dir, os.path.splitext(os.path.basename(bag_file))[0])
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for p in plots:
+        with open(os.path.join(out_dir, '%s.%s' % (p.title, p.image_format)), 'wb') as f:
+            f.write(p.image.tobytes())
+
+##\brief Efforts of an analyzed bag, for the fleet archive
+class ArchiveRun(object):
+    def __init__(self, data, timestamp):
+        self.lift_positions = data.lift_positions
+        self.flex_positions = data.flex_positions
+        self.lift_effort_avg = data.lift_effort_avg
+        self.flex_effort_avg = data.flex_effort_avg
+        self.timestamp = timestamp
+
+##\brief Analyzes one bag. Runs in a worker process
+##
+##\return (dict, ArchiveRun) : Row of summary table, keyed by COLUMNS, and
+## efforts to archive or None. Timed out runs aren't archived
+def analyze_bag(args):
+    bag_file, model_file, plot_dir, plot_format, cache_dir, archive = args
+    row = dict.fromkeys(COLUMNS, '')
+    row['bag'] = bag_file
+    row['result'] = 'FAIL'
+    run = None
+    try:
+        msg, timestamp = read_cb_msg_stamped(bag_file)
+        if msg is None:
+            row['summary'] = 'No %s message in bag' % CB_MSG_TYPE
+            return row, run
+
+        data = CounterbalanceAnalysisData(msg)
+        params = CounterbalanceAnalysisParams(msg)
+
+        row['lift_joint'] = params.lift_joint
+        row['flex_joint'] = params.flex_joint
+        row['timeout_hit'] = params.timeout_hit
+
+        lift_result = analyze_lift_efforts(params, data)
+        row['lift_mse'], row['lift_avg_abs'], avg_eff = get_effort_stats(data, True)
+        summary = [ lift_result.summary ]
+        ok = lift_result.result
+
+        if params.flex_test:
+            flex_result = analyze_flex_efforts(params, data)
+            row['flex_mse'], row['flex_avg_abs'], avg_eff = get_effort_stats(data, False)
+            summary.append(flex_result.summary)
+            ok = ok and flex_result.result
+
+            if model_file:
+                adjust_result = check_cb_adjustment(params, data, model_file)
+                if adjust_result.values:
+                    row['secondary_turns'] = float(adjust_result.values[0].value)
+                    row['cb_bar_turns'] = float(adjust_result.values[1].value)
+                if not adjust_result.result:
+                    summary = [ adjust_result.summary ]
+                ok = ok and adjust_result.result
+
+        if params.timeout_hit:
+            summary = [ 'Controller timeout hit' ]
+            ok = False
+
+        row['result'] = ok_dict[ok]
+        row['summary'] = ' '.join(summary).strip()
+
+        # Efforts aren't valid if test didn't finish
+        if archive and not params.timeout_hit:
+            run = ArchiveRun(data, timestamp)
+
+        if plot_dir:
+            try:
+                write_plots(bag_file, params, data, plot_dir, plot_format, cache_dir)
+            except Exception as e:
+                row['summary'] += ' Unable to write plots: %s' % e
+    except Exception as e:
+        row['summary'] = 'Unable to analyze bag: %s' % e
+
+    return row, run
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_batch_analysis.py [options] bag_or_dir [bag_or_dir ...]")
+    parser.add_option("-m", "--model", action="store", dest="model_file", default=None,
+                      help="CB model file, used to calculate recommended adjustment")
+    parser.add_option("-o", "--output", action="store", dest="output", default=None,
+                      help="Write summary table to this CSV file (default stdout)")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=None,
+                      help="Number of worker processes (default number of CPUs)")
+    parser.add_option("-p", "--plot-dir", action="store", dest="plot_dir", default=None,
+                      help="Write plots of each bag to a subdirectory of this directory")
+    parser.add_option("--plot-format", action="store", dest="plot_format", default="png",
+                      help="Plot image format, ex: png or svg (default png)")
+    parser.add_option("--plot-cache", action="store", dest="plot_cache", default=None,
+                      help="Directory of plot cache (default ~/.ros/pr2_counterbalance_check/plot_cache)")
+
+    parser.add_option("-a", "--archive", action="store", dest="archive", default=None,
+                      help="Append analyzed runs to this fleet archive directory")
+    parser.add_option("-r", "--robot", action="store", dest="robot", default="",
+                      help="Robot serial of bags not in a robot directory, <dir>/<robot>/.../*.bag, for the fleet archive")
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error("No bags or directories given")
+
+    if options.model_file and not os.path.exists(options.model_file):
+        parser.error("Model file %s does not exist" % options.model_file)
+
+    bags = find_bags(args)
+    if not bags:
+        print("No bags found in %s" % ', '.join(args), file=sys.stderr)
+        sys.exit(1)
+
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        results = pool.map(analyze_bag, [ (b, options.model_file, options.plot_dir, options.plot_format,
+                                           options.plot_cache, options.archive is not None)
+                                          for b, robot in bags ], chunksize = 4)
+    finally:
+        pool.close()
+        pool.join()
+
+    for (row, run), (b, robot) in zip(results, bags):
+        row['robot'] = robot or options.robot
+
+    rows = [ row for row, run in results ]
+
+    if options.archive:
+        archive = FleetArchive(options.archive)
+        version = model_version(options.model_file)
+        num_archived = 0
+        for row, run in results:
+            if run is None:
+                continue
+            try:
+                archive.append(run, row['robot'], arm_side(row['lift_joint']), run.timestamp,
+                               version, row['result'], row['bag'])
+                num_archived += 1
+            except ValueError as e:
+                print('Unable to archive %s: %s' % (row['bag'], e), file=sys.stderr)
+        print('Archived %d runs to %s' % (num_archived, archive.archive_dir), file=sys.stderr)
+
+    out = open(options.output, 'w') if options.output else sys.stdout
+    writer = csv.DictWriter(out, COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    if out is not sys.stdout:
+        out.close()
+
+    num_ok = len([ r for r in rows if r['result'] == 'OK' ])
+    print('Analyzed %d bags: %d OK, %d FAIL' % (len(rows), num_ok, len(rows) - num_ok), file=sys.stderr)
@@ -116,7 +116,7 @@ class CounterbalanceCheck(object):
 
             
 if __name__ == '__main__':
-    parser = OptionParser("./cb_check.py model_file")
+    parser = OptionParser("./cb_check.py [model_file]\n\nModel file defaults to the model in cb_data")
     parser.add_option("-t", "--tol", action="store_true",
                       dest="tolerance", default=False,
                       help="Print recommended tolerances and exit")
@@ -130,16 +130,16 @@ if __name__ == '__main__':
         print('If your recommended adjustment is less than this many turns, do not adjust your CB')
         sys.exit()
 
-    if len(args) < 2:
-        parser.error("No model file specified. Please give training data file to calculate adjustment")
-        sys.exit(2)
+    model_file = os.path.join(roslib.packages.get_pkg_dir(PKG), 'cb_data', 'counterbalance_model.yaml')
+    if len(args) > 1:
+        model_file = args[1]
 
-    if not os.path.exists(args[1]):
+    if not os.path.exists(model_file):
         parser.error("Model file does not exist. Please give training data file to calculate adjustment")
         sys.exit(2)
 
     rospy.init_node('cb_analysis')
-    app = CounterbalanceCheck(args[1])
+    app = CounterbalanceCheck(model_file)
     try:
         my_rate = rospy.Rate(5)
         while app.ok and not app.has_data and not rospy.is_shutdown():
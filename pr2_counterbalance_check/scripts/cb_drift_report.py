@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Nightly scan of fleet archive for counterbalance drift
+##
+## Prints drift of each robot arm, and exits with status 1 if any arm's
+## adjustment is projected out of tolerance by its next scheduled check.
+## Runs counts runs since the arm's last adjustment.
+##   ./cb_drift_report.py -m cb_model.yaml --interval 90
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+import roslib
+roslib.load_manifest(PKG)
+
+import os, sys
+import time
+
+from pr2_counterbalance_check.counterbalance_model import load_model
+from pr2_counterbalance_check.drift_analysis import analyze_drift
+from pr2_counterbalance_check.fleet_archive import FleetArchive
+
+from optparse import OptionParser
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_drift_report.py [options]")
+    parser.add_option("-a", "--archive", action="store", dest="archive", default=None,
+                      help="Fleet archive directory (default ~/.ros/pr2_counterbalance_check/fleet_archive)")
+    parser.add_option("-m", "--model", action="store", dest="model_file", default=None,
+                      help="CB model file, used to calculate recommended adjustment")
+    parser.add_option("-r", "--robot", action="store", dest="robot", default=None,
+                      help="Only runs of this robot serial")
+    parser.add_option("-s", "--side", action="store", dest="side", default=None,
+                      help="Only runs of this arm side, right or left")
+    parser.add_option("-i", "--interval", action="store", type="float", dest="interval", default=90.0,
+                      help="Days from last run to next scheduled check (default 90)")
+    parser.add_option("--screw-tol", action="store", type="float", dest="screw_tol", default=2.0,
+                      help="Tolerance of secondary spring adjustment, turns (default 2.0)")
+    parser.add_option("--bar-tol", action="store", type="float", dest="bar_tol", default=0.8,
+                      help="Tolerance of CB bar adjustment, turns (default 0.8)")
+    parser.add_option("-f", "--flagged", action="store_true", dest="flagged", default=False,
+                      help="Only print arms projected out of tolerance")
+    options, args = parser.parse_args()
+
+    if not options.model_file:
+        parser.error("No model file given")
+    if not os.path.exists(options.model_file):
+        parser.error("Model file %s does not exist" % options.model_file)
+
+    archive = FleetArchive(options.archive)
+    try:
+        results = analyze_drift(archive, load_model(options.model_file), options.interval,
+                                options.screw_tol, options.bar_tol, options.robot, options.side)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+    print('%-10s %-6s %4s %-10s %8s %8s %10s %10s %10s %10s %7s %s' % (
+            'Robot', 'Side', 'Runs', 'Last run', 'Sec.', 'Bar', 'Sec./day', 'Bar/day',
+            'Proj. sec.', 'Proj. bar', 'Change', 'Flag'))
+    for d in results:
+        if options.flagged and not d.flagged:
+            continue
+        print('%-10s %-6s %4d %-10s %8.2f %8.2f %10.4f %10.4f %10.2f %10.2f %7.3f %s' % (
+                d.robot, d.side, d.num_runs, time.strftime('%Y-%m-%d', time.gmtime(d.last_time)),
+                d.turns[0], d.turns[1], d.rate[0], d.rate[1], d.projected[0], d.projected[1],
+                d.grid_change, 'ADJUST' if d.flagged else ''))
+
+    num_flagged = len([ d for d in results if d.flagged ])
+    print('%d of %d arms projected out of tolerance within %g days' % (num_flagged, len(results), options.interval),
+          file=sys.stderr)
+    sys.exit(1 if num_flagged else 0)
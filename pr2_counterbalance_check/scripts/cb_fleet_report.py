@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Summarizes counterbalance efforts of fleet archive runs
+##
+## Ex: lift MSE of all right arms this quarter
+##   ./cb_fleet_report.py --side right --since 2010-07-01
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+import roslib
+roslib.load_manifest(PKG)
+
+import sys
+import time
+import calendar
+
+import numpy
+
+from pr2_counterbalance_check.fleet_archive import FleetArchive, effort_stats
+
+from optparse import OptionParser
+
+PERCENTILES = [ 0, 5, 25, 50, 75, 95, 100 ]
+
+def parse_date(date):
+    return calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_fleet_report.py [options]")
+    parser.add_option("-a", "--archive", action="store", dest="archive", default=None,
+                      help="Fleet archive directory (default ~/.ros/pr2_counterbalance_check/fleet_archive)")
+    parser.add_option("-r", "--robot", action="store", dest="robot", default=None,
+                      help="Only runs of this robot serial")
+    parser.add_option("-s", "--side", action="store", dest="side", default=None,
+                      help="Only runs of this arm side, right or left")
+    parser.add_option("-m", "--model-version", action="store", dest="model_version", default=None,
+                      help="Only runs analyzed with this model version")
+    parser.add_option("--since", action="store", dest="since", default=None,
+                      help="Only runs on or after this date, YYYY-MM-DD (UTC)")
+    parser.add_option("--until", action="store", dest="until", default=None,
+                      help="Only runs before this date, YYYY-MM-DD (UTC)")
+    options, args = parser.parse_args()
+
+    try:
+        since = parse_date(options.since) if options.since else None
+        until = parse_date(options.until) if options.until else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    archive = FleetArchive(options.archive)
+    runs = archive.select(options.robot, options.side, since, until, options.model_version)
+    if len(runs) == 0:
+        print('No runs in %s match' % archive.archive_dir, file=sys.stderr)
+        sys.exit(1)
+
+    # Reduction over the selected runs of the memory-mapped efforts
+    stats = effort_stats(archive.efforts()[runs])
+
+    print('%d of %d runs' % (len(runs), len(archive)))
+    print('%-14s %s' % ('Percentile', ' '.join([ '%7d' % p for p in PERCENTILES ])))
+    for name in [ 'lift_mse', 'lift_avg_abs', 'flex_mse', 'flex_avg_abs' ]:
+        values = numpy.percentile(stats[name], PERCENTILES)
+        print('%-14s %s' % (name, ' '.join([ '%7.3f' % v for v in values ])))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Recommends settle_time and dither_points of the CB controller from recorded hold traces
+##
+## Ex: ./cb_hold_timing.py -m cb_model.yaml runs/*.bag
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+import roslib
+roslib.load_manifest(PKG)
+
+import os, sys
+
+import numpy
+
+from pr2_counterbalance_check.bag_reader import CB_MSG_TYPE, read_cb_msg
+from pr2_counterbalance_check.counterbalance_model import load_model
+from pr2_counterbalance_check.hold_timing import HoldTraces, optimize_hold_timing
+
+from optparse import OptionParser
+
+def print_settle(name, settle):
+    print('%-20s median %.3fs, 95%% %.3fs, max %.3fs' % (
+            name, numpy.median(settle), numpy.percentile(settle, 95), settle.max()))
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_hold_timing.py [options] bag [bag ...]")
+    parser.add_option("-m", "--model", action="store", dest="model_file", default=None,
+                      help="CB model file, to keep recommended adjustment within allowed error")
+    parser.add_option("--effort-tol", action="store", type="float", dest="effort_tol", default=0.1,
+                      help="Allowed error of hold effort means (default 0.1)")
+    parser.add_option("--screw-error", action="store", type="float", dest="screw_error", default=0.2,
+                      help="Allowed error of secondary spring adjustment, turns (default 0.2)")
+    parser.add_option("--bar-error", action="store", type="float", dest="bar_error", default=0.08,
+                      help="Allowed error of CB bar adjustment, turns (default 0.08)")
+    parser.add_option("--position-tol", action="store", type="float", dest="position_tol", default=0.005,
+                      help="Position settle band, rad (default 0.005)")
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error("No bags given")
+    if options.model_file and not os.path.exists(options.model_file):
+        parser.error("Model file %s does not exist" % options.model_file)
+
+    msgs = []
+    for bag_file in args:
+        msg = read_cb_msg(bag_file) if os.path.exists(bag_file) else None
+        if msg is None:
+            print('%s: no %s message in bag, skipped' % (bag_file, CB_MSG_TYPE), file=sys.stderr)
+            continue
+        msgs.append(msg)
+
+    if not msgs:
+        print('No runs to analyze', file=sys.stderr)
+        sys.exit(1)
+
+    settle_times = set([ msg.arg_value[0] for msg in msgs ])
+    if len(settle_times) > 1:
+        print('Runs have different settle times: %s' % ', '.join([ '%g' % s for s in sorted(settle_times) ]),
+              file=sys.stderr)
+        sys.exit(1)
+    settle_time = settle_times.pop()
+
+    try:
+        traces = HoldTraces(msgs)
+        model = load_model(options.model_file) if options.model_file else None
+        timing = optimize_hold_timing(traces, settle_time, options.effort_tol, model,
+                                      options.screw_error, options.bar_error, options.position_tol)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    print('%d runs, %d holds of %d samples, recorded after %gs settle' % (
+            traces.num_runs, len(traces.effort), traces.num_samples, settle_time))
+    print('Settling, after start of recorded trace:')
+    print_settle('  Position', timing.position_settle)
+    print_settle('  Effort', timing.effort_settle)
+    print('Max hold effort error: %.3f' % timing.effort_error)
+    if timing.turns_error is not None:
+        print('Max adjustment error: secondary %.3f, CB bar %.3f turns' % timing.turns_error)
+
+    holds = traces.grid_shape[0] * traces.grid_shape[1]
+    print('Hold time %.2fs, was %.2fs. About %.0fs of %.0fs per arm' % (
+            timing.hold_time, timing.recorded_hold_time, holds * timing.hold_time, holds * timing.recorded_hold_time))
+    print('')
+    print('settle_time: %.3f' % timing.settle_time)
+    print('dither_points: %d' % timing.dither_points)
@@ -40,18 +40,32 @@ import roslib
 roslib.load_manifest(PKG)
 
 import os
+import multiprocessing
+import threading
 import rospy
 
 from pr2_self_test_msgs.srv import TestResult, TestResultRequest
 from std_msgs.msg import Bool
-from joint_qualification_controllers.msg import CounterbalanceTestData
+from joint_qualification_controllers.msg import CounterbalanceTestData, CBRunData
 
 from pr2_counterbalance_check.counterbalance_analysis import *
+from pr2_counterbalance_check.counterbalance_model import grid_positions, load_model
+from pr2_counterbalance_check.drift_analysis import analyze_drift
+from pr2_counterbalance_check.fleet_archive import FleetArchive, arm_side, model_version
+from pr2_counterbalance_check.plot_cache import PlotCache
 
+result_names = { TestResultRequest.RESULT_PASS: 'PASS',
+                 TestResultRequest.RESULT_FAIL: 'FAIL',
+                 TestResultRequest.RESULT_HUMAN_REQUIRED: 'HUMAN_REQUIRED' }
 
 class CounterbalanceAnalyzer:
-    def __init__(self):
+    ##\param plot_pool multiprocessing.Pool : Pool to render plots in, or None
+    def __init__(self, plot_pool = None):
+        self._plot_pool = plot_pool
+        # Early and full results are sent from different threads, only
+        # the first claimed is sent
         self._sent_results = False
+        self._sent_lock = threading.Lock()
         self._motors_halted = True
         self._data = None
 
@@ -61,22 +75,73 @@ class CounterbalanceAnalyzer:
 
         self._model_file = rospy.get_param('~model_file', None)
 
+        # Use 'svg' or a lower dpi to reduce size of results
+        self._plot_format = rospy.get_param('~plot_format', 'png')
+        self._plot_dpi = rospy.get_param('~plot_dpi', None)
+
+        # Reuse plots rendered earlier from identical data
+        self._plot_cache = None
+        plot_cache_dir = rospy.get_param('~plot_cache_dir', None)
+        if plot_cache_dir:
+            self._plot_cache = PlotCache(plot_cache_dir)
+
+        # Append analyzed runs to fleet archive
+        self._archive = None
+        archive_dir = rospy.get_param('~archive_dir', None)
+        if archive_dir:
+            self._archive = FleetArchive(archive_dir)
+        self._robot_serial = str(rospy.get_param('~robot_serial', ''))
+        # Drift since previous runs is projected to the next check
+        self._check_interval = rospy.get_param('~check_interval_days', 90.0)
+
+        # Analyze each lift position as it completes, and stop early
+        # once the test can't pass. Needs the controller's namespace,
+        # set by the counterbalance_test launch files
+        self._incremental = None
+        controller = rospy.get_param('~controller', rospy.get_param('cb_test_controller', None))
+        if controller:
+            self._incremental = self._make_incremental_analysis(controller)
+            self.run_topic = rospy.Subscriber('cb_run_data', CBRunData, self._run_callback)
+
+    ##\brief Incremental analysis with grid and limits from controller params
+    def _make_incremental_analysis(self, controller):
+        lift = rospy.get_param(controller + '/lift')
+        flex = rospy.get_param(controller + '/flex', {})
+        flex_test = 'joint' in flex
+
+        num_lifts = len(grid_positions(lift['min'], lift['max'], lift['delta']))
+        num_flexes = 1
+        if flex_test:
+            num_flexes = len(grid_positions(flex['min'], flex['max'], flex['delta']))
+
+        return IncrementalCounterbalanceAnalysis(num_lifts, num_flexes, lift['mse'], lift['avg_abs'],
+                                                 flex_test, flex.get('mse', 0.0), flex.get('avg_abs', 0.0),
+                                                 rospy.get_param(controller + '/screw_tol', 2.0),
+                                                 rospy.get_param(controller + '/bar_tol', 0.8))
+
 
     def has_data(self):
         return self._data is not None
 
+    def sent_results(self):
+        return self._sent_results
+
     def send_results(self, r):
-        if not self._sent_results:
-            try:
-                rospy.wait_for_service('test_result', 10)
-            except Exception:
-                rospy.logerr('Wait for service \'test_result\' timed out! Unable to send results.')
+        with self._sent_lock:
+            if self._sent_results:
                 return False
-                
-            self._result_service.call(r)
             self._sent_results = True
 
-            return True
+        try:
+            rospy.wait_for_service('test_result', 10)
+        except Exception:
+            rospy.logerr('Wait for service \'test_result\' timed out! Unable to send results.')
+            with self._sent_lock:
+                self._sent_results = False
+            return False
+
+        self._result_service.call(r)
+        return True
             
     def test_failed_service_call(self, except_str = ''):
         rospy.logerr(except_str)
@@ -86,57 +151,168 @@ class CounterbalanceAnalyzer:
         r.result = TestResultRequest.RESULT_FAIL
         self.send_results(r)
 
+    ##\brief Appends run to fleet archive. Errors are logged, and don't fail test
+    def _archive_run(self, params, data, result):
+        if self._archive is None:
+            return
+        try:
+            self._archive.append(data, self._robot_serial, arm_side(params.lift_joint), None,
+                                 model_version(self._model_file), result, rospy.get_name())
+        except Exception as e:
+            rospy.logwarn('Unable to append CB run to fleet archive %s: %s' % (self._archive.archive_dir, e))
+
+    ##\brief Drift of this arm over its archived runs. Doesn't fail test
+    ##
+    ##\return str : HTML of drift, or '' if not enough archived runs
+    def _drift_html(self, params):
+        if self._archive is None or not self._robot_serial or \
+                not self._model_file or not os.path.exists(self._model_file):
+            return ''
+        try:
+            results = analyze_drift(self._archive, load_model(self._model_file), self._check_interval,
+                                    params.screw_tol, params.bar_tol,
+                                    self._robot_serial, arm_side(params.lift_joint))
+        except Exception as e:
+            rospy.logwarn('Unable to analyze CB drift: %s' % e)
+            return ''
+        if not results or results[0].num_runs < 2:
+            return ''
+
+        d = results[0]
+        if d.flagged:
+            rospy.logwarn('CB of %s %s arm projected out of tolerance by next check' % (d.robot, d.side))
+
+        html = [ '<H4>CB Drift</H4>' ]
+        html.append('<p>%d archived runs of this arm since its last adjustment. Adjustment projected %g days ahead is %s.</p>' % (
+                d.num_runs, self._check_interval, 'out of tolerance' if d.flagged else 'within tolerance'))
+        html.append('<table border="1" cellpadding="2" cellspacing="0">')
+        html.append('<tr><td><b>Adjustment</b></td><td><b>Turns CW</b></td><td><b>Drift (turns/day)</b></td><td><b>Projected</b></td><td><b>Tolerance</b></td></tr>')
+        for i, (name, tol) in enumerate([ ('Secondary Spring', params.screw_tol), ('CB Bar', params.bar_tol) ]):
+            html.append('<tr><td>%s</td><td>%.2f</td><td>%.4f</td><td>%.2f</td><td>%.2f</td></tr>' % (
+                    name, d.turns[i], d.rate[i], d.projected[i], tol))
+        html.append('</table>')
+        html.append('<p>RMS effort change since previous run: %.3f</p>' % d.grid_change)
+        return '\n'.join(html)
+
     def _motors_cb(self, msg):
         self._motors_halted = msg.data
 
     def _data_callback(self, msg):
         self._data = msg
+
+    ##\brief CB adjustment result, or a placeholder if there's no model to check against
+    ##
+    ##\param params : Has screw_tol, bar_tol. CounterbalanceAnalysisParams or IncrementalCounterbalanceAnalysis
+    def _check_adjustment(self, params, data):
+        if self._model_file and os.path.exists(self._model_file):
+            return check_cb_adjustment(params, data, self._model_file)
+
+        adjust_result = CounterbalanceAnalysisResult()
+        if self._model_file:
+            adjust_result.result = False
+            adjust_result.html = '<p>CB model file is missing. File %s does not exist. This file is used for testing the CB adjustment.</p>\n' % self._model_file
+            adjust_result.summary = 'CB model file missing, unable to analyze'
+        else: # Don't check CB adjustment
+            adjust_result.result = True
+            adjust_result.html = '<p>Did not check counterbalance adjustment.</p>'
+        return adjust_result
+
+    ##\brief HTML of CB adjustment recommendations, placed before debugging information
+    def _adjustment_html(self, adjust_result):
+        if not self._model_file:
+            return []
+        return [ '<H4>CB Adjustment Recommendations and Analysis</H4>',
+                 adjust_result.html,
+                 '<p>Further information is for debugging and analysis information only.</p><br><hr size="2" />' ]
+
+    ##\brief Sets result and summary of r from effort and CB adjustment results
+    ##
+    ##\param effort_results [ CounterbalanceAnalysisResult ] : Effort checks
+    ##\param adjust_result CounterbalanceAnalysisResult : CB adjustment, or None if flex wasn't tested
+    def _grade(self, r, effort_results, adjust_result):
+        r.text_summary = ' '.join([ e.summary for e in effort_results ])
+
+        r.result = TestResultRequest.RESULT_HUMAN_REQUIRED
+        if all([ e.result for e in effort_results ]) and (adjust_result is None or adjust_result.result):
+            r.result = TestResultRequest.RESULT_PASS
+
+        # Adjustment required
+        if adjust_result is not None and not adjust_result.result:
+            r.result = TestResultRequest.RESULT_HUMAN_REQUIRED
+            r.text_summary = adjust_result.summary
+
+        # Check motors halted
+        if self._motors_halted:
+            r.text_summary = 'Fail, motors halted. Check estop and power board.'
+            r.html_result = '<H4>Motors Halted</H4>\n<p>Unable to analyze CB. Check estop and power board.</p>\n' + r.html_result
+            r.result = TestResultRequest.RESULT_FAIL
+
+    ##\brief Sends result once the completed lift positions fail the test
+    ##
+    ## The result is graded as the full test would be, with the CB adjustment
+    ## from the completed lift positions.
+    def _run_callback(self, msg):
+        if self._sent_results or not self._incremental.add_run(msg):
+            return
+
+        try:
+            effort_result = self._incremental.result()
+
+            adjust_result = None
+            html = [ '<H4>Counterbalance Test Stopped Early</H4>' ]
+            if self._incremental.flex_test:
+                adjust_result = self._check_adjustment(self._incremental, self._incremental.data())
+                html.extend(self._adjustment_html(adjust_result))
+            html.append('<H4>Effort Analysis</H4>')
+            html.append(effort_result.html)
+
+            r = TestResultRequest()
+            r.html_result = '\n'.join(html)
+            r.values = list(effort_result.values)
+            if adjust_result is not None:
+                r.values.extend(adjust_result.values)
+            self._grade(r, [ effort_result ], adjust_result)
+
+            self.send_results(r)
+        except Exception:
+            import traceback
+            self.test_failed_service_call(traceback.format_exc())
         
     def process_results(self):
+        # Test stopped early
+        if self._sent_results:
+            return
+
         msg = self._data
         try:
             data = CounterbalanceAnalysisData(msg)
             params = CounterbalanceAnalysisParams(msg)
 
             lift_effort_result = analyze_lift_efforts(params, data)
-            lift_effort_plot = plot_efforts_by_lift_position(params, data)
+
+            plots = render_plots(params, data, self._plot_pool, self._plot_format, self._plot_dpi, self._plot_cache)
+            lift_effort_plot = plots[0]
 
             if params.flex_test:
                 flex_effort_result = analyze_flex_efforts(params, data)
-                lift_effort_contour = plot_effort_contour(params, data)
-                flex_effort_contour = plot_effort_contour(params, data, False)
-
-                if self._model_file and os.path.exists(self._model_file):
-                    adjust_result = check_cb_adjustment(params, data, self._model_file)
-                elif self._model_file:
-                    adjust_result = CounterbalanceAnalysisResult()
-                    adjust_result.result = False
-                    adjust_result.html = '<p>CB model file is missing. File %s does not exist. This file is used for testing the CB adjustment.</p>\n' % self._model_file
-                    adjust_result.summary = 'CB model file missing, unable to analyze'
-                else: # Don't check CB adjustment
-                    adjust_result = CounterbalanceAnalysisResult()
-                    adjust_result.result = True
-                    adjust_result.html = '<p>Did not check counterbalance adjustment.</p>'
-                                        
+                lift_effort_contour, flex_effort_contour = plots[1:]
+                adjust_result = self._check_adjustment(params, data)
 
             html = []
             if params.flex_test:
-                if self._model_file:
-                    html.append('<H4>CB Adjustment Recommendations and Analysis</H4>')
-                    html.append(adjust_result.html)
-                    html.append('<p>Further information is for debugging and analysis information only.</p><br><hr size="2" />')
+                html.extend(self._adjustment_html(adjust_result))
 
                 html.append('<H4>Lift Effort Contour Plot</H4>')
-                html.append('<img src=\"IMG_PATH/%s.png\" width=\"640\" height=\"480\" />' % (lift_effort_contour.title))
+                html.append('<img src=\"IMG_PATH/%s.%s\" width=\"640\" height=\"480\" />' % (lift_effort_contour.title, lift_effort_contour.image_format))
                 html.append('<H4>Flex Effort Contour Plot</H4>')
-                html.append('<img src=\"IMG_PATH/%s.png\" width=\"640\" height=\"480\" />' % (flex_effort_contour.title))
+                html.append('<img src=\"IMG_PATH/%s.%s\" width=\"640\" height=\"480\" />' % (flex_effort_contour.title, flex_effort_contour.image_format))
                 
                 html.append('<H4>Flex Effort Analysis</H4>')
                 html.append(flex_effort_result.html)
 
             html.append('<H4>Lift Effort Analysis</H4>')
             html.append(lift_effort_result.html)
-            html.append('<img src=\"IMG_PATH/%s.png\" width=\"640\" height=\"480\" />' % (lift_effort_plot.title))
+            html.append('<img src=\"IMG_PATH/%s.%s\" width=\"640\" height=\"480\" />' % (lift_effort_plot.title, lift_effort_plot.image_format))
 
             html.append('<p>Test Parameters</p>')
             html.append('<table border="1" cellpadding="2" cellspacing="0">')
@@ -149,21 +325,6 @@ class CounterbalanceAnalyzer:
            
             r = TestResultRequest()
             r.html_result = '\n'.join(html)
-            r.text_summary = ' '.join([lift_effort_result.summary])
-            if params.flex_test:
-                r.text_summary = ' '.join([r.text_summary, flex_effort_result.summary])
-
-            r.result = TestResultRequest.RESULT_HUMAN_REQUIRED
-
-
-            if params.flex_test and (lift_effort_result.result and 
-                                     flex_effort_result.result and 
-                                     adjust_result.result):
-                r.result = TestResultRequest.RESULT_PASS
-            elif not params.flex_test and lift_effort_result.result:
-                r.result = TestResultRequest.RESULT_PASS
-
-
             r.plots = [ lift_effort_plot ]
             if params.flex_test:
                 r.plots.append(lift_effort_contour)
@@ -174,16 +335,10 @@ class CounterbalanceAnalyzer:
                 r.values.extend(flex_effort_result.values)
                 r.values.extend(adjust_result.values)
 
-            # Adjustment required
-            if params.flex_test and not adjust_result.result:
-                r.result = TestResultRequest.RESULT_HUMAN_REQUIRED
-                r.text_summary = adjust_result.summary
-
-            # Check motors halted
-            if self._motors_halted:
-                r.text_summary = 'Fail, motors halted. Check estop and power board.'
-                r.html_result = '<H4>Motors Halted</H4>\n<p>Unable to analyze CB. Check estop and power board.</p>\n' + r.html_result
-                r.result = TestResultRequest.RESULT_FAIL
+            if params.flex_test:
+                self._grade(r, [ lift_effort_result, flex_effort_result ], adjust_result)
+            else:
+                self._grade(r, [ lift_effort_result ], None)
             
             # Check timeout of controller
             if params.timeout_hit:
@@ -191,6 +346,11 @@ class CounterbalanceAnalyzer:
                 r.html_result = '<H4>Timeout Hit</H4>\n<p>Unable to analyzer CB. Controller timeout hit.</p>\n' + r.html_result
                 r.result = TestResultRequest.RESULT_FAIL
 
+            # Efforts aren't valid if motors halted or test didn't finish
+            if not self._motors_halted and not params.timeout_hit:
+                self._archive_run(params, data, result_names.get(r.result, str(r.result)))
+                if params.flex_test:
+                    r.html_result += self._drift_html(params)
 
             self.send_results(r)
         except Exception:
@@ -199,14 +359,17 @@ class CounterbalanceAnalyzer:
 
             
 if __name__ == '__main__':
+    # Start plot workers before rospy starts its threads
+    plot_pool = multiprocessing.Pool(3)
+
     rospy.init_node('cb_analyzer')
-    app = CounterbalanceAnalyzer()
+    app = CounterbalanceAnalyzer(plot_pool)
     try:
         my_rate = rospy.Rate(5)
-        while not app.has_data() and not rospy.is_shutdown():
+        while not app.has_data() and not app.sent_results() and not rospy.is_shutdown():
             my_rate.sleep()
 
-        if not rospy.is_shutdown():
+        if not rospy.is_shutdown() and not app.sent_results():
             app.process_results()
 
         rospy.spin()
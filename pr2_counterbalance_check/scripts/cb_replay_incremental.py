@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Replays archived counterbalance bags through incremental analysis
+##
+## Shows at which lift position each failing test could have been stopped,
+## and the test time that would have saved.
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+import roslib
+roslib.load_manifest(PKG)
+
+import os, sys
+
+from pr2_counterbalance_check.bag_reader import CB_MSG_TYPE, read_cb_msg
+from pr2_counterbalance_check.counterbalance_analysis import *
+
+from optparse import OptionParser
+
+# Controller update rate, each dither point is one update
+CONTROLLER_RATE = 1000.0
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_replay_incremental.py bag [bag ...]")
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.error("No bags given")
+
+    total_saved = 0.0
+    for bag_file in args:
+        if not os.path.exists(bag_file):
+            print('%s: bag file does not exist' % bag_file, file=sys.stderr)
+            continue
+
+        msg = read_cb_msg(bag_file)
+        if msg is None:
+            print('%s: no %s message in bag' % (bag_file, CB_MSG_TYPE), file=sys.stderr)
+            continue
+
+        analysis, runs = replay_incremental(msg)
+        if runs is None:
+            print('%s: %s' % (bag_file, analysis.result().summary))
+            continue
+
+        # Each flex position is a settle, then a dither
+        hold_time = msg.arg_value[0] + msg.arg_value[1] / CONTROLLER_RATE
+        saved = hold_time * analysis.num_flexes * (analysis.num_lifts - runs)
+        total_saved += saved
+
+        print('%s: FAIL after %d of %d lift positions, saves %.0fs. Bounds: %s' % (
+                bag_file, runs, analysis.num_lifts, saved,
+                ', '.join([ '%.2f' % b for b in analysis.bounds() ])))
+
+    print('Total test time saved: %.0fs' % total_saved)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Reads CounterbalanceTestData from bags by the bag index
+##
+## Connections of CounterbalanceTestData are found in the bag's connection
+## index, and only their records are read, through the chunk index. Other
+## topics in the bag, like high rate station data, are not deserialized.
+
+CB_MSG_TYPE = 'joint_qualification_controllers/CounterbalanceTestData'
+
+##\brief Topics of bag with msg_type messages, from the connection index
+##
+##\param bag rosbag.Bag : Open bag
+##\return [ str ] : Topics
+def indexed_topics(bag, msg_type = CB_MSG_TYPE):
+    try:
+        topics = bag.get_type_and_topic_info()[1]
+        return sorted([ topic for topic, info in topics.items() if info.msg_type == msg_type ])
+    except AttributeError:
+        # rosbag before get_type_and_topic_info
+        return sorted(set([ c.topic for c in bag._connections.values() if c.datatype == msg_type ]))
+
+##\brief Generates the CounterbalanceTestData messages of a bag, in time order
+##
+##\param bag_file str : Bag filename. Bag must be indexed (rosbag reindex)
+##\param stamped bool : Generate (msg, time recorded in seconds) instead of msg
+def read_cb_msgs(bag_file, stamped = False):
+    import rosbag
+    bag = rosbag.Bag(bag_file)
+    try:
+        topics = indexed_topics(bag)
+        if not topics:
+            return
+        for topic, msg, t in bag.read_messages(topics = topics):
+            if stamped:
+                yield msg, t.to_sec()
+            else:
+                yield msg
+    finally:
+        bag.close()
+
+##\brief Returns first CounterbalanceTestData message in bag, or None
+def read_cb_msg(bag_file):
+    msgs = read_cb_msgs(bag_file)
+    try:
+        return next(msgs, None)
+    finally:
+        msgs.close()
+
+##\brief Returns first CounterbalanceTestData message in bag and its time
+##
+##\return (msg, float) : Message and time recorded in seconds, or (None, None)
+def read_cb_msg_stamped(bag_file):
+    msgs = read_cb_msgs(bag_file, True)
+    try:
+        return next(msgs, (None, None))
+    finally:
+        msgs.close()
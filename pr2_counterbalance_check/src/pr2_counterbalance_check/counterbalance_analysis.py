@@ -37,58 +37,125 @@
 
 from __future__ import print_function
 
+## Only NumPy is imported at load, so the analysis starts quickly. Plotting
+## (counterbalance_plots, matplotlib) and pr2_self_test_msgs are imported
+## on first use.
+
 PKG = 'pr2_counterbalance_check'
-import roslib
-#import roslib; roslib.load_manifest(PKG)
 
 import numpy
 import math
 import sys
 
-
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from StringIO import StringIO
-
-from pr2_self_test_msgs.msg import Plot, TestValue, TestParam
+from pr2_counterbalance_check.counterbalance_model import CounterbalanceModel, load_model
 
 ok_dict = { False: 'FAIL', True: 'OK' }
 
+# No adjustment is recommended if interpolating onto the model grid may
+# be off by more than this fraction of the tighter tolerance
+MAX_INTERP_ERROR = 0.5
+
+##\brief Signed byte view of image data for Plot.image (byte[]), without copying
 def str_to_bytes(s):
-       return map(lambda x: x if x < 128 else x-256, map(ord, s))
+    return numpy.frombuffer(s, dtype=numpy.int8)
 
+##\brief Summary statistics of a single joint hold
+##
+## By default only the position and effort mean/std are kept. The raw
+## time, position, velocity and effort arrays are None unless keep_raw is set.
 class JointPositionAnalysisData(object):
-    def __init__(self, msg):
-        self.time     = numpy.array(msg.time)
-        self.position = numpy.array(msg.position)
-        self.velocity = numpy.array(msg.velocity)
-        self.effort   = numpy.array(msg.effort)
+    __slots__ = ['time', 'position', 'velocity', 'effort',
+                 'position_avg', 'position_sd', 'effort_avg', 'effort_sd']
+
+    ##\param msg JointPositionData : Hold data from controller
+    ##\param keep_raw bool : Retain raw arrays of hold data
+    def __init__(self, msg, keep_raw = False):
+        if keep_raw:
+            self.time     = numpy.array(msg.time)
+            self.position = numpy.array(msg.position)
+            self.velocity = numpy.array(msg.velocity)
+            self.effort   = numpy.array(msg.effort)
+        else:
+            self.time     = None
+            self.position = None
+            self.velocity = None
+            self.effort   = None
 
-        self.position_avg = numpy.average(self.position)
-        self.position_sd  = numpy.std(self.position)
-        self.effort_avg   = numpy.average(self.effort)
-        self.effort_sd    = numpy.std(self.effort)
+        # Position and effort stats in one pass over a (2, dither_points) array
+        hold = numpy.array((msg.position, msg.effort), dtype=numpy.float64)
+        avg = hold.mean(axis=1)
+        sd  = hold.std(axis=1)
+
+        self.position_avg = avg[0]
+        self.position_sd  = sd[0]
+        self.effort_avg   = avg[1]
+        self.effort_sd    = sd[1]
 
 class CBPositionAnalysisData(object):
-    def __init__(self, msg):
+    def __init__(self, msg, keep_raw = False):
         self.flex_position = msg.flex_position
-        self.lift_hold = JointPositionAnalysisData(msg.lift_hold)
-        self.flex_hold = JointPositionAnalysisData(msg.flex_hold)
+        self.lift_hold = JointPositionAnalysisData(msg.lift_hold, keep_raw)
+        self.flex_hold = JointPositionAnalysisData(msg.flex_hold, keep_raw)
 
 class CBRunAnalysisData(object):
-    def __init__(self, msg):
+    def __init__(self, msg, keep_raw = False):
         self.lift_position = msg.lift_position
         self.flex_data = []
         for fd in msg.flex_data:
-            self.flex_data.append(CBPositionAnalysisData(fd))
+            self.flex_data.append(CBPositionAnalysisData(fd, keep_raw))
 
+##\brief Stores CB test data, and dense (num_lifts, num_flexes) arrays of hold averages
+##
+## Grid arrays are indexed [lift_index, flex_index]. The lift_* grids are
+## from the shoulder lift holds, the flex_* grids from the elbow flex holds.
 class CounterbalanceAnalysisData(object):
     ##\param msg CounterbalanceTestData : Message from controller
-    def __init__(self, msg):
-        self.lift_data = []
-        for ld in msg.lift_data:
-            self.lift_data.append(CBRunAnalysisData(ld))
+    ##\param keep_raw bool : Retain raw time/position/velocity/effort arrays of each hold
+    def __init__(self, msg, keep_raw = False):
+        self._set_runs([ CBRunAnalysisData(ld, keep_raw) for ld in msg.lift_data ])
+
+    ##\brief Analysis data of lift position rows analyzed so far, ex: of a test stopped early
+    ##
+    ##\param runs [ CBRunAnalysisData ] : Rows, in lift position order
+    @classmethod
+    def from_runs(cls, runs):
+        data = cls.__new__(cls)
+        data._set_runs(list(runs))
+        return data
+
+    def _set_runs(self, runs):
+        self.lift_data = runs
+
+        num_lifts = len(self.lift_data)
+        num_flexes = len(self.lift_data[0].flex_data) if num_lifts > 0 else 0
+        shape = (num_lifts, num_flexes)
+
+        self.lift_positions = numpy.zeros(num_lifts)
+        self.flex_positions = numpy.zeros(num_flexes)
+
+        self.lift_effort_avg   = numpy.zeros(shape)
+        self.lift_effort_sd    = numpy.zeros(shape)
+        self.lift_position_avg = numpy.zeros(shape)
+        self.lift_position_sd  = numpy.zeros(shape)
+        self.flex_effort_avg   = numpy.zeros(shape)
+        self.flex_effort_sd    = numpy.zeros(shape)
+        self.flex_position_avg = numpy.zeros(shape)
+        self.flex_position_sd  = numpy.zeros(shape)
+
+        for i, ld in enumerate(self.lift_data):
+            self.lift_positions[i] = ld.lift_position
+            for j, fd in enumerate(ld.flex_data):
+                self.lift_effort_avg[i, j]   = fd.lift_hold.effort_avg
+                self.lift_effort_sd[i, j]    = fd.lift_hold.effort_sd
+                self.lift_position_avg[i, j] = fd.lift_hold.position_avg
+                self.lift_position_sd[i, j]  = fd.lift_hold.position_sd
+                self.flex_effort_avg[i, j]   = fd.flex_hold.effort_avg
+                self.flex_effort_sd[i, j]    = fd.flex_hold.effort_sd
+                self.flex_position_avg[i, j] = fd.flex_hold.position_avg
+                self.flex_position_sd[i, j]  = fd.flex_hold.position_sd
+
+        for j, fd in enumerate(self.lift_data[0].flex_data if num_lifts > 0 else []):
+            self.flex_positions[j] = fd.flex_position
 
 ##\brief Stores parameters from CB analysis test
 class CounterbalanceAnalysisParams(object):
@@ -141,6 +208,8 @@ class CounterbalanceAnalysisParams(object):
             self.named_params[msg.arg_name[i]] = msg.arg_value[i]
 
     def get_test_params(self):
+        from pr2_self_test_msgs.msg import TestParam
+
         params = []
         params.append(TestParam(key='Lift Dither', value=str(self.lift_dither)))
         params.append(TestParam(key='Flex Dither', value=str(self.flex_dither)))
@@ -189,19 +258,19 @@ class CounterbalanceAnalysisResult:
         self.result = False
         self.values = []
 
+##\brief Get average efforts for CB test as a (num_lifts, num_flexes) array
+##
+##\param lift_calc bool : Lift or flex efforts
+def _get_effort_grid(data, lift_calc):
+    if lift_calc:
+        return data.lift_effort_avg
+    return data.flex_effort_avg
+
 ##\brief Get average efforts for CB test as a list
 ##
 ##\param lift_calc bool : Lift or flex efforts
 def get_efforts(data, lift_calc):
-    avg_effort_list = []
-    for ld in data.lift_data:
-        for fd in ld.flex_data:
-            if lift_calc:
-                avg_effort_list.append(fd.lift_hold.effort_avg)
-            else:
-                avg_effort_list.append(fd.flex_hold.effort_avg)
-
-    return avg_effort_list
+    return _get_effort_grid(data, lift_calc).ravel().tolist()
 
 def _get_mean_sq_effort(avg_effort_array):
     sq_array = avg_effort_array * avg_effort_array
@@ -214,132 +283,58 @@ def _get_mean_abs_effort(avg_effort_array):
 def _get_mean_effort(avg_effort_array):
     return numpy.average(avg_effort_array)
 
-##\brief Returns a list of lift positions, efforts for a given flex position (vary by lift)
-def _get_const_flex_effort(data, flex_index = 0, lift_calc = True):
-    effort_list = []
-    lift_list = []
-    for ld in data.lift_data:
-        fd = ld.flex_data[flex_index]
-        lift_list.append(ld.lift_position)
-        if lift_calc:
-            effort_list.append(fd.lift_hold.effort_avg)
-        else:
-            effort_list.append(fd.flex_hold.effort_avg)
+##\brief Returns (mean sq. effort, mean abs. effort, mean effort) of lift or flex holds
+##
+##\param lift_calc bool : Lift or flex efforts
+def get_effort_stats(data, lift_calc):
+    avg_efforts = _get_effort_grid(data, lift_calc)
+    return (_get_mean_sq_effort(avg_efforts), _get_mean_abs_effort(avg_efforts), _get_mean_effort(avg_efforts))
 
-    return lift_list, effort_list
+##\brief Returns arrays of lift positions, efforts for a given flex position (vary by lift)
+def _get_const_flex_effort(data, flex_index = 0, lift_calc = True):
+    return data.lift_positions, _get_effort_grid(data, lift_calc)[:, flex_index]
     
 def _get_const_lift_effort(data, lift_index = 0, lift_calc = True):
-    ld = data.lift_data[lift_index]
-        
-    effort_list = []
-    flex_list = []
-
-    for fd in ld.flex_data:
-        flex_list.append(fd.flex_position)
-        if lift_calc:
-            effort_list.append(fd.lift_hold.effort_avg)
-        else:
-            effort_list.append(fd.flex_hold.effort_avg)
-
-    return flex_list, effort_list
-
-
+    return data.flex_positions, _get_effort_grid(data, lift_calc)[lift_index, :]
 
 def _get_flex_positions(data):
-    flex_list = []
-    for fd in data.lift_data[0].flex_data:
-        flex_list.append(fd.flex_position)
-
-    return flex_list
+    return data.flex_positions
 
 def _get_lift_positions(data):
-    lifts = []
-    for ld in data.lift_data:
-        lifts.append(ld.lift_position)
-    return lifts
+    return data.lift_positions
 
 
 ##\brief Gives effort contour plot of efforts by lift, flex position
 ##
-##\param params CounterbalanceAnalysisParams : Input params
-##\param data CounterbalanceAnalysisData : Test Data
-##\return qualification.msg.Plot : Plot message with contour
-def plot_effort_contour(params, data, lift_calc = True):
-    effort_list = []
-    for i in range(0, params.num_lifts):
-        flexes, efforts = _get_const_lift_effort(data, i, lift_calc)
-        effort_list.append(efforts)
-    flexes = _get_flex_positions(data)
-    lifts = _get_lift_positions(data)
-
-    flex_grid, lift_grid = numpy.meshgrid(numpy.array(flexes), numpy.array(lifts))
-    effort_grid = numpy.array(effort_list)
-
-    CS = plt.contour(flex_grid, lift_grid, effort_grid)
-    plt.clabel(CS, inline=0, fontsize=10)
-    
-    plt.xlabel('Flex')
-    plt.ylabel('Lift')
-        
-    stream = StringIO()
-    plt.savefig(stream, format = 'png')
-    image = stream.getvalue()
-    p = Plot()
-    if lift_calc:
-        p.title = 'lift_effort_contour'
-    else:
-        p.title = 'flex_effort_contour'
-    p.image = str_to_bytes(image)
-    p.image_format = 'png'
-    
-    plt.close()
-
-    return p
+## Plots are rendered by counterbalance_plots, imported on first use.
+## See counterbalance_plots.plot_effort_contour
+def plot_effort_contour(*args, **kwargs):
+    from pr2_counterbalance_check import counterbalance_plots
+    return counterbalance_plots.plot_effort_contour(*args, **kwargs)
 
 ##\brief Plots CB efforts against shoulder lift position
 ##
-##\param flex_index int : Index of flex data to plot against
-##\param lift_calc bool : Lift efforts or flex efforts
-def plot_efforts_by_lift_position(params, data, flex_index = -1, lift_calc = True):
-    lift_position, effort = _get_const_flex_effort(data, flex_index, lift_calc)
-    
-    flex_position = data.lift_data[0].flex_data[flex_index].flex_position
+## See counterbalance_plots.plot_efforts_by_lift_position
+def plot_efforts_by_lift_position(*args, **kwargs):
+    from pr2_counterbalance_check import counterbalance_plots
+    return counterbalance_plots.plot_efforts_by_lift_position(*args, **kwargs)
 
-    plt.plot(numpy.array(lift_position), numpy.array(effort))
-    if lift_calc:
-        plt.title('Shoulder Lift Effort at Flex Position %.2f' % (flex_position))
-    else:
-        plt.title('Shoulder Flex Effort at Flex Position %.2f' % (flex_position))
-    plt.axes()
-    plt.xlabel('Lift Position')
-    plt.ylabel('Effort')
-    plt.axhline(y = 0, color = 'r', label='_nolegend_')
-
-    stream = StringIO()
-    plt.savefig(stream, format = 'png')
-    image = stream.getvalue()
-    p = Plot()
-    if lift_calc:
-        p.title = 'lift_effort_const_flex_%d' % flex_index
-    else:
-        p.title = 'flex_effort_const_flex_%d' % flex_index
-    p.image = str_to_bytes(image)
-    p.image_format = 'png'
-    
-    plt.close()
-
-    return p
+##\brief Renders all plots of a CB test concurrently
+##
+## See counterbalance_plots.render_plots
+def render_plots(*args, **kwargs):
+    from pr2_counterbalance_check import counterbalance_plots
+    return counterbalance_plots.render_plots(*args, **kwargs)
 
 ##\brief Checks shoulder lift efforts against params
 ##
 ##\return CounterbalanceAnalysisResult
 def analyze_lift_efforts(params, data):
+    from pr2_self_test_msgs.msg import TestValue
+
     result = CounterbalanceAnalysisResult()
     
-    avg_efforts = numpy.array(get_efforts(data, True))
-    mse = _get_mean_sq_effort(avg_efforts)
-    avg_abs = _get_mean_abs_effort(avg_efforts)
-    avg_eff = _get_mean_effort(avg_efforts)
+    mse, avg_abs, avg_eff = get_effort_stats(data, True)
 
     mse_ok = mse < params.lift_mse
     avg_abs_ok = avg_abs < params.lift_avg_abs
@@ -376,12 +371,11 @@ def analyze_lift_efforts(params, data):
 ##
 ##\return CounterbalanceAnalysisResult
 def analyze_flex_efforts(params, data):
+    from pr2_self_test_msgs.msg import TestValue
+
     result = CounterbalanceAnalysisResult()
     
-    avg_efforts = numpy.array(get_efforts(data, False))
-    mse = _get_mean_sq_effort(avg_efforts)
-    avg_abs = _get_mean_abs_effort(avg_efforts)
-    avg_eff = _get_mean_effort(avg_efforts)
+    mse, avg_abs, avg_eff = get_effort_stats(data, False)
 
     mse_ok = mse < params.flex_mse
     avg_abs_ok = avg_abs < params.flex_avg_abs
@@ -412,30 +406,188 @@ def analyze_flex_efforts(params, data):
 
     return result
 
-##\brief Calculates CB adjustment 
+##\brief Analyzes CB test rows (CBRunData) as each lift position completes
 ##
-##\return (secondary, arm_gimbal) : Turns CW
-def calc_cb_adjust(data, model_file):
+## Keeps running sums of squared and absolute hold efforts. The remaining
+## holds can only add to these sums, so the final mean sq. effort and average
+## absolute effort are at least (sum / total holds). Once either bound is over
+## its limit, the test fails whatever the remaining rows are.
+class IncrementalCounterbalanceAnalysis(object):
+    ##\param num_lifts int : Number of lift positions in test
+    ##\param num_flexes int : Number of flex positions at each lift position
+    ##\param lift_mse, lift_avg_abs float : Lift effort limits
+    ##\param flex_test bool : Flex efforts are checked
+    ##\param flex_mse, flex_avg_abs float : Flex effort limits
+    ##\param screw_tol, bar_tol float : CB adjustment tolerances, in turns
+    def __init__(self, num_lifts, num_flexes, lift_mse, lift_avg_abs,
+                 flex_test = True, flex_mse = 0.0, flex_avg_abs = 0.0,
+                 screw_tol = 2.0, bar_tol = 0.8):
+        self.num_lifts    = num_lifts
+        self.num_flexes   = num_flexes
+        self.lift_mse     = lift_mse
+        self.lift_avg_abs = lift_avg_abs
+        self.flex_test    = flex_test
+        self.flex_mse     = flex_mse
+        self.flex_avg_abs = flex_avg_abs
+        self.screw_tol    = screw_tol
+        self.bar_tol      = bar_tol
+
+        # Summary stats of each row, for the CB adjustment of a test stopped early
+        self._runs = []
+        # Sums of lift sq., lift abs., flex sq., flex abs. efforts
+        self._sums = numpy.zeros(4)
+
+    @classmethod
+    def from_params(cls, params):
+        return cls(params.num_lifts, params.num_flexes, params.lift_mse, params.lift_avg_abs,
+                   params.flex_test, params.flex_mse, params.flex_avg_abs,
+                   params.screw_tol, params.bar_tol)
+
+    @property
+    def num_runs(self):
+        return len(self._runs)
+
+    @property
+    def done(self):
+        return self.num_runs >= self.num_lifts
+
+    ##\brief Add data from a completed lift position. Repeated lift positions are ignored
+    ##
+    ##\param msg CBRunData
+    ##\return bool : True if test has definitively failed
+    def add_run(self, msg):
+        if self.done or any(abs(msg.lift_position - r.lift_position) < 1e-4 for r in self._runs):
+            return self.failed
+
+        run = CBRunAnalysisData(msg)
+        efforts = numpy.array([ (fd.lift_hold.effort_avg, fd.flex_hold.effort_avg) for fd in run.flex_data ])
+        self._sums += ((efforts[:, 0] ** 2).sum(), abs(efforts[:, 0]).sum(),
+                       (efforts[:, 1] ** 2).sum(), abs(efforts[:, 1]).sum())
+        self._runs.append(run)
+
+        return self.failed
+
+    ##\brief Analysis data of the lift positions added so far
+    ##
+    ## The grid covers only the completed lift positions. check_cb_adjustment
+    ## resamples it onto the part of the model grid it covers.
+    ##\return CounterbalanceAnalysisData
+    def data(self):
+        return CounterbalanceAnalysisData.from_runs(sorted(self._runs, key = lambda r: r.lift_position))
+
+    ##\brief Lower bounds of final (lift MSE, lift avg. abs., flex MSE, flex avg. abs.) efforts
+    ##
+    ## Bounds are the final values once all lift positions are added.
+    def bounds(self):
+        return tuple(self._sums / float(self.num_lifts * self.num_flexes))
+
+    @property
+    def failed(self):
+        lift_mse, lift_avg_abs, flex_mse, flex_avg_abs = self.bounds()
+        if lift_mse >= self.lift_mse or lift_avg_abs >= self.lift_avg_abs:
+            return True
+        return self.flex_test and (flex_mse >= self.flex_mse or flex_avg_abs >= self.flex_avg_abs)
+
+    ##\return CounterbalanceAnalysisResult : Result so far
+    def result(self):
+        from pr2_self_test_msgs.msg import TestValue
+
+        result = CounterbalanceAnalysisResult()
+        lift_mse, lift_avg_abs, flex_mse, flex_avg_abs = self.bounds()
+
+        result.result = not self.failed
+        if self.failed:
+            result.summary = 'Counterbalance efforts too high after %d of %d lift positions. Requires adjustment' % (self.num_runs, self.num_lifts)
+        elif self.done:
+            result.summary = 'Counterbalance efforts OK'
+        else:
+            result.summary = 'Counterbalance efforts OK so far, %d of %d lift positions' % (self.num_runs, self.num_lifts)
+
+        rows = [ ('Lift Mean Sq. Effort', lift_mse, self.lift_mse),
+                 ('Lift Average Abs. Effort', lift_avg_abs, self.lift_avg_abs) ]
+        if self.flex_test:
+            rows.extend([ ('Flex Mean Sq. Effort', flex_mse, self.flex_mse),
+                          ('Flex Average Abs. Effort', flex_avg_abs, self.flex_avg_abs) ])
+
+        html = ['<p>%s</p>' % result.summary]
+        html.append('<table border="1" cellpadding="2" cellspacing="0">')
+        html.append('<tr><td><b>Parameter</b></td><td><b>Minimum Final Value</b></td><td><b>Maximum</b></td><td><b>Status</b></td></tr>')
+        for name, value, limit in rows:
+            html.append('<tr><td><b>%s</b></td><td>%.2f</td><td>%.2f</td><td>%s</td></tr>' % (name, value, limit, ok_dict[value < limit]))
+        html.append('</table>')
+        result.html = '\n'.join(html)
+
+        result.values = [ TestValue(name, str(value), '', str(limit)) for name, value, limit in rows ]
+
+        return result
+
+##\brief Replays a complete CB test through incremental analysis, as rows would arrive
+##
+##\param msg CounterbalanceTestData
+##\return (IncrementalCounterbalanceAnalysis, int) : Analysis, and number of lift
+## positions needed for a definitive FAIL, or None if the test didn't fail early
+def replay_incremental(msg):
+    analysis = IncrementalCounterbalanceAnalysis.from_params(CounterbalanceAnalysisParams(msg))
+    for i, ld in enumerate(msg.lift_data):
+        if analysis.add_run(ld):
+            return analysis, i + 1
+    return analysis, None
+
+##\brief Lift efforts followed by flex efforts, as used by the CB model
+def _get_model_efforts(data):
+    return numpy.concatenate((_get_effort_grid(data, True).ravel(), _get_effort_grid(data, False).ravel()))
+
+##\brief Calculates CB adjustment, resampling runs that don't match the model's grid
+##
+##\return (secondary, arm_gimbal, error) : Turns CW, and interpolation error in
+## turns. Error is None if the run matched the model's grid
+def _calc_cb_adjust(data, model_file):
     try:
-        # Use this to tune to last known "good" position
-        # A = numpy.load(model_file).transpose()
-        
-        # This uses minimum of total torque
-        A = numpy.load(model_file)[:-1].transpose() 
-        B = numpy.array(get_efforts(data, True) + get_efforts(data, False))
-        X = numpy.linalg.lstsq(A,B)
+        model = load_model(model_file)
+
+        mismatch = model.grid_mismatch(data)
+        if not mismatch:
+            secondary, cb_bar = model.solve(_get_model_efforts(data))
+            return (secondary, cb_bar, None)
+
+        if not model.has_grid:
+            print("Unable to calculate CB adjustment. Data does not match model grid: %s" % mismatch, file=sys.stderr)
+            return (100, 100, None)
+
+        try:
+            return model.solve_resampled(data)
+        except ValueError as e:
+            print("Unable to calculate CB adjustment. %s: %s" % (mismatch, e), file=sys.stderr)
+            return (100, 100, None)
     except:
         print("Unable to calculate CB adjustment. May have incorrect model data", file=sys.stderr)
         import traceback
         traceback.print_exc()
-        return (100, 100)
-
-    # Recommended adjustments
-    secondary = -X[0][0]
-    cb_bar = X[0][1] # CCW increases force
+        return (100, 100, None)
 
+##\brief Calculates CB adjustment 
+##
+## Runs on a different grid than the model are interpolated onto the
+## model's grid, where they overlap.
+##\return (secondary, arm_gimbal) : Turns CW
+def calc_cb_adjust(data, model_file):
+    secondary, cb_bar, error = _calc_cb_adjust(data, model_file)
     return (secondary, cb_bar)
 
+##\brief Calculates CB adjustment for many runs in one solve
+##
+##\param data_list [ CounterbalanceAnalysisData ] : Runs, all on the model's grid. Raises ValueError otherwise
+##\return numpy.ndarray : (num_runs, 2) secondary, arm_gimbal turns CW
+def calc_cb_adjust_batch(data_list, model_file):
+    model = load_model(model_file)
+    for data in data_list:
+        mismatch = model.grid_mismatch(data)
+        if mismatch:
+            raise ValueError('Data does not match model grid: %s' % mismatch)
+
+    efforts = numpy.array([ _get_model_efforts(data) for data in data_list ])
+    return model.solve_batch(efforts)
+
 ##\brief Return CB adjustments to minimize total torque
 ##
 ## Uses CB adjustment/torque value from the model file. 
@@ -444,9 +596,11 @@ def calc_cb_adjust(data, model_file):
 ##\param data CounterbalanceAnalysisData
 ##\param str : Filename of model file
 def check_cb_adjustment(params, data, model_file):
+    from pr2_self_test_msgs.msg import TestValue
+
     result = CounterbalanceAnalysisResult()
 
-    (secondary, cb_bar) = calc_cb_adjust(data, model_file)
+    (secondary, cb_bar, interp_error) = _calc_cb_adjust(data, model_file)
 
     if (abs(secondary) > 25 or abs(cb_bar) > 25):
         result.result = False
@@ -462,9 +616,15 @@ def check_cb_adjustment(params, data, model_file):
     adjust_msg += '<tr><td>Secondary Spring</td><td>%.1f</td><td>%s</td><td>%.1f</td></tr>\n' % (abs(secondary), secondary_dir, params.screw_tol)
     adjust_msg += '<tr><td>Arm Gimbal Shaft</td><td>%.1f</td><td>%s</td><td>%.1f</td></tr>\n' % (abs(cb_bar), cb_bar_dir, params.bar_tol)
     adjust_msg += '</table>\n'
+    if interp_error is not None:
+        adjust_msg += '<p>Test grid does not match CB model grid. Efforts were interpolated onto the model grid, adjustment may be off by %.2f turns.</p>\n' % interp_error
 
-    
-    if abs(secondary) > params.screw_tol or abs(cb_bar) > params.bar_tol:
+    max_interp_error = MAX_INTERP_ERROR * min(params.screw_tol, params.bar_tol)
+    if interp_error is not None and interp_error > max_interp_error:
+        result.result = False
+        result.summary = 'Unable to recommend CB adjustment, test grid does not match CB model grid. Retest on model grid. '
+        result.html = '<p>Unable to recommend CB adjustment. Interpolation error of %.2f turns is over the limit of %.2f turns. Retest on the CB model grid. Adjustment below is for reference only.</p>\n<p>%s</p>\n' % (interp_error, max_interp_error, adjust_msg)
+    elif abs(secondary) > params.screw_tol or abs(cb_bar) > params.bar_tol:
         result.result = False
         result.summary = 'CB adjustment recommended. Follow instructions below to tune CB. '
         result.html = '<p>CB adjustment recommended. Adjusting the counterbalance will increase performance of the arm. (Note: CW = "Clockwise")</p>\n<p>%s</p>\n' % adjust_msg
@@ -476,5 +636,7 @@ def check_cb_adjustment(params, data, model_file):
 
     result.values = [TestValue('Secondary Spring Adjustment', str(secondary), '', str(params.screw_tol)),
                      TestValue('CB Bar Adjustment', str(cb_bar), '', str(params.bar_tol))]
+    if interp_error is not None:
+        result.values.append(TestValue('CB Adjustment Interpolation Error', str(interp_error), '', str(max_interp_error)))
 
     return result
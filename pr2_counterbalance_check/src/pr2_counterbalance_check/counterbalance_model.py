@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Loads, saves and solves the counterbalance adjustment model
+##
+## Model files are a small YAML header, with format version, grid geometry,
+## joint names and training metadata, next to a raw .npy model array of the
+## same basename that is memory-mapped on load. A legacy pickled .dat model
+## is read only if no converted model of the same basename is next to it,
+## without grid checks.
+
+import os
+import numpy
+
+MODEL_FORMAT = 'pr2_counterbalance_model'
+MODEL_VERSION = 1
+
+# Grid positions match if within this (positions are float32 in messages)
+GRID_TOL = 1e-3
+
+##\brief Grid positions of one joint, as CounterbalanceTestController steps them
+##
+##\param min_pos, max_pos, delta float : Controller's min, max and delta params
+##\return [ float ] : Positions
+def grid_positions(min_pos, max_pos, delta):
+    num = 1
+    if delta > 0:
+        num = int((max_pos - min_pos) / delta + 1)
+    return [ min_pos + delta * i for i in range(num) ]
+
+##\brief Columns of model efforts at the given grid indices
+##
+##\return numpy.ndarray : Indices into lift efforts, then flex efforts, as get_efforts() orders them
+def effort_columns(num_lifts, num_flexes, lift_indices, flex_indices):
+    grid = (numpy.asarray(lift_indices)[:, numpy.newaxis] * num_flexes + numpy.asarray(flex_indices)).ravel()
+    return numpy.concatenate((grid, grid + num_lifts * num_flexes))
+
+##\brief Target positions within range of source positions
+##
+##\return numpy.ndarray : Bool mask of target
+def covered(source, target):
+    source = numpy.asarray(source, dtype=numpy.float64)
+    target = numpy.asarray(target, dtype=numpy.float64)
+    return (target >= source.min() - GRID_TOL) & (target <= source.max() + GRID_TOL)
+
+##\brief Linear interpolation weights from source positions to target positions
+##
+## Targets are clamped to the source range, so check covered() first.
+##\return numpy.ndarray : (len(target), len(source)) weights
+def interp_matrix(source, target):
+    source = numpy.asarray(source, dtype=numpy.float64)
+    target = numpy.asarray(target, dtype=numpy.float64)
+    order = numpy.argsort(source)
+    s = source[order]
+
+    W = numpy.zeros((len(target), len(source)))
+    if len(s) == 1:
+        W[:, order[0]] = 1.0
+        return W
+
+    t = numpy.clip(target, s[0], s[-1])
+    hi = numpy.clip(numpy.searchsorted(s, t, side='right'), 1, len(s) - 1)
+    lo = hi - 1
+    frac = (t - s[lo]) / (s[hi] - s[lo])
+
+    rows = numpy.arange(len(target))
+    W[rows, order[lo]] += 1 - frac
+    W[rows, order[hi]] += frac
+    return W
+
+##\brief Counterbalance model, factorized on the first solve for repeated adjustment solves
+##
+## The model array is (3, num_efforts): effort change per turn CW of the
+## secondary spring, per turn CW of the CB bar, and the constant term.
+## Efforts are the lift efforts followed by the flex efforts, as given by
+## get_efforts().
+class CounterbalanceModel(object):
+    ##\param model numpy.ndarray : (3, num_efforts) model array
+    ##\param lift_positions [ float ] : Lift positions of training grid, or None if unknown
+    ##\param flex_positions [ float ] : Flex positions of training grid, or None if unknown
+    ##\param lift_joint str : Lift joint of training data
+    ##\param flex_joint str : Flex joint of training data
+    ##\param metadata dict : Training information
+    def __init__(self, model, lift_positions = None, flex_positions = None,
+                 lift_joint = '', flex_joint = '', metadata = None):
+        self.model = numpy.asarray(model, dtype=numpy.float64)
+
+        self.lift_positions = None if lift_positions is None else numpy.asarray(lift_positions, dtype=numpy.float64)
+        self.flex_positions = None if flex_positions is None else numpy.asarray(flex_positions, dtype=numpy.float64)
+        self.lift_joint = lift_joint
+        self.flex_joint = flex_joint
+        self.metadata = metadata or {}
+
+        if self.model.ndim != 2 or self.model.shape[0] != 3:
+            raise ValueError('Model array must have shape (3, num_efforts), got %s' % (self.model.shape,))
+
+        if self.has_grid and self.model.shape[1] != 2 * len(self.lift_positions) * len(self.flex_positions):
+            raise ValueError('Model array has %d efforts, expected %d for %dx%d grid' % (
+                    self.model.shape[1], 2 * len(self.lift_positions) * len(self.flex_positions),
+                    len(self.lift_positions), len(self.flex_positions)))
+
+        # Memory-mapped model data is read on the first solve
+        self._pinv_cache = None
+
+    @property
+    def _pinv(self):
+        if self._pinv_cache is None:
+            # This uses minimum of total torque. To tune to last known
+            # "good" position, use the full model, including the constant term.
+            A = self.model[:-1].transpose()
+            self._pinv_cache = numpy.linalg.pinv(A)
+        return self._pinv_cache
+
+    @property
+    def num_efforts(self):
+        return self.model.shape[1]
+
+    @property
+    def has_grid(self):
+        return self.lift_positions is not None and self.flex_positions is not None
+
+    ##\brief Check run's grid against the model's grid
+    ##
+    ##\param data CounterbalanceAnalysisData
+    ##\return str : Description of mismatch, or None if data can be solved
+    def grid_mismatch(self, data):
+        lifts = numpy.asarray(data.lift_positions)
+        flexes = numpy.asarray(data.flex_positions)
+
+        if 2 * len(lifts) * len(flexes) != self.num_efforts:
+            return 'Data has %dx%d grid, model has %d efforts' % (len(lifts), len(flexes), self.num_efforts)
+
+        if not self.has_grid:
+            return None
+
+        if len(lifts) != len(self.lift_positions) or len(flexes) != len(self.flex_positions):
+            return 'Data has %dx%d grid, model has %dx%d grid' % (
+                len(lifts), len(flexes), len(self.lift_positions), len(self.flex_positions))
+
+        if not numpy.allclose(lifts, self.lift_positions, rtol = 0, atol = GRID_TOL):
+            return 'Lift positions of data do not match model'
+        if not numpy.allclose(flexes, self.flex_positions, rtol = 0, atol = GRID_TOL):
+            return 'Flex positions of data do not match model'
+
+        return None
+
+    ##\brief Least squares CB adjustment for one effort vector
+    ##
+    ##\param efforts numpy.ndarray : (num_efforts,) lift, then flex efforts
+    ##\return (secondary, cb_bar) : Turns CW
+    def solve(self, efforts):
+        X = numpy.dot(self._pinv, efforts)
+
+        secondary = -X[0]
+        cb_bar = X[1] # CCW increases force
+
+        return (secondary, cb_bar)
+
+    ##\brief Least squares CB adjustment for many effort vectors at once
+    ##
+    ##\param efforts numpy.ndarray : (num_runs, num_efforts) stacked effort vectors
+    ##\return numpy.ndarray : (num_runs, 2) secondary, cb_bar turns CW
+    def solve_batch(self, efforts):
+        X = numpy.dot(numpy.atleast_2d(efforts), self._pinv.transpose())
+        X[:, 0] *= -1
+
+        return X
+
+    ##\brief Least squares CB adjustment for a run on a different grid
+    ##
+    ## The run's efforts are interpolated onto the model positions inside the
+    ## run's range, and solved with the model's efforts at those positions.
+    ## The error estimate is the difference from the other interpolation:
+    ## model efforts interpolated onto the run positions inside the model's
+    ## range.
+    ##\param data CounterbalanceAnalysisData
+    ##\return (secondary, cb_bar, error) : Turns CW, and max abs. difference of interpolations in turns
+    def solve_resampled(self, data):
+        if not self.has_grid:
+            raise ValueError('Model has no grid positions, unable to resample run')
+
+        run_lifts = numpy.asarray(data.lift_positions, dtype=numpy.float64)
+        run_flexes = numpy.asarray(data.flex_positions, dtype=numpy.float64)
+        lift_in = covered(run_lifts, self.lift_positions)
+        flex_in = covered(run_flexes, self.flex_positions)
+        if not lift_in.any() or not flex_in.any():
+            raise ValueError('Run grid does not overlap model grid')
+
+        # Run efforts on model positions
+        Wl = interp_matrix(run_lifts, self.lift_positions[lift_in])
+        Wf = interp_matrix(run_flexes, self.flex_positions[flex_in])
+        efforts = numpy.concatenate([ numpy.dot(numpy.dot(Wl, grid), Wf.transpose()).ravel()
+                                      for grid in (data.lift_effort_avg, data.flex_effort_avg) ])
+        columns = effort_columns(len(self.lift_positions), len(self.flex_positions),
+                                 numpy.nonzero(lift_in)[0], numpy.nonzero(flex_in)[0])
+        turns = self._solve_columns(self.model[:2, columns], efforts)
+
+        # Model efforts on run positions
+        run_lift_in = covered(self.lift_positions, run_lifts)
+        run_flex_in = covered(self.flex_positions, run_flexes)
+        Ml = interp_matrix(self.lift_positions, run_lifts[run_lift_in])
+        Mf = interp_matrix(self.flex_positions, run_flexes[run_flex_in])
+        model_grid = self.model[:2].reshape(2, 2, len(self.lift_positions), len(self.flex_positions))
+        run_model = numpy.einsum('il,chlf,jf->chij', Ml, model_grid, Mf).reshape(2, -1)
+        ix = numpy.ix_(run_lift_in, run_flex_in)
+        run_efforts = numpy.concatenate([ numpy.asarray(grid)[ix].ravel()
+                                          for grid in (data.lift_effort_avg, data.flex_effort_avg) ])
+        check = self._solve_columns(run_model, run_efforts)
+
+        return (turns[0], turns[1], float(abs(turns - check).max()))
+
+    @staticmethod
+    def _solve_columns(model, efforts):
+        A = model.transpose()
+        if numpy.linalg.matrix_rank(A) < 2:
+            raise ValueError('Run grid overlaps too few model positions to solve adjustment')
+        X = numpy.dot(numpy.linalg.pinv(A), efforts)
+        return numpy.array([ -X[0], X[1] ])
+
+##\brief Name of .npy data file for model header file
+def _data_file(model_file):
+    return os.path.splitext(model_file)[0] + '.npy'
+
+##\brief Write model header and data files
+##
+##\param model_file str : Header filename (.yaml). Data is written next to it (.npy)
+##\param model CounterbalanceModel
+def save_model(model_file, model):
+    data_file = _data_file(model_file)
+    numpy.save(data_file, model.model)
+
+    header = {
+        'format': MODEL_FORMAT,
+        'version': MODEL_VERSION,
+        'shape': list(model.model.shape),
+        'lift_joint': model.lift_joint,
+        'flex_joint': model.flex_joint,
+        'lift_positions': None if model.lift_positions is None else [ round(float(v), 6) for v in model.lift_positions ],
+        'flex_positions': None if model.flex_positions is None else [ round(float(v), 6) for v in model.flex_positions ],
+        'metadata': model.metadata,
+        }
+
+    import yaml
+    with open(model_file, 'w') as f:
+        yaml.safe_dump(header, f, default_flow_style = False)
+
+##\brief Read and validate header of model file
+##
+##\return dict : Model header
+def read_model_header(model_file):
+    import yaml
+    with open(model_file) as f:
+        header = yaml.safe_load(f)
+
+    if not isinstance(header, dict) or header.get('format') != MODEL_FORMAT:
+        raise ValueError('%s is not a counterbalance model header' % model_file)
+    if header.get('version', 0) > MODEL_VERSION:
+        raise ValueError('Model %s has version %s, only versions up to %d are supported' % (
+                model_file, header.get('version'), MODEL_VERSION))
+
+    return header
+
+##\brief Model file to load for model_file, its converted header if there is one
+##
+##\param model_file str : Filename of model header (.yaml) or legacy model (.dat)
+##\return str : Filename of model header, or legacy model if not converted
+def resolve_model_file(model_file):
+    header_file = os.path.splitext(model_file)[0] + '.yaml'
+    if not model_file.endswith('.yaml') and os.path.exists(header_file):
+        return header_file
+    return model_file
+
+##\brief Load legacy model file, without grid information
+##
+##\param model_file str : Legacy model (.dat), pickled by ndarray.dump(), possibly under Python 2
+##\return CounterbalanceModel
+def load_legacy_model(model_file):
+    return CounterbalanceModel(numpy.load(model_file, allow_pickle=True, encoding='latin1'))
+
+def _load_model_file(path):
+    if not path.endswith('.yaml'):
+        return load_legacy_model(path)
+
+    header = read_model_header(path)
+    data_file = _data_file(path)
+    model = numpy.load(data_file, mmap_mode='r')
+
+    if list(model.shape) != list(header['shape']):
+        raise ValueError('Model data %s has shape %s, header gives %s' % (
+                data_file, model.shape, tuple(header['shape'])))
+
+    return CounterbalanceModel(model,
+                               header.get('lift_positions'), header.get('flex_positions'),
+                               header.get('lift_joint', ''), header.get('flex_joint', ''),
+                               header.get('metadata'))
+
+_model_cache = {}
+
+##\brief Load model file, cached by path and modification time
+##
+## A legacy model converted by convert_cb_model.py is loaded from its header.
+##\param model_file str : Filename of model header (.yaml) or legacy model (.dat)
+##\return CounterbalanceModel
+def load_model(model_file):
+    path = resolve_model_file(os.path.abspath(model_file))
+    mtime = os.path.getmtime(path)
+    if path.endswith('.yaml'):
+        mtime = max(mtime, os.path.getmtime(_data_file(path)))
+
+    cached = _model_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    model = _load_model_file(path)
+    _model_cache[path] = (mtime, model)
+
+    return model
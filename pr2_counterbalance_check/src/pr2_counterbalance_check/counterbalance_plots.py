@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Renders counterbalance plots
+##
+## Split from counterbalance_analysis, since matplotlib is slow to import.
+## counterbalance_analysis loads this on the first plot. matplotlib itself is
+## only loaded to render a plot, not to find it in the plot cache.
+
+import numpy
+import multiprocessing
+
+from io import BytesIO
+
+from pr2_self_test_msgs.msg import Plot
+
+from pr2_counterbalance_check.counterbalance_analysis import str_to_bytes, _get_effort_grid, \
+    _get_const_flex_effort, _get_flex_positions, _get_lift_positions
+
+##\brief Saves figure to image data
+##
+##\param image_format str : Any format supported by matplotlib, ex: 'png', 'svg'
+##\param dpi int : Resolution of raster images, or None for default (640x480 PNG)
+def _print_figure(fig, image_format = 'png', dpi = None):
+    stream = BytesIO()
+    fig.savefig(stream, format = image_format, dpi = dpi)
+    return stream.getvalue()
+
+##\brief Renders contour of efforts by flex (x), lift (y) position
+##
+## Uses its own Figure and Agg canvas, so it is safe to call from
+## several threads or processes at once.
+##\return bytes : Image data
+def _render_effort_contour(flexes, lifts, effort_grid, image_format = 'png', dpi = None):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    flex_grid, lift_grid = numpy.meshgrid(flexes, lifts)
+    CS = ax.contour(flex_grid, lift_grid, effort_grid)
+    ax.clabel(CS, inline=0, fontsize=10)
+
+    ax.set_xlabel('Flex')
+    ax.set_ylabel('Lift')
+
+    return _print_figure(fig, image_format, dpi)
+
+##\brief Renders efforts against lift position
+##
+##\return bytes : Image data
+def _render_efforts_by_lift(lifts, efforts, title, image_format = 'png', dpi = None):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    ax.plot(lifts, efforts)
+    ax.set_title(title)
+    ax.set_xlabel('Lift Position')
+    ax.set_ylabel('Effort')
+    ax.axhline(y = 0, color = 'r', label='_nolegend_')
+
+    return _print_figure(fig, image_format, dpi)
+
+_renderers = { 'contour': _render_effort_contour,
+               'by_lift': _render_efforts_by_lift }
+
+##\brief Renders a plot task, (renderer name, args, image format, dpi)
+##
+## Top level so it can run in a worker process
+def _render(task):
+    name, args, image_format, dpi = task
+    return _renderers[name](*args, image_format = image_format, dpi = dpi)
+
+##\brief Renders a plot task, or gets its image from cache
+##
+##\param cache PlotCache : Cache of rendered images, or None
+def _render_cached(task, cache):
+    if cache is None:
+        return _render(task)
+
+    key = cache.key(task)
+    image = cache.get(key)
+    if image is None:
+        image = _render(task)
+        cache.put(key, image)
+    return image
+
+##\return (task, title) : Render task and plot title of effort contour
+def _effort_contour_task(data, lift_calc, image_format = 'png', dpi = None):
+    task = ('contour', (_get_flex_positions(data), _get_lift_positions(data), _get_effort_grid(data, lift_calc)),
+            image_format, dpi)
+    if lift_calc:
+        return task, 'lift_effort_contour'
+    return task, 'flex_effort_contour'
+
+##\return (task, title) : Render task and plot title of efforts by lift position
+def _efforts_by_lift_task(data, flex_index, lift_calc, image_format = 'png', dpi = None):
+    lift_position, effort = _get_const_flex_effort(data, flex_index, lift_calc)
+    flex_position = _get_flex_positions(data)[flex_index]
+
+    if lift_calc:
+        title = 'Shoulder Lift Effort at Flex Position %.2f' % (flex_position)
+        plot_title = 'lift_effort_const_flex_%d' % flex_index
+    else:
+        title = 'Shoulder Flex Effort at Flex Position %.2f' % (flex_position)
+        plot_title = 'flex_effort_const_flex_%d' % flex_index
+
+    return ('by_lift', (lift_position, effort, title), image_format, dpi), plot_title
+
+def _make_plot(title, image, image_format):
+    p = Plot()
+    p.title = title
+    p.image = str_to_bytes(image)
+    p.image_format = image_format
+    return p
+
+##\brief Gives effort contour plot of efforts by lift, flex position
+##
+##\param params CounterbalanceAnalysisParams : Input params
+##\param data CounterbalanceAnalysisData : Test Data
+##\param image_format str : Image format, ex: 'png' or 'svg'
+##\param dpi int : Resolution of raster images, or None for default
+##\param cache PlotCache : Cache of rendered images, or None
+##\return qualification.msg.Plot : Plot message with contour
+def plot_effort_contour(params, data, lift_calc = True, image_format = 'png', dpi = None, cache = None):
+    task, title = _effort_contour_task(data, lift_calc, image_format, dpi)
+    return _make_plot(title, _render_cached(task, cache), image_format)
+
+##\brief Plots CB efforts against shoulder lift position
+##
+##\param flex_index int : Index of flex data to plot against
+##\param lift_calc bool : Lift efforts or flex efforts
+##\param image_format str : Image format, ex: 'png' or 'svg'
+##\param dpi int : Resolution of raster images, or None for default
+##\param cache PlotCache : Cache of rendered images, or None
+def plot_efforts_by_lift_position(params, data, flex_index = -1, lift_calc = True, image_format = 'png', dpi = None, cache = None):
+    task, title = _efforts_by_lift_task(data, flex_index, lift_calc, image_format, dpi)
+    return _make_plot(title, _render_cached(task, cache), image_format)
+
+##\brief Renders all plots of a CB test concurrently
+##
+## Plots are rendered in worker processes. Only the plotted arrays are
+## sent to the workers. Plots found in the cache are not rendered, and no
+## pool is needed if all plots are cached.
+##\param pool multiprocessing.Pool : Pool to render in. If None, a pool is created for this call
+##\param image_format str : Image format, ex: 'png' or 'svg'
+##\param dpi int : Resolution of raster images, or None for default
+##\param cache PlotCache : Cache of rendered images, or None
+##\return [ Plot ] : Lift efforts by lift position, then lift and flex effort contours if flex was tested
+def render_plots(params, data, pool = None, image_format = 'png', dpi = None, cache = None):
+    tasks = [ _efforts_by_lift_task(data, -1, True, image_format, dpi) ]
+    if params.flex_test:
+        tasks.append(_effort_contour_task(data, True, image_format, dpi))
+        tasks.append(_effort_contour_task(data, False, image_format, dpi))
+
+    images = [ None ] * len(tasks)
+    if cache is not None:
+        keys = [ cache.key(task) for task, title in tasks ]
+        images = [ cache.get(key) for key in keys ]
+
+    missing = [ i for i, image in enumerate(images) if image is None ]
+    if missing:
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(len(missing))
+        try:
+            rendered = pool.map(_render, [ tasks[i][0] for i in missing ])
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+
+        for i, image in zip(missing, rendered):
+            images[i] = image
+            if cache is not None:
+                cache.put(keys[i], image)
+
+    return [ _make_plot(title, image, image_format) for (task, title), image in zip(tasks, images) ]
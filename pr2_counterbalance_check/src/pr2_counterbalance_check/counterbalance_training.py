@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Trains the counterbalance adjustment model from CB test bags
+##
+## Each training bag is a CB test taken with a known secondary spring and
+## CB bar adjustment. Bags and adjustments are listed in a manifest, CSV
+## with columns bag, secondary, cb_bar or YAML, and read in parallel.
+##
+## The model is solved from sufficient statistics of the training set,
+## saved next to the model with the efforts of each bag. Bags can be added
+## to a trained model without reading the other training bags again, and
+## removed without reading any bags.
+
+import os
+import csv
+import multiprocessing
+
+import numpy
+
+from pr2_counterbalance_check.bag_reader import CB_MSG_TYPE, read_cb_msg
+from pr2_counterbalance_check.counterbalance_analysis import CounterbalanceAnalysisData, get_efforts
+from pr2_counterbalance_check.counterbalance_model import CounterbalanceModel, GRID_TOL
+
+STATS_VERSION = 2
+
+##\brief Bag of training set, with adjustments when it was taken
+class TrainingEntry(object):
+    ##\param bag str : Bag filename
+    ##\param secondary float : Secondary spring adjustment from "zero", turns CW
+    ##\param cb_bar float : CB bar adjustment from "zero", turns CW
+    ##\param name str : Name of bag in training set, its path relative to the manifest. Default bag
+    def __init__(self, bag, secondary, cb_bar, name = None):
+        self.bag = bag
+        self.secondary = float(secondary)
+        self.cb_bar = float(cb_bar)
+        self.name = os.path.normpath(name or bag)
+
+##\brief Reads training manifest
+##
+## CSV manifests have a header row with columns bag, secondary, cb_bar.
+## YAML manifests (.yaml, .yml) are a list of dicts with the same keys,
+## or a dict with that list under 'bags'. Relative bag paths are relative
+## to the manifest. Bags are named by their path in the manifest, so bags
+## to remove from a model are listed as they were in its training manifest.
+##\return [ TrainingEntry ]
+def read_manifest(manifest_file):
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+    if os.path.splitext(manifest_file)[1] in ('.yaml', '.yml'):
+        import yaml
+        with open(manifest_file) as f:
+            rows = yaml.safe_load(f)
+        if isinstance(rows, dict):
+            rows = rows.get('bags')
+        if not isinstance(rows, list):
+            raise ValueError('Manifest %s has no list of bags' % manifest_file)
+    else:
+        with open(manifest_file) as f:
+            rows = [ r for r in csv.DictReader(f) ]
+
+    entries = []
+    for i, row in enumerate(rows):
+        try:
+            bag = str(row['bag']).strip()
+            entry = TrainingEntry(os.path.join(base_dir, bag), row['secondary'], row['cb_bar'], bag)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError('Manifest %s, entry %d: expected bag, secondary and cb_bar (%s)' % (
+                    manifest_file, i + 1, e))
+        entries.append(entry)
+
+    return entries
+
+##\brief Efforts and grid of one training bag
+class TrainingData(object):
+    ##\param msg CounterbalanceTestData
+    def __init__(self, msg):
+        data = CounterbalanceAnalysisData(msg)
+        self.efforts = numpy.array(get_efforts(data, True) + get_efforts(data, False))
+        self.lift_positions = data.lift_positions
+        self.flex_positions = data.flex_positions
+        self.lift_joint = msg.lift_joint
+        self.flex_joint = msg.flex_joint
+
+##\brief Loads training data of bag. Runs in a worker process
+##
+##\return TrainingData
+def load_training_data(bag_file):
+    msg = read_cb_msg(bag_file)
+    if msg is None:
+        raise ValueError('Bag %s has no %s message' % (bag_file, CB_MSG_TYPE))
+    return TrainingData(msg)
+
+def _same_grid(a, b):
+    for pa, pb in ((a.lift_positions, b.lift_positions), (a.flex_positions, b.flex_positions)):
+        if pa is None or pb is None or pa.shape != pb.shape or \
+                not numpy.allclose(pa, pb, rtol = 0, atol = GRID_TOL):
+            return False
+    return True
+
+##\brief Design matrix of adjustments, with constant term
+##
+##\return numpy.ndarray : (num_bags, 3) secondary, cb_bar, 1
+def design_matrix(adjustments):
+    adjustments = numpy.asarray(adjustments, dtype=numpy.float64).reshape(-1, 2)
+    return numpy.hstack((adjustments, numpy.ones((len(adjustments), 1))))
+
+##\brief Name of training statistics file of model header file
+def stats_file(model_file):
+    return os.path.splitext(model_file)[0] + '_stats.npz'
+
+##\brief Sufficient statistics of CB model training set
+##
+## With A the (num_bags, 3) design matrix and B the (num_bags, num_efforts)
+## efforts, keeps A'A, A'B and the column sums of squares of B. Bags are
+## added or removed in O(num_efforts), and the model is the solution of
+## A'A X = A'B.
+##
+## Named bags keep their adjustments and efforts, so they can be removed
+## by name.
+class TrainingStats(object):
+    def __init__(self, num_efforts):
+        self.AtA = numpy.zeros((3, 3))
+        self.AtB = numpy.zeros((3, num_efforts))
+        self.BtB = numpy.zeros(num_efforts)
+        self.count = 0
+        self.bags = []
+        self.adjustments = numpy.zeros((0, 2))
+        self.efforts = numpy.zeros((0, num_efforts))
+
+    @property
+    def num_efforts(self):
+        return self.AtB.shape[1]
+
+    def copy(self):
+        stats = TrainingStats(self.num_efforts)
+        stats.AtA[:] = self.AtA
+        stats.AtB[:] = self.AtB
+        stats.BtB[:] = self.BtB
+        stats.count = self.count
+        stats.bags = list(self.bags)
+        stats.adjustments = self.adjustments.copy()
+        stats.efforts = self.efforts.copy()
+        return stats
+
+    def _update(self, adjustments, efforts, sign):
+        A = design_matrix(adjustments)
+        B = numpy.asarray(efforts, dtype=numpy.float64).reshape(len(A), -1)
+        if B.shape[1] != self.num_efforts:
+            raise ValueError('Training efforts have %d values, statistics have %d' % (B.shape[1], self.num_efforts))
+
+        self.AtA += sign * numpy.dot(A.T, A)
+        self.AtB += sign * numpy.dot(A.T, B)
+        self.BtB += sign * (B ** 2).sum(axis=0)
+        self.count += sign * len(A)
+
+    ##\brief Add bags to training set
+    ##
+    ##\param adjustments numpy.ndarray : (num_bags, 2) secondary, cb_bar turns CW
+    ##\param efforts numpy.ndarray : (num_bags, num_efforts) lift, then flex efforts
+    ##\param bags [ str ] : Bag names, to remove bags by name later. Or None
+    def add(self, adjustments, efforts, bags = None):
+        if bags is not None:
+            bags = list(bags)
+            for b in bags:
+                if b in self.bags or bags.count(b) > 1:
+                    raise ValueError('Bag %s is already in training set' % b)
+
+        self._update(adjustments, efforts, 1)
+        if bags is not None:
+            self.bags.extend(bags)
+            self.adjustments = numpy.vstack((self.adjustments, design_matrix(adjustments)[:, :2]))
+            self.efforts = numpy.vstack((self.efforts, numpy.asarray(efforts, dtype=numpy.float64).reshape(len(bags), -1)))
+
+    ##\brief Remove bags, previously added, from training set
+    def remove(self, adjustments, efforts):
+        if len(design_matrix(adjustments)) > self.count:
+            raise ValueError('Unable to remove %d bags from training set of %d' % (len(adjustments), self.count))
+        self._update(adjustments, efforts, -1)
+
+    ##\brief Remove named bags from training set, from their stored efforts
+    ##
+    ##\param bags [ str ] : Bag names
+    ##\return numpy.ndarray : (num_bags, 2) adjustments of removed bags
+    def remove_bags(self, bags):
+        bags = list(bags)
+        index = []
+        for b in bags:
+            if b not in self.bags:
+                raise ValueError('Bag %s is not in training set' % b)
+            if bags.count(b) > 1:
+                raise ValueError('Bag %s is removed more than once' % b)
+            index.append(self.bags.index(b))
+
+        adjustments = self.adjustments[index]
+        self.remove(adjustments, self.efforts[index])
+
+        keep = [ i for i in range(len(self.bags)) if i not in index ]
+        self.bags = [ self.bags[i] for i in keep ]
+        self.adjustments = self.adjustments[keep]
+        self.efforts = self.efforts[keep]
+        return adjustments
+
+    ##\return numpy.ndarray : (3, num_efforts) model array
+    def solve(self):
+        if self.count < 3:
+            raise ValueError('Need at least 3 training bags, have %d' % self.count)
+        try:
+            return numpy.linalg.solve(self.AtA, self.AtB)
+        except numpy.linalg.LinAlgError:
+            raise ValueError('Training adjustments do not determine the model. Vary both secondary and CB bar adjustments')
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            numpy.savez(f, version = STATS_VERSION, AtA = self.AtA, AtB = self.AtB, BtB = self.BtB, count = self.count,
+                        bags = numpy.array(self.bags, dtype=numpy.str_).reshape(-1),
+                        adjustments = self.adjustments, efforts = self.efforts)
+
+    @classmethod
+    def load(cls, filename):
+        f = numpy.load(filename)
+        try:
+            if int(f['version']) != STATS_VERSION:
+                raise ValueError('Training statistics %s have version %d, only version %d is supported. Retrain the model' % (
+                        filename, int(f['version']), STATS_VERSION))
+            stats = cls(f['AtB'].shape[1])
+            stats.AtA[:] = f['AtA']
+            stats.AtB[:] = f['AtB']
+            stats.BtB[:] = f['BtB']
+            stats.count = int(f['count'])
+            stats.bags = [ str(b) for b in f['bags'] ]
+            stats.adjustments = f['adjustments'].reshape(-1, 2)
+            stats.efforts = f['efforts'].reshape(-1, stats.num_efforts)
+        finally:
+            f.close()
+        return stats
+
+##\brief Leave-one-out validation of training bags
+##
+## Leave-one-out results are closed form, from the leverage (hat matrix
+## diagonal) h of each bag, without refitting. The model without bag i is
+## X - (A'A)^-1 a_i e_i' / (1 - h_i), with e_i the bag's effort residuals.
+## The turn error is the held-out model's estimate of the bag's adjustments,
+## from its efforts, less the recorded adjustments. Adjustment
+## recommendations are made from the same estimate.
+class ValidationReport(object):
+    ##\param bags [ str ] : Bag names
+    def __init__(self, bags, leverage, rms_residual, studentized, turn_error, outlier):
+        self.bags = bags
+        self.leverage = leverage
+        self.rms_residual = rms_residual
+        self.studentized = studentized
+        self.turn_error = turn_error
+        self.outlier = outlier
+
+    ##\return [ str ] : Outlier bags
+    def outliers(self):
+        return [ b for b, o in zip(self.bags, self.outlier) if o ]
+
+    ##\return (float, float) : RMS leave-one-out turn error of secondary, CB bar
+    def rms_turn_error(self):
+        valid = numpy.isfinite(self.turn_error).all(axis=1)
+        if not valid.any():
+            return (float('nan'), float('nan'))
+        return tuple(numpy.sqrt((self.turn_error[valid] ** 2).mean(axis=0)).tolist())
+
+    ##\return [ dict ] : Row of each bag
+    def rows(self):
+        return [ { 'bag': b, 'leverage': float(h), 'rms_residual': float(r), 'studentized': float(t),
+                   'secondary_error': float(err[0]), 'cb_bar_error': float(err[1]), 'outlier': bool(o) }
+                 for b, h, r, t, err, o in zip(self.bags, self.leverage, self.rms_residual,
+                                               self.studentized, self.turn_error, self.outlier) ]
+
+    ##\return dict : Summary for model metadata
+    def summary(self):
+        secondary, cb_bar = self.rms_turn_error()
+        return { 'num_bags': len(self.bags),
+                 'loo_rms_secondary_error': round(secondary, 4),
+                 'loo_rms_cb_bar_error': round(cb_bar, 4),
+                 'outliers': self.outliers() }
+
+##\brief Leave-one-out validation of training bags, in closed form
+##
+## Bags are any of the training set of stats, so bags added to a model can
+## be validated without the rest of the training set.
+##\param stats TrainingStats : Statistics of the training set
+##\param bags [ str ] : Bag names
+##\param adjustments numpy.ndarray : (num_bags, 2) secondary, cb_bar turns CW
+##\param efforts numpy.ndarray : (num_bags, num_efforts) lift, then flex efforts
+##\param screw_tol, bar_tol float : Bags with leave-one-out turn errors over these are outliers
+##\param outlier_threshold float : Bags with studentized RMS residuals over this are outliers
+##\return ValidationReport
+def validate(stats, bags, adjustments, efforts, screw_tol = 2.0, bar_tol = 0.8, outlier_threshold = 2.0):
+    A = design_matrix(adjustments)
+    B = numpy.asarray(efforts, dtype=numpy.float64).reshape(len(A), stats.num_efforts)
+    n, m = B.shape
+
+    X = stats.solve()
+    G = numpy.linalg.inv(stats.AtA)
+    GA = numpy.dot(A, G)
+
+    h = (GA * A).sum(axis=1)
+    E = B - numpy.dot(A, X)
+    rms_residual = numpy.sqrt((E ** 2).mean(axis=1))
+
+    # A bag with leverage 1 alone determines the model, no leave-one-out estimate
+    valid = 1 - h > 1e-9
+    h_valid = numpy.where(valid, h, 0)
+
+    dof = stats.count - 3
+    rss = stats.BtB.sum() - (X * stats.AtB).sum()
+    if dof > 0:
+        s = numpy.sqrt(max(rss, 0) / (dof * m))
+        studentized = rms_residual / numpy.maximum(s * numpy.sqrt(1 - h_valid), 1e-12)
+    else:
+        studentized = numpy.zeros(n)
+    studentized[~valid] = numpy.nan
+
+    # Models without each bag, (n, 3, num_efforts)
+    X_loo = X[numpy.newaxis] - GA[:, :, numpy.newaxis] * (E / (1 - h_valid)[:, numpy.newaxis])[:, numpy.newaxis, :]
+
+    # Held-out model's least squares estimate of each bag's adjustments
+    M = X_loo[:, :2, :]
+    P = numpy.einsum('nkm,nlm->nkl', M, M)
+    q = numpy.einsum('nkm,nm->nk', M, B - X_loo[:, 2, :])
+
+    turn_error = numpy.empty((n, 2))
+    turn_error[:] = numpy.nan
+    if valid.any():
+        estimate = numpy.linalg.solve(P[valid], q[valid][:, :, numpy.newaxis])[:, :, 0]
+        turn_error[valid] = estimate - A[valid, :2]
+
+    with numpy.errstate(invalid = 'ignore'):
+        outlier = (studentized > outlier_threshold) | \
+            (abs(turn_error[:, 0]) > screw_tol) | (abs(turn_error[:, 1]) > bar_tol)
+
+    return ValidationReport(list(bags), h, rms_residual, studentized, turn_error, outlier)
+
+##\brief Least squares fit of the CB model
+##
+##\param adjustments numpy.ndarray : (num_bags, 2) secondary, cb_bar turns CW
+##\param efforts numpy.ndarray : (num_bags, num_efforts) lift, then flex efforts
+##\return numpy.ndarray : (3, num_efforts) model array
+def fit_model(adjustments, efforts):
+    efforts = numpy.asarray(efforts, dtype=numpy.float64)
+    stats = TrainingStats(efforts.shape[1])
+    stats.add(adjustments, efforts)
+    return stats.solve()
+
+##\brief Reads training bags in parallel
+##
+##\param pool multiprocessing.Pool : Pool to read bags in. If None, a pool is created for this call
+##\param grid : Object with lift_positions, flex_positions all bags must match, or None to match first bag
+##\return [ TrainingData ]
+def read_training_data(entries, pool = None, grid = None):
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool()
+    try:
+        training_data = pool.map(load_training_data, [ e.bag for e in entries ])
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    if grid is None and training_data:
+        grid = training_data[0]
+    for e, d in zip(entries, training_data):
+        if not _same_grid(d, grid):
+            if grid is training_data[0]:
+                raise ValueError('Bag %s has a different test grid than bag %s. All bags must use the same grid' % (
+                        e.bag, entries[0].bag))
+            raise ValueError('Bag %s has a different test grid than the model' % e.bag)
+
+    return training_data
+
+##\brief Reads training bags in parallel and fits the CB model
+##
+##\param entries [ TrainingEntry ]
+##\param pool multiprocessing.Pool : Pool to read bags in. If None, a pool is created for this call
+##\param metadata dict : Extra training information stored in the model
+##\param validate_args : Outlier tolerances passed to validate()
+##\return (CounterbalanceModel, TrainingStats, ValidationReport)
+def train_model(entries, pool = None, metadata = None, **validate_args):
+    if len(entries) < 3:
+        raise ValueError('Need at least 3 training bags, got %d' % len(entries))
+
+    training_data = read_training_data(entries, pool)
+    first = training_data[0]
+
+    adjustments = [ (e.secondary, e.cb_bar) for e in entries ]
+    bags = [ e.name for e in entries ]
+    stats = TrainingStats(len(first.efforts))
+    stats.add(adjustments, [ d.efforts for d in training_data ], bags)
+
+    report = validate(stats, bags, adjustments, [ d.efforts for d in training_data ], **validate_args)
+
+    info = { 'bags': bags,
+             'adjustments': [ list(a) for a in adjustments ],
+             'validation': report.summary() }
+    info.update(metadata or {})
+
+    model = CounterbalanceModel(stats.solve(), first.lift_positions, first.flex_positions,
+                                first.lift_joint, first.flex_joint, info)
+    return model, stats, report
+
+##\brief Adds bags to and removes bags from a trained model
+##
+## Only the added bags are read. Removed bags are subtracted with the
+## efforts stored in the training statistics, and must be in the model's
+## training set under the same name, with the same adjustments.
+##\param model CounterbalanceModel : Trained model
+##\param stats TrainingStats : Training statistics of model
+##\param add [ TrainingEntry ] : Bags to add
+##\param remove [ TrainingEntry ] : Bags to remove
+##\param metadata dict : Extra training information stored in the model
+##\param validate_args : Outlier tolerances passed to validate()
+##\return (CounterbalanceModel, TrainingStats, ValidationReport) : Updated model and
+## statistics, validation of added bags
+def update_model(model, stats, add = (), remove = (), pool = None, metadata = None, **validate_args):
+    if not model.has_grid:
+        raise ValueError('Model has no grid information, unable to update. Retrain the model')
+    if stats.num_efforts != model.num_efforts:
+        raise ValueError('Training statistics have %d efforts, model has %d' % (stats.num_efforts, model.num_efforts))
+
+    if len(stats.bags) != stats.count:
+        raise ValueError('Training statistics have %d bags, only %d named. Retrain the model' % (stats.count, len(stats.bags)))
+
+    stats = stats.copy()
+    if len(remove) > 0:
+        for e in remove:
+            if e.name not in stats.bags or \
+                    not numpy.allclose(stats.adjustments[stats.bags.index(e.name)], (e.secondary, e.cb_bar)):
+                raise ValueError('Bag %s with adjustments (%s, %s) is not in training set of model' % (
+                        e.name, e.secondary, e.cb_bar))
+        stats.remove_bags([ e.name for e in remove ])
+
+    training_data = read_training_data(add, pool, model) if len(add) > 0 else []
+
+    added = [ e.name for e in add ]
+    if len(add) > 0:
+        stats.add([ (e.secondary, e.cb_bar) for e in add ], [ d.efforts for d in training_data ], added)
+
+    report = validate(stats, added, [ (e.secondary, e.cb_bar) for e in add ],
+                      [ d.efforts for d in training_data ], **validate_args)
+
+    info = dict(model.metadata)
+    info.update(metadata or {})
+    info['bags'] = list(stats.bags)
+    info['adjustments'] = stats.adjustments.tolist()
+    if added:
+        info['validation'] = report.summary()
+    else:
+        info.pop('validation', None)
+
+    updated = CounterbalanceModel(stats.solve(), model.lift_positions, model.flex_positions,
+                                  model.lift_joint, model.flex_joint, info)
+    return updated, stats, report
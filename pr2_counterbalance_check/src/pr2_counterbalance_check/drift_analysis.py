@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Counterbalance drift of each robot, from fleet archive runs
+##
+## The recommended CB adjustment of every archived run is solved at once
+## from the memory-mapped effort tensor. A line fit over time of each
+## robot arm's adjustments gives its drift rate, and the adjustment
+## projected to the next scheduled check is compared against the
+## tolerances.
+##
+## A run that didn't pass is followed by a CB adjustment, so only runs
+## since an arm's last adjustment are fit.
+
+import numpy
+
+SECONDS_PER_DAY = 24 * 3600.0
+
+# Archived results of runs after which the CB was adjusted
+ADJUSTED_RESULTS = ( 'FAIL', 'HUMAN_REQUIRED' )
+
+##\brief Efforts in CB model order, lift efforts then flex efforts
+##
+##\param efforts numpy.ndarray : (num_runs, num_lifts, num_flexes, 2) archive efforts
+##\return numpy.ndarray : (num_runs, 2 * num_lifts * num_flexes)
+def model_efforts(efforts):
+    efforts = numpy.asarray(efforts)
+    return numpy.transpose(efforts, (0, 3, 1, 2)).reshape(len(efforts), -1)
+
+##\brief Recommended adjustments of archived runs
+##
+##\param archive FleetArchive
+##\param model CounterbalanceModel
+##\param runs numpy.ndarray : Run indices, or None for all runs
+##\return numpy.ndarray : (num_runs, 2) secondary, CB bar turns CW
+def archive_turns(archive, model, runs = None):
+    mismatch = model.grid_mismatch(archive)
+    if mismatch:
+        raise ValueError('Fleet archive does not match model grid: %s' % mismatch)
+
+    efforts = archive.efforts()
+    if runs is not None:
+        efforts = efforts[runs]
+    return model.solve_batch(model_efforts(efforts))
+
+##\brief Drift of one robot arm
+class DriftResult(object):
+    def __init__(self, robot, side, num_runs, last_time, turns, rate, projected, grid_change, flagged):
+        self.robot = robot
+        self.side = side
+        self.num_runs = num_runs       # Runs since last adjustment
+        self.last_time = last_time     # Time of last run, seconds since epoch
+        self.turns = turns             # (secondary, cb_bar) recommended at last run
+        self.rate = rate               # (secondary, cb_bar) turns per day, nan if one run
+        self.projected = projected     # (secondary, cb_bar) projected at next check
+        self.grid_change = grid_change # RMS effort change from previous run since adjustment, nan if one run
+        self.flagged = flagged         # Projected adjustment over tolerance
+
+##\brief Drift of each robot arm in fleet archive
+##
+## Runs are grouped by robot serial and side. Runs without a robot serial
+## are skipped. Each group's history is split after runs with a result in
+## ADJUSTED_RESULTS, and only runs since the last adjustment are used.
+##\param archive FleetArchive
+##\param model CounterbalanceModel
+##\param interval_days float : Time from last run to next scheduled check
+##\param screw_tol, bar_tol float : Tolerances of secondary, CB bar adjustment
+##\param robot, side str : Only this robot or side, or None for all
+##\return [ DriftResult ] : Sorted by robot, side
+def analyze_drift(archive, model, interval_days = 90.0, screw_tol = 2.0, bar_tol = 0.8,
+                  robot = None, side = None):
+    runs = archive.select(robot, side)
+    index = archive.index()
+    robots = index['robot'][runs].astype(str)
+    runs = runs[robots != '']
+    if len(runs) == 0:
+        return []
+
+    keys = numpy.array([ '%s\t%s' % (r, s) for r, s in zip(index['robot'][runs], index['side'][runs]) ])
+    group_keys, groups = numpy.unique(keys, return_inverse=True)
+
+    # Segments of each group's history, split after adjusted runs
+    order = numpy.lexsort((index['timestamp'][runs], groups))
+    adjusted = numpy.array([ r in ADJUSTED_RESULTS for r in index['result'][runs][order] ], dtype=bool)
+    starts = numpy.ones(len(order), dtype=bool)
+    starts[1:] = (groups[order][1:] != groups[order][:-1]) | adjusted[:-1]
+    segment = numpy.cumsum(starts)
+    group_last = numpy.nonzero(numpy.append(groups[order][1:] != groups[order][:-1], True))[0]
+    current = numpy.zeros(len(runs), dtype=bool)
+    current[order] = segment == segment[group_last][groups[order]]
+    runs = runs[current]
+    groups = groups[current]
+
+    turns = archive_turns(archive, model, runs)
+    efforts = model_efforts(archive.efforts()[runs])
+
+    # Days from first run, for conditioning of fit
+    t = (index['timestamp'][runs] - index['timestamp'][runs].min()) / SECONDS_PER_DAY
+
+    # Line fit of each group's adjustments over time
+    n = numpy.bincount(groups).astype(numpy.float64)
+    St = numpy.bincount(groups, t)
+    Stt = numpy.bincount(groups, t * t)
+    denom = n * Stt - St ** 2
+    valid = denom > 1e-9 * numpy.maximum(n * Stt, 1)
+
+    rate = numpy.empty((len(group_keys), 2))
+    offset = numpy.empty((len(group_keys), 2))
+    rate[:] = numpy.nan
+    for k in range(2):
+        Sx = numpy.bincount(groups, turns[:, k])
+        Stx = numpy.bincount(groups, t * turns[:, k])
+        rate[valid, k] = (n * Stx - St * Sx)[valid] / denom[valid]
+        offset[valid, k] = (Sx[valid] - rate[valid, k] * St[valid]) / n[valid]
+
+    # Last and previous run of each group
+    order = numpy.lexsort((t, groups))
+    last_pos = numpy.nonzero(numpy.append(groups[order][1:] != groups[order][:-1], True))[0]
+    last = order[last_pos]
+    has_prev = (last_pos > 0) & (n > 1)
+    prev = order[numpy.where(has_prev, last_pos - 1, last_pos)]
+
+    grid_change = numpy.sqrt(((efforts[last] - efforts[prev]) ** 2).mean(axis=1))
+    grid_change[~has_prev] = numpy.nan
+
+    t_next = t[last] + interval_days
+    projected = turns[last].copy()
+    projected[valid] = offset[valid] + rate[valid] * t_next[valid][:, numpy.newaxis]
+
+    flagged = (abs(projected[:, 0]) > screw_tol) | (abs(projected[:, 1]) > bar_tol) | \
+        (abs(turns[last, 0]) > screw_tol) | (abs(turns[last, 1]) > bar_tol)
+
+    results = []
+    for g, key in enumerate(group_keys):
+        r, s = key.split('\t')
+        results.append(DriftResult(r, s, int(n[g]), float(index['timestamp'][runs][last[g]]),
+                                   tuple(turns[last[g]]), tuple(rate[g]), tuple(projected[g]),
+                                   float(grid_change[g]), bool(flagged[g])))
+    return results
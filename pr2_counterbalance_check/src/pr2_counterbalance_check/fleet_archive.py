@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Fleet archive of analyzed counterbalance runs
+##
+## Hold efforts of every archived run are appended to one raw float64 file,
+## memory-mapped as a (num_runs, num_lifts, num_flexes, 2) tensor. The last
+## axis is lift, flex hold effort. A CSV index has one row per run, with
+## robot serial, arm side, timestamp and model version. The grid is fixed by
+## the first run, in archive.yaml.
+##
+## An index row is written after its efforts, so readers never see a
+## partly written run. Appends from several processes are serialized with
+## a lock file.
+
+import os
+import csv
+import time
+import fcntl
+
+import numpy
+
+from pr2_counterbalance_check.counterbalance_model import GRID_TOL, read_model_header, resolve_model_file
+
+ARCHIVE_FORMAT = 'pr2_counterbalance_fleet_archive'
+ARCHIVE_VERSION = 1
+
+INDEX_COLUMNS = [ 'robot', 'side', 'timestamp', 'model_version', 'result', 'source' ]
+
+EFFORT_DTYPE = numpy.dtype('<f8')
+
+##\brief Default archive directory, under ROS_HOME
+def default_archive_dir():
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return os.path.join(ros_home, 'pr2_counterbalance_check', 'fleet_archive')
+
+##\brief Arm side of CB test joint, 'right', 'left' or ''
+def arm_side(joint):
+    if joint.startswith('r_'):
+        return 'right'
+    if joint.startswith('l_'):
+        return 'left'
+    return ''
+
+##\brief Version string of a CB model file, for the archive index
+##
+##\return str : Model filename and training date, or '' if no model
+def model_version(model_file):
+    if not model_file:
+        return ''
+    model_file = resolve_model_file(model_file)
+    version = os.path.basename(model_file)
+    if model_file.endswith('.yaml'):
+        try:
+            date = (read_model_header(model_file).get('metadata') or {}).get('date')
+        except (IOError, ValueError):
+            date = None
+        if date:
+            version = '%s@%s' % (version, date)
+    return version
+
+##\brief Mean sq., average abs. effort of each archived run
+##
+##\param efforts numpy.ndarray : (num_runs, num_lifts, num_flexes, 2) efforts
+##\return dict : lift_mse, lift_avg_abs, flex_mse, flex_avg_abs arrays, (num_runs,)
+def effort_stats(efforts):
+    efforts = numpy.asarray(efforts)
+    stats = {}
+    for i, name in enumerate([ 'lift', 'flex' ]):
+        e = efforts[..., i].reshape(len(efforts), -1)
+        stats[name + '_mse'] = (e ** 2).mean(axis=1)
+        stats[name + '_avg_abs'] = abs(e).mean(axis=1)
+    return stats
+
+class FleetArchive(object):
+    ##\param archive_dir str : Archive directory, created if needed. None for default_archive_dir()
+    def __init__(self, archive_dir = None):
+        self.archive_dir = archive_dir or default_archive_dir()
+
+        if not os.path.isdir(self.archive_dir):
+            try:
+                os.makedirs(self.archive_dir)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.archive_dir):
+                    raise
+
+        self._header_file = os.path.join(self.archive_dir, 'archive.yaml')
+        self._efforts_file = os.path.join(self.archive_dir, 'efforts.dat')
+        self._index_file = os.path.join(self.archive_dir, 'index.csv')
+        self._lock_file = os.path.join(self.archive_dir, '.lock')
+
+    ##\return dict : Archive header, or None if no run archived
+    def header(self):
+        import yaml
+        if not os.path.exists(self._header_file):
+            return None
+        with open(self._header_file) as f:
+            header = yaml.safe_load(f)
+        if not isinstance(header, dict) or header.get('format') != ARCHIVE_FORMAT:
+            raise ValueError('%s is not a fleet archive header' % self._header_file)
+        if header.get('version', 0) > ARCHIVE_VERSION:
+            raise ValueError('Fleet archive %s has version %s, only versions up to %d are supported' % (
+                    self.archive_dir, header.get('version'), ARCHIVE_VERSION))
+        return header
+
+    def _write_header(self, lift_positions, flex_positions):
+        import yaml
+        header = { 'format': ARCHIVE_FORMAT,
+                   'version': ARCHIVE_VERSION,
+                   'dtype': EFFORT_DTYPE.str,
+                   'lift_positions': [ round(float(v), 6) for v in lift_positions ],
+                   'flex_positions': [ round(float(v), 6) for v in flex_positions ] }
+        with open(self._header_file, 'w') as f:
+            yaml.safe_dump(header, f, default_flow_style = False)
+        return header
+
+    ##\return (num_lifts, num_flexes) : Grid shape, or None if no run archived
+    def grid_shape(self):
+        header = self.header()
+        if header is None:
+            return None
+        return (len(header['lift_positions']), len(header['flex_positions']))
+
+    ##\brief Lift positions of archive grid, or None if no run archived
+    @property
+    def lift_positions(self):
+        header = self.header()
+        return None if header is None else numpy.array(header['lift_positions'])
+
+    ##\brief Flex positions of archive grid, or None if no run archived
+    @property
+    def flex_positions(self):
+        header = self.header()
+        return None if header is None else numpy.array(header['flex_positions'])
+
+    def _read_index(self):
+        if not os.path.exists(self._index_file):
+            return []
+        with open(self._index_file) as f:
+            return [ r for r in csv.DictReader(f) ]
+
+    def __len__(self):
+        return len(self._read_index())
+
+    ##\brief Appends analyzed run to archive
+    ##
+    ##\param data CounterbalanceAnalysisData : Analyzed run, or any object with its
+    ## lift_positions, flex_positions, lift_effort_avg and flex_effort_avg
+    ##\param robot str : Robot serial
+    ##\param side str : Arm side, 'right' or 'left'
+    ##\param timestamp float : Time of run, seconds since epoch. None for now
+    ##\param model_version str : Model used to analyze run, see model_version()
+    ##\param result str : Test result
+    ##\param source str : Bag file, or node that analyzed run
+    ##\return int : Index of run in archive
+    def append(self, data, robot = '', side = '', timestamp = None, model_version = '', result = '', source = ''):
+        efforts = numpy.dstack((data.lift_effort_avg, data.flex_effort_avg)).astype(EFFORT_DTYPE)
+        if timestamp is None:
+            timestamp = time.time()
+
+        with open(self._lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                header = self.header()
+                if header is None:
+                    header = self._write_header(data.lift_positions, data.flex_positions)
+                elif not self._same_grid(header, data):
+                    raise ValueError('Run has %dx%d grid, does not match grid of fleet archive %s' % (
+                            len(data.lift_positions), len(data.flex_positions), self.archive_dir))
+
+                # Efforts past the last indexed run are from an interrupted append
+                num_runs = len(self._read_index())
+                with open(self._efforts_file, 'ab') as f:
+                    f.truncate(num_runs * efforts.nbytes)
+                    f.write(efforts.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                new_index = not os.path.exists(self._index_file)
+                with open(self._index_file, 'a') as f:
+                    writer = csv.DictWriter(f, INDEX_COLUMNS)
+                    if new_index:
+                        writer.writeheader()
+                    writer.writerow({ 'robot': robot, 'side': side, 'timestamp': '%.3f' % timestamp,
+                                      'model_version': model_version, 'result': result, 'source': source })
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return num_runs
+
+    @staticmethod
+    def _same_grid(header, data):
+        for archived, positions in ((header['lift_positions'], data.lift_positions),
+                                    (header['flex_positions'], data.flex_positions)):
+            if len(archived) != len(positions) or \
+                    not numpy.allclose(archived, positions, rtol = 0, atol = GRID_TOL):
+                return False
+        return True
+
+    ##\brief Index of archived runs, as column arrays
+    ##
+    ##\return dict : Column name to (num_runs,) array. Timestamps are float, others str
+    def index(self):
+        rows = self._read_index()
+        index = {}
+        for c in INDEX_COLUMNS:
+            index[c] = numpy.array([ r[c] for r in rows ], dtype=object)
+        index['timestamp'] = numpy.array([ float(r['timestamp']) for r in rows ], dtype=numpy.float64)
+        return index
+
+    ##\brief Memory-mapped efforts of all runs, read only
+    ##
+    ##\return numpy.ndarray : (num_runs, num_lifts, num_flexes, 2) efforts
+    def efforts(self):
+        shape = self.grid_shape()
+        num_runs = len(self)
+        if shape is None or num_runs == 0:
+            return numpy.zeros((0,) + (shape or (0, 0)) + (2,), dtype=EFFORT_DTYPE)
+        return numpy.memmap(self._efforts_file, dtype=EFFORT_DTYPE, mode='r',
+                            shape=(num_runs,) + shape + (2,))
+
+    ##\brief Indices of runs matching all given filters
+    ##
+    ##\param since, until float : Time range, seconds since epoch
+    ##\return numpy.ndarray : Run indices
+    def select(self, robot = None, side = None, since = None, until = None, model_version = None):
+        index = self.index()
+        mask = numpy.ones(len(index['timestamp']), dtype=bool)
+        if robot is not None:
+            mask &= index['robot'] == robot
+        if side is not None:
+            mask &= index['side'] == side
+        if model_version is not None:
+            mask &= index['model_version'] == model_version
+        if since is not None:
+            mask &= index['timestamp'] >= since
+        if until is not None:
+            mask &= index['timestamp'] < until
+        return numpy.nonzero(mask)[0]
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Measures settling and effort convergence of CB holds, recommends hold timing
+##
+## The controller holds each position for settle_time, then records
+## dither_points samples. The traces of all holds of all runs are stacked
+## into one (num_holds, 2, num_samples) tensor, lift and flex joint on the
+## middle axis. Dropping the first samples of a trace is equivalent to a
+## longer settle_time, and keeping fewer samples to fewer dither_points, so
+## every (start, length) window of the traces is scored at once from
+## cumulative sums against the full-trace hold means the analysis uses.
+##
+## Traces don't cover the settle_time itself, so recommended settle times
+## are never below the recorded one. Record runs with a short settle_time
+## and long dither to measure the whole tradeoff.
+
+import numpy
+
+##\brief Hold traces of CB runs, stacked for vectorized timing analysis
+class HoldTraces(object):
+    ##\param msgs [ CounterbalanceTestData ] : Runs, all on the same grid
+    def __init__(self, msgs):
+        if not msgs:
+            raise ValueError('No runs given')
+
+        self.lift_positions = numpy.array([ ld.lift_position for ld in msgs[0].lift_data ])
+        self.flex_positions = numpy.array([ fd.flex_position for fd in msgs[0].lift_data[0].flex_data ])
+        shape = (len(self.lift_positions), len(self.flex_positions))
+
+        holds = []
+        for msg in msgs:
+            run = [ (fd.lift_hold, fd.flex_hold) for ld in msg.lift_data for fd in ld.flex_data ]
+            if len(msg.lift_data) != shape[0] or len(run) != shape[0] * shape[1]:
+                raise ValueError('Runs have different grids, unable to stack hold traces')
+            holds.extend(run)
+
+        # Holds of all runs are truncated to the shortest one
+        num_samples = min([ len(h.effort) for pair in holds for h in pair ])
+        if num_samples < 2:
+            raise ValueError('Hold traces have %d samples, need at least 2' % num_samples)
+
+        for name in ('time', 'position', 'effort'):
+            values = numpy.array([ [ getattr(h, name)[:num_samples] for h in pair ] for pair in holds ],
+                                 dtype=numpy.float64)
+            setattr(self, name, values)
+
+        self.grid_shape = shape
+        self.num_runs = len(msgs)
+        self.dt = float(numpy.median(numpy.diff(self.time, axis=-1)))
+
+    @property
+    def num_samples(self):
+        return self.effort.shape[-1]
+
+##\brief Mean of x[..., start:start + length] for all starts and lengths, from cumulative sums
+##
+##\return numpy.ndarray : (len(starts), len(lengths)) + x.shape[:-1] means
+def window_means(x, starts, lengths):
+    csum = numpy.concatenate((numpy.zeros(x.shape[:-1] + (1,)), numpy.cumsum(x, axis=-1)), axis=-1)
+    starts = numpy.asarray(starts)
+    ends = numpy.minimum(starts[:, numpy.newaxis] + numpy.asarray(lengths)[numpy.newaxis, :], x.shape[-1])
+
+    sums = numpy.take(csum, ends, axis=-1) - numpy.take(csum, starts, axis=-1)[..., numpy.newaxis]
+    means = sums / (ends - starts[:, numpy.newaxis])
+
+    nd = means.ndim
+    return means.transpose((nd - 2, nd - 1) + tuple(range(nd - 2)))
+
+##\brief Samples from start of each trace until it stays within band
+##
+##\param x numpy.ndarray : (..., num_samples) traces
+##\param band numpy.ndarray : Allowed deviation from final value, broadcast to x.shape[:-1]
+##\param window int : Traces are smoothed by moving average of this many samples
+##\return numpy.ndarray : x.shape[:-1] settle samples
+def settle_samples(x, band, window = 1):
+    window = max(1, min(window, x.shape[-1]))
+    csum = numpy.concatenate((numpy.zeros(x.shape[:-1] + (1,)), numpy.cumsum(x, axis=-1)), axis=-1)
+    smooth = (csum[..., window:] - csum[..., :-window]) / window
+
+    final = smooth[..., -1:]
+    outside = abs(smooth - final) > numpy.asarray(band)[..., numpy.newaxis]
+    # Index after last sample outside band, 0 if always inside
+    last = outside.shape[-1] - numpy.argmax(outside[..., ::-1], axis=-1)
+    return numpy.where(outside.any(axis=-1), last, 0)
+
+##\brief Recommended hold timing, with settling measurements
+class HoldTiming(object):
+    def __init__(self, settle_time, dither_points, effort_error, turns_error,
+                 position_settle, effort_settle, hold_time, recorded_hold_time):
+        self.settle_time = settle_time                # Recommended settle time, s
+        self.dither_points = dither_points            # Recommended dither points
+        self.effort_error = effort_error              # Max abs. error of hold effort means
+        self.turns_error = turns_error                # Max abs. error (secondary, cb_bar), or None without model
+        self.position_settle = position_settle        # (num_holds, 2) s into trace until position settles
+        self.effort_settle = effort_settle            # (num_holds, 2) s into trace until effort settles
+        self.hold_time = hold_time                    # Recommended time per hold, s
+        self.recorded_hold_time = recorded_hold_time  # Time per hold of recorded runs, s
+
+##\brief Shortest hold timing that keeps hold effort means, and adjustment, within tolerance
+##
+##\param traces HoldTraces
+##\param settle_time float : Settle time of recorded runs, s
+##\param effort_tol float : Allowed error of hold effort means
+##\param model CounterbalanceModel : Checks adjustment error if given. None to skip
+##\param screw_error, bar_error float : Allowed error of secondary, CB bar adjustment, turns
+##\param position_tol float : Position settle band, added to 2 std. dev. of settled position
+##\param smooth_samples int : Moving average of effort for effort settle time
+##\param num_steps int : Candidate starts and lengths are multiples of num_samples / num_steps
+##\return HoldTiming
+def optimize_hold_timing(traces, settle_time, effort_tol = 0.1, model = None,
+                         screw_error = 0.2, bar_error = 0.08,
+                         position_tol = 0.005, smooth_samples = 100, num_steps = 40):
+    n = traces.num_samples
+    step = max(1, n // num_steps)
+
+    # Settling within recorded traces
+    settled_sd = traces.position[..., n // 2:].std(axis=-1)
+    position_settle = settle_samples(traces.position, position_tol + 2 * settled_sd) * traces.dt
+    effort_settle = settle_samples(traces.effort, effort_tol, smooth_samples) * traces.dt
+
+    reference = traces.effort.mean(axis=-1)
+
+    starts = numpy.arange(0, n // 2 + 1, step)
+    # Full traces are always a candidate, so a timing is always found
+    lengths = numpy.unique(numpy.append(numpy.arange(step, n, step), n))
+    means = window_means(traces.effort, starts, lengths)
+    effort_error = abs(means - reference).reshape(len(starts), len(lengths), -1).max(axis=-1)
+
+    valid = (starts[:, numpy.newaxis] + lengths[numpy.newaxis, :] <= n) & (effort_error <= effort_tol)
+
+    turns_error = None
+    if model is not None:
+        mismatch = model.grid_mismatch(traces)
+        if mismatch:
+            raise ValueError('Runs do not match model grid: %s' % mismatch)
+
+        from pr2_counterbalance_check.drift_analysis import model_efforts
+        L, F = traces.grid_shape
+        grid = means.reshape((-1, traces.num_runs, L, F, 2))
+        turns = model.solve_batch(model_efforts(grid.reshape((-1, L, F, 2))))
+        ref_turns = model.solve_batch(model_efforts(reference.reshape((traces.num_runs, L, F, 2))))
+        diff = abs(turns.reshape((len(starts), len(lengths), traces.num_runs, 2)) - ref_turns)
+        turns_error = diff.max(axis=2)
+        valid &= (turns_error[..., 0] <= screw_error) & (turns_error[..., 1] <= bar_error)
+
+    # Shortest time per hold, least effort error among equals
+    samples = starts[:, numpy.newaxis] + lengths[numpy.newaxis, :]
+    candidates = numpy.nonzero(valid)
+    best = numpy.lexsort((effort_error[candidates], samples[candidates]))[0]
+    i, j = candidates[0][best], candidates[1][best]
+
+    rec_settle = settle_time + starts[i] * traces.dt
+    return HoldTiming(rec_settle, int(lengths[j]), float(effort_error[i, j]),
+                      None if turns_error is None else tuple(turns_error[i, j]),
+                      position_settle, effort_settle,
+                      rec_settle + lengths[j] * traces.dt, settle_time + n * traces.dt)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief On-disk, content-addressed cache of rendered plot images
+##
+## Images are stored under the hash of the plotted data, plot type and
+## rendering parameters. The least recently used images are removed when
+## the cache grows over its size limit.
+
+import os, sys
+import hashlib
+import tempfile
+
+import numpy
+
+# Change to invalidate all cached plots, ex: when plots are drawn differently
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+##\brief Default cache directory, under ROS_HOME
+def default_cache_dir():
+    ros_home = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+    return os.path.join(ros_home, 'pr2_counterbalance_check', 'plot_cache')
+
+_matplotlib_version = None
+
+##\brief Installed matplotlib version, read without importing matplotlib
+def matplotlib_version():
+    global _matplotlib_version
+    if _matplotlib_version is None:
+        if 'matplotlib' in sys.modules:
+            _matplotlib_version = sys.modules['matplotlib'].__version__
+        else:
+            try:
+                from importlib.metadata import version
+            except ImportError:
+                # Python before 3.8
+                from pkg_resources import get_distribution
+                version = lambda name: get_distribution(name).version
+            try:
+                _matplotlib_version = version('matplotlib')
+            except Exception:
+                _matplotlib_version = ''
+    return _matplotlib_version
+
+def _update_hash(h, obj):
+    if isinstance(obj, numpy.ndarray):
+        h.update(('ndarray %s %s:' % (obj.dtype.str, obj.shape)).encode('utf-8'))
+        h.update(numpy.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (tuple, list)):
+        h.update(('seq %d:' % len(obj)).encode('utf-8'))
+        for o in obj:
+            _update_hash(h, o)
+    else:
+        h.update(('%s %r;' % (type(obj).__name__, obj)).encode('utf-8'))
+
+class PlotCache(object):
+    ##\param cache_dir str : Directory of cached images, created if needed. None for default_cache_dir()
+    ##\param max_bytes int : Least recently used images are removed above this total size
+    def __init__(self, cache_dir = None, max_bytes = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        # Cache size as of the last listing plus images put since, None until first put
+        self._total_bytes = None
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    ##\brief Cache key of a render task, (renderer name, args, image format, dpi)
+    ##
+    ## Doesn't import matplotlib, so cached plots are found without loading it
+    def key(self, task):
+        h = hashlib.sha1()
+        _update_hash(h, (CACHE_VERSION, matplotlib_version(), task))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    ##\brief Cached image data for key, or None
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                image = f.read()
+            # Mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        return image
+
+    ##\brief Store image data for key, evicting old images if this puts the cache over its size limit
+    ##
+    ## The cache is listed on the first put only, later puts add their size
+    ## to that total.
+    def put(self, key, image):
+        fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, prefix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self._total_bytes is None:
+            self._total_bytes = self._entries()[1]
+        else:
+            self._total_bytes += len(image)
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    ##\return ([ (mtime, size, name) ], int) : Cached images and their total size
+    def _entries(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        return entries, total
+
+    ##\brief Removes least recently used images until cache is under size limit
+    def evict(self):
+        entries, total = self._entries()
+        self._total_bytes = total
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                # Removed by another process
+                pass
+            total -= size
+        self._total_bytes = total
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Finds the smallest test grid that still predicts the CB adjustment
+##
+## CounterbalanceTestController steps each joint from min to max by delta,
+## so a reduced grid is an evenly spaced subset of the lift positions
+## times an evenly spaced subset of the flex positions. Each candidate is
+## scored on archived runs: the adjustment solved from only the reduced
+## grid's efforts, with the model's columns of those efforts, against the
+## adjustment solved from the full grid.
+##
+## The effort limits of the CB test are mean square and mean absolute
+## efforts over the grid, so they are rescaled for the reduced grid from
+## the same runs.
+
+import numpy
+
+from pr2_counterbalance_check.counterbalance_model import CounterbalanceModel, effort_columns
+
+##\brief Evenly spaced index subsets of n positions
+##
+##\return [ [ int ] ] : Index lists, by increasing length
+def progressions(n):
+    subsets = [ [ i ] for i in range(n) ]
+    for count in range(2, n + 1):
+        for stride in range(1, (n - 1) // (count - 1) + 1):
+            for start in range(n - stride * (count - 1)):
+                subsets.append(list(range(start, start + stride * count, stride)))
+    return subsets
+
+##\brief Model for the reduced grid, the full model's columns at its positions
+##
+##\param model CounterbalanceModel : Full grid model
+##\return CounterbalanceModel
+def reduce_model(model, lift_indices, flex_indices):
+    columns = effort_columns(len(model.lift_positions), len(model.flex_positions), lift_indices, flex_indices)
+    metadata = dict(model.metadata)
+    metadata['reduced_from'] = { 'lift_indices': [ int(i) for i in lift_indices ],
+                                 'flex_indices': [ int(i) for i in flex_indices ] }
+    return CounterbalanceModel(numpy.array(model.model[:, columns]),
+                               model.lift_positions[lift_indices], model.flex_positions[flex_indices],
+                               model.lift_joint, model.flex_joint, metadata)
+
+##\brief Reduced grid, with its prediction error on archived runs
+class ReducedGrid(object):
+    def __init__(self, lift_indices, flex_indices, lift_positions, flex_positions, error):
+        self.lift_indices = lift_indices
+        self.flex_indices = flex_indices
+        self.lift_positions = lift_positions
+        self.flex_positions = flex_positions
+        self.error = error # (num_runs, 2) abs. error of secondary, CB bar turns
+
+    @property
+    def num_holds(self):
+        return len(self.lift_indices) * len(self.flex_indices)
+
+##\brief Smallest evenly spaced grid predicting the adjustment within tolerance
+##
+## Among grids with the fewest holds, the one with lowest worst-case error,
+## relative to the tolerances, is returned.
+##\param model CounterbalanceModel : Full grid model
+##\param efforts numpy.ndarray : (num_runs, num_efforts) full grid efforts of archived runs
+##\param screw_error, bar_error float : Allowed error of secondary, CB bar adjustment, turns
+##\param coverage float : Percent of runs that must be within allowed error
+##\param min_lifts, min_flexes int : Minimum positions of each joint
+##\return ReducedGrid, or None if no grid smaller than the full grid is within tolerance
+def find_reduced_grid(model, efforts, screw_error, bar_error, coverage = 100.0,
+                      min_lifts = 2, min_flexes = 2):
+    if not model.has_grid:
+        raise ValueError('Model has no grid positions, unable to reduce grid')
+
+    efforts = numpy.atleast_2d(efforts)
+    if efforts.shape[1] != model.num_efforts:
+        raise ValueError('Runs have %d efforts, model has %d' % (efforts.shape[1], model.num_efforts))
+    if len(efforts) == 0:
+        raise ValueError('No runs to score reduced grids')
+
+    num_lifts = len(model.lift_positions)
+    num_flexes = len(model.flex_positions)
+    full_turns = model.solve_batch(efforts)
+    scale = numpy.array([ 1.0 / screw_error, 1.0 / bar_error ])
+
+    lift_subsets = [ s for s in progressions(num_lifts) if len(s) >= min_lifts ]
+    flex_subsets = [ s for s in progressions(num_flexes) if len(s) >= min_flexes ]
+    candidates = [ (len(l) * len(f), l, f) for l in lift_subsets for f in flex_subsets ]
+    candidates.sort(key = lambda c: c[0])
+
+    best = None
+    best_score = None
+    for holds, lifts, flexes in candidates:
+        if holds >= num_lifts * num_flexes:
+            break
+        if best is not None and holds > best.num_holds:
+            break
+
+        columns = effort_columns(num_lifts, num_flexes, lifts, flexes)
+        A = model.model[:2, columns].transpose()
+        if numpy.linalg.matrix_rank(A) < 2:
+            continue
+
+        turns = numpy.dot(efforts[:, columns], numpy.linalg.pinv(A).transpose())
+        turns[:, 0] *= -1
+        error = abs(turns - full_turns)
+
+        # Worst relative error over the covered fraction of runs
+        score = numpy.percentile((error * scale).max(axis=1), coverage)
+        if score > 1.0:
+            continue
+        if best is None or score < best_score:
+            best = ReducedGrid(lifts, flexes, model.lift_positions[lifts], model.flex_positions[flexes], error)
+            best_score = score
+
+    return best
+
+# Effort limits of controller config graded over the grid
+EFFORT_LIMITS = ( 'mse', 'avg_abs' )
+
+def _effort_stats(efforts):
+    return { 'mse': (efforts ** 2).mean(axis=(1, 2)), 'avg_abs': abs(efforts).mean(axis=(1, 2)) }
+
+##\brief Effort limits of reduced grid, scaled from full grid limits on archived runs
+##
+## Each limit is scaled by the median ratio of the reduced grid's statistic
+## to the full grid's, over the runs. Agreement is the fraction of runs
+## where the reduced grid's statistic is within its limit exactly when the
+## full grid's is.
+##\param efforts numpy.ndarray : (num_runs, num_lifts, num_flexes, 2) full grid archive efforts
+##\param reduced ReducedGrid
+##\param limits dict : { 'lift': { 'mse': float, 'avg_abs': float }, 'flex': { ... } } full grid limits
+##\return (dict, dict) : Reduced grid limits and agreement, keyed as limits
+def reduced_limits(efforts, reduced, limits):
+    efforts = numpy.asarray(efforts, dtype=numpy.float64)
+    ix = numpy.ix_(range(len(efforts)), reduced.lift_indices, reduced.flex_indices)
+    scaled = {}
+    agreement = {}
+    for k, joint in enumerate(('lift', 'flex')):
+        full = _effort_stats(efforts[..., k])
+        small = _effort_stats(efforts[..., k][ix])
+        scaled[joint] = {}
+        agreement[joint] = {}
+        for name in EFFORT_LIMITS:
+            if name not in limits.get(joint, {}):
+                continue
+            ok = full[name] > 0
+            ratio = numpy.median(small[name][ok] / full[name][ok]) if ok.any() else 1.0
+            limit = float(limits[joint][name]) * ratio
+            scaled[joint][name] = round(float(limit), 4)
+            agreement[joint][name] = float(((small[name] < limit) == (full[name] < limits[joint][name])).mean())
+    return scaled, agreement
+
+##\brief Controller min, max, delta params stepping through the given positions
+##
+##\param positions [ float ] : Evenly spaced positions
+##\param full_delta float : Delta of full grid, used if only one position
+##\return (min, max, delta)
+def joint_limits(positions, full_delta):
+    delta = full_delta if len(positions) < 2 else positions[1] - positions[0]
+    # Controller steps int((max - min) / delta + 1) positions, so pad max
+    pad = 0.05 * delta if len(positions) > 1 else 0.0
+    return (round(float(positions[0]), 6), round(float(positions[-1] + pad), 6), round(float(delta), 6))
+
+##\brief Controller config for reduced grid
+##
+## Every controller in the config with lift and flex limits gets the
+## reduced grid. Anchors and merge keys of the original are expanded, so
+## entries that were only anchors of controllers are dropped.
+##\param config dict : Loaded counterbalance_controller.yaml
+##\param reduced ReducedGrid
+##\param lift_delta, flex_delta float : Deltas of full grid
+##\param effort_limits dict : Reduced grid effort limits from reduced_limits(), or None to keep limits
+##\return dict : Config of reduced test
+def reduced_config(config, reduced, lift_delta, flex_delta, effort_limits = None):
+    import copy
+    limits = { 'lift': joint_limits(reduced.lift_positions, lift_delta),
+               'flex': joint_limits(reduced.flex_positions, flex_delta) }
+
+    controllers = {}
+    for name, params in config.items():
+        if not isinstance(params, dict) or \
+                not all([ isinstance(params.get(joint), dict) and 'delta' in params[joint] for joint in limits ]):
+            continue
+        params = copy.deepcopy(params)
+        for joint in ('lift', 'flex'):
+            params[joint]['min'], params[joint]['max'], params[joint]['delta'] = limits[joint]
+            params[joint].update((effort_limits or {}).get(joint, {}))
+        controllers[name] = params
+    return controllers
+
+##\brief Effort limits of first controller with lift and flex limits in config
+##
+##\return dict : { 'lift': { 'mse': float, 'avg_abs': float }, 'flex': { ... } }
+def config_limits(config):
+    for params in config.values():
+        if isinstance(params, dict) and all([ isinstance(params.get(j), dict) for j in ('lift', 'flex') ]):
+            return dict((j, dict((n, params[j][n]) for n in EFFORT_LIMITS if n in params[j]))
+                        for j in ('lift', 'flex'))
+    return { 'lift': {}, 'flex': {} }
@@ -39,10 +39,23 @@ from __future__ import division
 PKG = 'pr2_counterbalance_check'
 import roslib
 
+from pr2_counterbalance_check.bag_reader import indexed_topics, read_cb_msg, read_cb_msgs
 from pr2_counterbalance_check.counterbalance_analysis import *
+from pr2_counterbalance_check.counterbalance_analysis import _get_const_flex_effort, _get_const_lift_effort
+from pr2_counterbalance_check.counterbalance_model import grid_positions, load_legacy_model, read_model_header, save_model
+from pr2_counterbalance_check.counterbalance_training import TrainingEntry, TrainingStats, fit_model, read_manifest, update_model, validate
+from pr2_counterbalance_check.drift_analysis import analyze_drift
+from pr2_counterbalance_check.fleet_archive import FleetArchive, effort_stats
+from pr2_counterbalance_check.hold_timing import HoldTraces, optimize_hold_timing, window_means
+from pr2_counterbalance_check.reduced_grid import config_limits, find_reduced_grid, progressions, reduce_model, reduced_config, reduced_limits
+from pr2_counterbalance_check.plot_cache import PlotCache
 
 import copy
+import math
+import numpy
 import os, sys
+import shutil, tempfile
+import subprocess
 import rostest, unittest
 
 # Dummy classes to store data
@@ -51,9 +64,11 @@ class DummyCBAnalysisData(object): pass
 class DummyCBRunAnalysisData(object): pass
 class DummyCBPositionAnalysisData(object): pass
 class DummyJointPositionAnalysisData(object): pass
+class DummyMsg(object): pass
 
+# Spaced as the controller steps them, on the grid of the CB model
 def get_position(minv, maxv, num_pts, i):
-    return minv + (maxv - minv) * i / num_pts
+    return minv + (maxv - minv) * i / max(num_pts - 1, 1)
 
 def generate_data(params):
     data = DummyCBAnalysisData()
@@ -83,8 +98,40 @@ def generate_data(params):
 
         data.lift_data.append(lift_data)
 
+    shape = (params.num_lifts, params.num_flexes)
+    data.lift_positions = numpy.array([ld.lift_position for ld in data.lift_data])
+    data.flex_positions = numpy.array([fd.flex_position for fd in data.lift_data[0].flex_data])
+    for hold in ('lift', 'flex'):
+        for stat in ('effort_avg', 'effort_sd', 'position_avg', 'position_sd'):
+            grid = numpy.array([[getattr(getattr(fd, hold + '_hold'), stat) for fd in ld.flex_data]
+                                for ld in data.lift_data]).reshape(shape)
+            setattr(data, '%s_%s' % (hold, stat), grid)
+
     return data
 
+##\brief Generates CounterbalanceTestData-shaped message with dither_points samples per hold
+def generate_msg(params, dither_points = 10):
+    msg = DummyMsg()
+    msg.lift_data = []
+    for i in range(params.num_lifts):
+        ld = DummyMsg()
+        ld.lift_position = get_position(params.min_lift, params.max_lift, params.num_lifts, i)
+        ld.flex_data = []
+        for j in range(params.num_flexes):
+            fd = DummyMsg()
+            fd.flex_position = get_position(params.min_flex, params.max_flex, params.num_flexes, j)
+            for hold_name, position in (('lift_hold', ld.lift_position), ('flex_hold', fd.flex_position)):
+                hold = DummyMsg()
+                hold.time     = [ 0.001 * k for k in range(dither_points) ]
+                hold.position = [ position + 0.01 * (k % 2) for k in range(dither_points) ]
+                hold.velocity = [ 0.0 ] * dither_points
+                hold.effort   = [ i + j / 10.0 + 0.5 * (k % 2) for k in range(dither_points) ]
+                setattr(fd, hold_name, hold)
+            ld.flex_data.append(fd)
+        msg.lift_data.append(ld)
+
+    return msg
+
 class TestCounterbalanceAnalysis(unittest.TestCase):
     def setUp(self):
         # Set up parameters
@@ -117,9 +164,57 @@ class TestCounterbalanceAnalysis(unittest.TestCase):
         self.data = generate_data(self.params)
 
         # Model file for analyzing data
-        self.model_file = os.path.join(roslib.packages.get_pkg_dir(PKG), 'cb_data/counterbalance_model.dat')
+        self.model_file = os.path.join(roslib.packages.get_pkg_dir(PKG), 'cb_data/counterbalance_model.yaml')
             
 
+    def test_effort_grid(self):
+        data = CounterbalanceAnalysisData(generate_msg(self.params))
+
+        shape = (self.params.num_lifts, self.params.num_flexes)
+        self.assertEqual(data.lift_effort_avg.shape, shape)
+        self.assertEqual(data.flex_position_sd.shape, shape)
+        self.assertEqual(len(data.lift_positions), self.params.num_lifts)
+        self.assertEqual(len(data.flex_positions), self.params.num_flexes)
+
+        for i, ld in enumerate(data.lift_data):
+            self.assertAlmostEqual(data.lift_positions[i], ld.lift_position)
+            for j, fd in enumerate(ld.flex_data):
+                self.assertAlmostEqual(data.lift_effort_avg[i, j], fd.lift_hold.effort_avg)
+                self.assertAlmostEqual(data.flex_effort_sd[i, j], fd.flex_hold.effort_sd)
+                self.assertAlmostEqual(data.flex_position_avg[i, j], fd.flex_hold.position_avg)
+
+        efforts = get_efforts(data, True)
+        self.assertEqual(len(efforts), self.params.num_lifts * self.params.num_flexes)
+        self.assertAlmostEqual(efforts[self.params.num_flexes + 2], data.lift_data[1].flex_data[2].lift_hold.effort_avg)
+
+        lifts, lift_efforts = _get_const_flex_effort(data, 3, False)
+        self.assertAlmostEqual(lifts[2], data.lift_data[2].lift_position)
+        self.assertAlmostEqual(lift_efforts[2], data.lift_data[2].flex_data[3].flex_hold.effort_avg)
+
+        flexes, flex_efforts = _get_const_lift_effort(data, 4, True)
+        self.assertAlmostEqual(flexes[5], data.lift_data[0].flex_data[5].flex_position)
+        self.assertAlmostEqual(flex_efforts[5], data.lift_data[4].flex_data[5].lift_hold.effort_avg)
+
+    def test_summary_hold_data(self):
+        msg = generate_msg(self.params, 50)
+        hold_msg = msg.lift_data[2].flex_data[3].flex_hold
+
+        hold = JointPositionAnalysisData(hold_msg)
+        self.assert_(hold.effort is None and hold.time is None, "Summary hold data kept raw arrays")
+        self.assertAlmostEqual(hold.effort_avg, numpy.average(hold_msg.effort))
+        self.assertAlmostEqual(hold.effort_sd, numpy.std(hold_msg.effort))
+        self.assertAlmostEqual(hold.position_avg, numpy.average(hold_msg.position))
+        self.assertAlmostEqual(hold.position_sd, numpy.std(hold_msg.position))
+        self.assertRaises(AttributeError, setattr, hold, 'extra', 0)
+
+        raw_hold = JointPositionAnalysisData(hold_msg, keep_raw = True)
+        self.assertEqual(len(raw_hold.effort), 50)
+        self.assertEqual(len(raw_hold.time), 50)
+        self.assertAlmostEqual(raw_hold.effort_avg, hold.effort_avg)
+
+        data = CounterbalanceAnalysisData(msg, keep_raw = True)
+        self.assertEqual(len(data.lift_data[0].flex_data[0].lift_hold.velocity), 50)
+
     def test_lift_effort(self):
         result = analyze_lift_efforts(self.params, self.data)
         self.assert_(result.result, "Lift effort result wasn't OK. %s\n%s" % (result.summary, result.html))
@@ -131,6 +226,60 @@ class TestCounterbalanceAnalysis(unittest.TestCase):
 
     
     
+    def test_incremental(self):
+        msg = generate_msg(self.params)
+        data = CounterbalanceAnalysisData(msg)
+
+        # Bounds are the final values once all lift positions are in
+        analysis = IncrementalCounterbalanceAnalysis.from_params(self.params)
+        for ld in msg.lift_data:
+            analysis.add_run(ld)
+            analysis.add_run(ld) # Repeats are ignored
+        self.assert_(analysis.done)
+
+        lift_mse, lift_avg_abs, avg_eff = get_effort_stats(data, True)
+        flex_mse, flex_avg_abs, avg_eff = get_effort_stats(data, False)
+        for bound, value in zip(analysis.bounds(), (lift_mse, lift_avg_abs, flex_mse, flex_avg_abs)):
+            self.assertAlmostEqual(bound, value)
+
+        ok = analyze_lift_efforts(self.params, data).result and analyze_flex_efforts(self.params, data).result
+        self.assertEqual(analysis.failed, not ok)
+
+        # Efforts grow with lift position, so test fails before last lift position
+        analysis = IncrementalCounterbalanceAnalysis.from_params(self.params)
+        runs = [ i + 1 for i, ld in enumerate(msg.lift_data) if analysis.add_run(ld) ]
+        self.assertEqual(runs[0], 3)
+        self.assert_(not analysis.result().result, "Failed incremental analysis passed")
+
+        # Completed lift positions give CB adjustment, as full test would
+        analysis = IncrementalCounterbalanceAnalysis(self.params.num_lifts, self.params.num_flexes,
+                                                     100.0, 100.0, True, 100.0, 100.0)
+        for ld in msg.lift_data[:2]:
+            analysis.add_run(ld)
+        partial = analysis.data()
+        numpy.testing.assert_array_almost_equal(partial.lift_positions, data.lift_positions[:2])
+        numpy.testing.assert_array_almost_equal(partial.lift_effort_avg, data.lift_effort_avg[:2])
+        numpy.testing.assert_array_almost_equal(partial.flex_effort_avg, data.flex_effort_avg[:2])
+        legacy = load_model(self.model_file)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_file = os.path.join(tmp_dir, 'model.yaml')
+            save_model(model_file, CounterbalanceModel(legacy.model, data.lift_positions, data.flex_positions,
+                                                       'lift_joint', 'flex_joint', {}))
+            adjust_result = check_cb_adjustment(analysis, partial, model_file)
+            self.assert_(not adjust_result.result, "Early stop didn't recommend adjustment")
+            self.assertEqual([ v.key for v in adjust_result.values[:2] ],
+                             [ 'Secondary Spring Adjustment', 'CB Bar Adjustment' ])
+            self.assert_('Turns' in adjust_result.html, "No adjustment instructions for early stop")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        # Test with high limits never fails
+        analysis = IncrementalCounterbalanceAnalysis(self.params.num_lifts, self.params.num_flexes,
+                                                     100.0, 100.0, True, 100.0, 100.0)
+        self.assert_(not any([ analysis.add_run(ld) for ld in msg.lift_data ]), "Good data failed early")
+        self.assert_(analysis.result().result, "Good data failed")
+
     def test_adjustment(self):
         """
         Test that CB adjustment runs successfully
@@ -143,7 +292,9 @@ class TestCounterbalanceAnalysis(unittest.TestCase):
         adjust_result = check_cb_adjustment(self.params, self.data, self.model_file)
         self.assert_(adjust_result.result, "Adjustment result was unsuccessful! %s\n%s" % (adjust_result.summary, adjust_result.html))
         
-        # Bad data has invalid number of dimensions
+        # Bad data has invalid number of dimensions. It's resampled onto
+        # the model's grid, but legacy models have no grid positions, so
+        # it can't be resampled
         bad_params = copy.deepcopy(self.params)
         bad_params.num_lifts = 7
         bad_params.max_lift = 1.0
@@ -151,17 +302,640 @@ class TestCounterbalanceAnalysis(unittest.TestCase):
         bad_data = generate_data(bad_params)
 
         (secondary, bar) = calc_cb_adjust(bad_data, self.model_file)
+        self.assert_(abs(secondary) < self.params.screw_tol and abs(bar) < self.params.bar_tol,
+                     "Resampled adjustment didn't match. Adjustment: %.2f, %.2f" % (secondary, bar))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            legacy_file = os.path.join(tmp_dir, 'legacy.dat')
+            shutil.copy(os.path.splitext(self.model_file)[0] + '.dat', legacy_file)
+            (secondary, bar) = calc_cb_adjust(bad_data, legacy_file)
+        finally:
+            shutil.rmtree(tmp_dir)
 
         self.assert_(abs(secondary) > 50 and abs(bar) > 50,
                      "Calculated adjustment successful on bad data. Adjustment: %.2f, %.2f" % (secondary, bar))
         
+
+    def test_batch_adjustment(self):
+        model = load_model(self.model_file)
+        self.assert_(load_model(self.model_file) is model, "Model file was not cached")
+
+        datas = [ self.data, generate_data(self.params) ]
+        datas[1].lift_effort_avg = datas[1].lift_effort_avg + 0.5
+
+        adjust = calc_cb_adjust_batch(datas, self.model_file)
+        self.assertEqual(adjust.shape, (2, 2))
+        for i, data in enumerate(datas):
+            (secondary, bar) = calc_cb_adjust(data, self.model_file)
+            self.assertAlmostEqual(adjust[i][0], secondary)
+            self.assertAlmostEqual(adjust[i][1], bar)
+
+        # Pre-factorized solve matches full least squares
+        A = model.model[:-1].transpose()
+        B = numpy.array(get_efforts(datas[1], True) + get_efforts(datas[1], False))
+        X = numpy.linalg.lstsq(A, B)[0]
+        self.assertAlmostEqual(adjust[1][0], -X[0])
+        self.assertAlmostEqual(adjust[1][1], X[1])
+
+    def test_model_file(self):
+        legacy = load_model(self.model_file)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_file = os.path.join(tmp_dir, 'model.yaml')
+            save_model(model_file, CounterbalanceModel(legacy.model, self.data.lift_positions, self.data.flex_positions,
+                                                       'lift_joint', 'flex_joint', { 'bags': [ 'a.bag' ] }))
+            self.assert_(os.path.exists(os.path.join(tmp_dir, 'model.npy')), "Model data file not written")
+
+            model = load_model(model_file)
+            self.assert_(isinstance(model.model, numpy.memmap) or isinstance(model.model.base, numpy.memmap),
+                         "Model data not memory mapped")
+            self.assertEqual(model.lift_joint, 'lift_joint')
+            self.assertEqual(model.metadata['bags'], [ 'a.bag' ])
+            self.assertEqual(model.grid_mismatch(self.data), None)
+            self.assertEqual(model._pinv_cache, None, "Model data read before first solve")
+
+            # Shipped legacy model loads from its converted model, and only
+            # without one from the pickle
+            legacy_file = os.path.splitext(self.model_file)[0] + '.dat'
+            self.assert_(load_model(legacy_file).has_grid, "Converted model of legacy model not loaded")
+            self.assert_(numpy.array_equal(load_legacy_model(legacy_file).model, legacy.model))
+            shutil.copy(legacy_file, os.path.join(tmp_dir, 'legacy.dat'))
+            self.assert_(not load_model(os.path.join(tmp_dir, 'legacy.dat')).has_grid)
+
+            (secondary, bar) = calc_cb_adjust(self.data, model_file)
+            (legacy_secondary, legacy_bar) = calc_cb_adjust(self.data, os.path.join(tmp_dir, 'legacy.dat'))
+            self.assertAlmostEqual(secondary, legacy_secondary)
+            self.assertAlmostEqual(bar, legacy_bar)
+
+            # Same grid size, shifted positions is resampled onto model grid
+            shifted = generate_data(self.params)
+            shifted.lift_positions = shifted.lift_positions + 0.1
+            self.assert_(model.grid_mismatch(shifted), "Shifted grid wasn't detected")
+            (secondary, bar) = calc_cb_adjust(shifted, model_file)
+            self.assert_(abs(secondary) < 25 and abs(bar) < 25, "Unable to calculate adjustment on shifted grid")
+
+            # Header from a future format version is rejected
+            with open(os.path.join(tmp_dir, 'future.yaml'), 'w') as f:
+                f.write('format: pr2_counterbalance_model\nversion: 99\n')
+            self.assertRaises(ValueError, read_model_header, os.path.join(tmp_dir, 'future.yaml'))
+        finally:
+            shutil.rmtree(tmp_dir)
             
+    def test_resampled_adjustment(self):
+        legacy = load_model(self.model_file)
+        model = CounterbalanceModel(legacy.model, self.data.lift_positions, self.data.flex_positions)
+
+        # Same grid, resampling is exact
+        secondary, bar, error = model.solve_resampled(self.data)
+        efforts = numpy.concatenate((self.data.lift_effort_avg.ravel(), self.data.flex_effort_avg.ravel()))
+        self.assert_(numpy.allclose((secondary, bar), model.solve(efforts)))
+        self.assertAlmostEqual(error, 0.0)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            model_file = os.path.join(tmp_dir, 'model.yaml')
+            save_model(model_file, model)
+
+            # Partial run, fewer lifts over part of the model's range
+            partial_params = copy.deepcopy(self.params)
+            partial_params.num_lifts = 7
+            partial_params.max_lift = 1.0
+            partial = generate_data(partial_params)
+
+            (secondary, bar) = calc_cb_adjust(partial, model_file)
+            self.assert_(abs(secondary) < self.params.screw_tol and abs(bar) < self.params.bar_tol,
+                         "Resampled adjustment didn't match. Adjustment: %.2f, %.2f" % (secondary, bar))
+
+            adjust_result = check_cb_adjustment(self.params, partial, model_file)
+            self.assert_(adjust_result.result, "Resampled adjustment was unsuccessful! %s" % adjust_result.summary)
+            self.assertEqual(adjust_result.values[2].key, 'CB Adjustment Interpolation Error')
+            self.assert_(float(adjust_result.values[2].value) < 0.1)
+
+            # Rough efforts between model positions interpolate badly, no
+            # adjustment is recommended
+            rs = numpy.random.RandomState(7)
+            rough = generate_data(self.params)
+            rough.lift_positions = rough.lift_positions + 0.0875
+            rough.lift_effort_avg = 3 * rs.randn(*rough.lift_effort_avg.shape)
+            rough.flex_effort_avg = 3 * rs.randn(*rough.flex_effort_avg.shape)
+            (secondary, bar, error) = load_model(model_file).solve_resampled(rough)
+            self.assert_(abs(secondary) < self.params.screw_tol and abs(bar) < self.params.bar_tol)
+            self.assert_(error > MAX_INTERP_ERROR * self.params.bar_tol)
+            adjust_result = check_cb_adjustment(self.params, rough, model_file)
+            self.assert_(not adjust_result.result, "Adjustment recommended with large interpolation error")
+            self.assert_(adjust_result.summary.startswith('Unable to recommend'))
+
+            # No overlap with model grid
+            outside = generate_data(self.params)
+            outside.lift_positions = outside.lift_positions + 5.0
+            (secondary, bar) = calc_cb_adjust(outside, model_file)
+            self.assert_(abs(secondary) > 50 and abs(bar) > 50, "Calculated adjustment on disjoint grid")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_training_manifest(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            csv_file = os.path.join(tmp_dir, 'manifest.csv')
+            with open(csv_file, 'w') as f:
+                f.write('bag,secondary,cb_bar\n')
+                f.write('cb_0.bag,0,0\n')
+                f.write('/data/cb_1.bag,1.5,-0.5\n')
+            entries = read_manifest(csv_file)
+            self.assertEqual([ e.bag for e in entries ], [ os.path.join(tmp_dir, 'cb_0.bag'), '/data/cb_1.bag' ])
+            self.assertEqual([ (e.secondary, e.cb_bar) for e in entries ], [ (0, 0), (1.5, -0.5) ])
+
+            yaml_file = os.path.join(tmp_dir, 'manifest.yaml')
+            with open(yaml_file, 'w') as f:
+                f.write('bags:\n- {bag: cb_0.bag, secondary: 2, cb_bar: 1}\n')
+            entries = read_manifest(yaml_file)
+            self.assertEqual((entries[0].bag, entries[0].secondary, entries[0].cb_bar),
+                             (os.path.join(tmp_dir, 'cb_0.bag'), 2.0, 1.0))
+
+            with open(yaml_file, 'w') as f:
+                f.write('- {bag: cb_0.bag, secondary: 2}\n')
+            self.assertRaises(ValueError, read_manifest, yaml_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fit_model(self):
+        rand = numpy.random.RandomState(0)
+        model = rand.randn(3, 2 * self.params.num_lifts * self.params.num_flexes)
+
+        adjustments = rand.uniform(-2, 2, (10, 2))
+        efforts = numpy.dot(numpy.hstack((adjustments, numpy.ones((10, 1)))), model)
+
+        self.assert_(numpy.allclose(fit_model(adjustments, efforts), model))
+
+    def test_training_stats(self):
+        rand = numpy.random.RandomState(1)
+        num_efforts = 2 * self.params.num_lifts * self.params.num_flexes
+        adjustments = rand.uniform(-2, 2, (8, 2))
+        efforts = rand.randn(8, num_efforts)
+
+        A = numpy.hstack((adjustments, numpy.ones((8, 1))))
+        self.assert_(numpy.allclose(fit_model(adjustments, efforts), numpy.linalg.lstsq(A, efforts, rcond=-1)[0]))
+
+        # Folding bags in, or out, matches training on remaining bags
+        stats = TrainingStats(num_efforts)
+        stats.add(adjustments[:5], efforts[:5])
+        stats.add(adjustments[5:], efforts[5:])
+        stats.remove(adjustments[:2], efforts[:2])
+        self.assertEqual(stats.count, 6)
+        self.assert_(numpy.allclose(stats.solve(), fit_model(adjustments[2:], efforts[2:])))
+        self.assert_(numpy.allclose(stats.BtB, (efforts[2:] ** 2).sum(axis=0)))
+
+        self.assertRaises(ValueError, stats.remove, adjustments, efforts)
+        self.assertRaises(ValueError, TrainingStats(num_efforts).solve)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(tmp_dir, 'model_stats.npz')
+            stats.save(stats_file)
+            loaded = TrainingStats.load(stats_file)
+            self.assertEqual(loaded.count, 6)
+            self.assert_(numpy.allclose(loaded.solve(), stats.solve()))
+
+            # Only the current statistics version is read
+            with open(stats_file, 'wb') as f:
+                numpy.savez(f, version = 1, AtA = stats.AtA, AtB = stats.AtB, BtB = stats.BtB, count = stats.count)
+            self.assertRaises(ValueError, TrainingStats.load, stats_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_remove_bags(self):
+        rand = numpy.random.RandomState(3)
+        num_efforts = 2 * self.params.num_lifts * self.params.num_flexes
+        adjustments = rand.uniform(-2, 2, (8, 2))
+        efforts = rand.randn(8, num_efforts)
+        # Same bag name on different robots
+        bags = [ os.path.join('robot%d' % (i % 2), 'cb_%d.bag' % (i // 2)) for i in range(8) ]
+
+        stats = TrainingStats(num_efforts)
+        stats.add(adjustments, efforts, bags)
+        self.assertRaises(ValueError, stats.add, adjustments[:1], efforts[:1], bags[:1])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(tmp_dir, 'model_stats.npz')
+            stats.save(stats_file)
+            stats = TrainingStats.load(stats_file)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(stats.bags, bags)
+
+        # Removed from stored efforts, bags aren't read
+        model = CounterbalanceModel(stats.solve(), self.data.lift_positions, self.data.flex_positions,
+                                    'lift_joint', 'flex_joint', {})
+        remove = [ TrainingEntry('/does/not/exist/' + bags[i], adjustments[i][0], adjustments[i][1], bags[i])
+                   for i in (0, 3) ]
+        updated, updated_stats, report = update_model(model, stats, remove = remove)
+
+        keep = [ 1, 2, 4, 5, 6, 7 ]
+        self.assertEqual(updated.metadata['bags'], [ bags[i] for i in keep ])
+        self.assert_(numpy.allclose(updated.model, fit_model(adjustments[keep], efforts[keep])))
+        self.assertEqual(updated_stats.count, 6)
+        self.assertEqual(stats.count, 8)
+
+        # Bag adjustments must match training set
+        wrong = [ TrainingEntry(bags[1], adjustments[1][0] + 1, adjustments[1][1], bags[1]) ]
+        self.assertRaises(ValueError, update_model, model, stats, remove = wrong)
+        self.assertRaises(ValueError, update_model, model, stats, remove = [ TrainingEntry('cb_0.bag', 0, 0) ])
+
+        # Repeated bags are rejected, statistics are unchanged
+        before = stats.copy()
+        self.assertRaises(ValueError, stats.remove_bags, [ bags[2], bags[2] ])
+        self.assertRaises(ValueError, update_model, model, stats, remove = [ remove[0], remove[0] ])
+        self.assertEqual(stats.bags, before.bags)
+        self.assert_(numpy.allclose(stats.AtB, before.AtB))
+
+        # Statistics of unnamed bags can't be updated
+        unnamed = TrainingStats(num_efforts)
+        unnamed.add(adjustments, efforts)
+        self.assertRaises(ValueError, update_model, model, unnamed)
+
+    def test_leave_one_out(self):
+        rand = numpy.random.RandomState(2)
+        num_bags = 12
+        num_efforts = 2 * self.params.num_lifts * self.params.num_flexes
+        model = rand.randn(3, num_efforts)
+        adjustments = rand.uniform(-2, 2, (num_bags, 2))
+        A = numpy.hstack((adjustments, numpy.ones((num_bags, 1))))
+        efforts = numpy.dot(A, model) + 0.05 * rand.randn(num_bags, num_efforts)
+        bags = [ 'cb_%d.bag' % i for i in range(num_bags) ]
+
+        stats = TrainingStats(num_efforts)
+        stats.add(adjustments, efforts)
+        report = validate(stats, bags, adjustments, efforts)
+
+        hat = numpy.dot(numpy.dot(A, numpy.linalg.inv(numpy.dot(A.T, A))), A.T)
+        self.assert_(numpy.allclose(report.leverage, numpy.diag(hat)))
+
+        # Closed form matches refitting without each bag
+        for i in range(num_bags):
+            others = [ j for j in range(num_bags) if j != i ]
+            X = fit_model(adjustments[others], efforts[others])
+            estimate = numpy.linalg.lstsq(X[:2].T, efforts[i] - X[2], rcond=-1)[0]
+            self.assert_(numpy.allclose(report.turn_error[i], estimate - adjustments[i]))
+
+        self.assertEqual(report.outliers(), [])
+        self.assert_(max(report.rms_turn_error()) < 0.1, "Leave-one-out error too high for good data")
+
+        # Bag with wrong adjustments recorded
+        wrong = adjustments.copy()
+        wrong[4] += (1.5, -1.0)
+        stats = TrainingStats(num_efforts)
+        stats.add(wrong, efforts)
+        report = validate(stats, bags, wrong, efforts)
+        self.assertEqual(report.outliers(), [ 'cb_4.bag' ])
+
+    def test_bag_reader(self):
+        import rosbag, rospy
+        from std_msgs.msg import Float64
+        from joint_qualification_controllers.msg import CounterbalanceTestData, CBRunData
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # Station bag, CB data among high rate data
+            bag_file = os.path.join(tmp_dir, 'station.bag')
+            bag = rosbag.Bag(bag_file, 'w')
+            try:
+                for i in range(2000):
+                    bag.write('/high_rate', Float64(i), rospy.Time.from_sec(1 + 0.001 * i))
+                for i, joint in enumerate([ 'r_shoulder_lift_joint', 'l_shoulder_lift_joint' ]):
+                    msg = CounterbalanceTestData()
+                    msg.lift_joint = joint
+                    msg.lift_data = [ CBRunData() for j in range(3) ]
+                    bag.write('/cb_test_data', msg, rospy.Time.from_sec(2 + i))
+            finally:
+                bag.close()
+
+            bag = rosbag.Bag(bag_file)
+            try:
+                self.assertEqual(indexed_topics(bag), [ '/cb_test_data' ])
+                self.assertEqual(indexed_topics(bag, 'std_msgs/Float64'), [ '/high_rate' ])
+            finally:
+                bag.close()
+
+            msg = read_cb_msg(bag_file)
+            self.assertEqual(msg.lift_joint, 'r_shoulder_lift_joint')
+            self.assertEqual(len(msg.lift_data), 3)
+            self.assertEqual([ m.lift_joint for m in read_cb_msgs(bag_file) ],
+                             [ 'r_shoulder_lift_joint', 'l_shoulder_lift_joint' ])
+
+            empty_file = os.path.join(tmp_dir, 'empty.bag')
+            bag = rosbag.Bag(empty_file, 'w')
+            try:
+                bag.write('/high_rate', Float64(0), rospy.Time.from_sec(1))
+            finally:
+                bag.close()
+            self.assertEqual(read_cb_msg(empty_file), None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fleet_archive(self):
+        data = CounterbalanceAnalysisData(generate_msg(self.params))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive = FleetArchive(os.path.join(tmp_dir, 'archive'))
+            self.assertEqual(len(archive), 0)
+            self.assertEqual(archive.efforts().shape[0], 0)
+
+            self.assertEqual(archive.append(data, 'pr1001', 'right', 1000.0, 'model.yaml'), 0)
+            self.assertEqual(archive.append(data, 'pr1001', 'left', 2000.0, 'model.yaml'), 1)
+
+            # Efforts from an interrupted append are dropped
+            with open(os.path.join(archive.archive_dir, 'efforts.dat'), 'ab') as f:
+                f.write(b'\0' * 100)
+            self.assertEqual(archive.append(data, 'pr1002', 'right', 3000.0, 'model.yaml'), 2)
+
+            efforts = archive.efforts()
+            self.assertEqual(efforts.shape, (3, self.params.num_lifts, self.params.num_flexes, 2))
+            self.assert_(numpy.allclose(efforts[2, :, :, 0], data.lift_effort_avg))
+            self.assert_(numpy.allclose(efforts[2, :, :, 1], data.flex_effort_avg))
+
+            self.assertEqual(list(archive.select(side = 'right')), [ 0, 2 ])
+            self.assertEqual(list(archive.select(robot = 'pr1001', since = 1500.0)), [ 1 ])
+            self.assertEqual(list(archive.select(until = 1000.0)), [])
+
+            stats = effort_stats(efforts[archive.select(side = 'right')])
+            lift_mse, lift_avg_abs, avg_eff = get_effort_stats(data, True)
+            self.assert_(numpy.allclose(stats['lift_mse'], lift_mse))
+            self.assert_(numpy.allclose(stats['lift_avg_abs'], lift_avg_abs))
+
+            # Grid is fixed by first run
+            small = copy.deepcopy(self.params)
+            small.num_lifts = 4
+            self.assertRaises(ValueError, archive.append, CounterbalanceAnalysisData(generate_msg(small)))
+            self.assertEqual(len(archive), 3)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_drift(self):
+        data = CounterbalanceAnalysisData(generate_msg(self.params))
+        shape = data.lift_effort_avg.shape
+        model = CounterbalanceModel(numpy.random.RandomState(5).randn(3, 2 * data.lift_effort_avg.size),
+                                    data.lift_positions, data.flex_positions)
+
+        # Efforts of a run the model adjusts by given turns
+        def run(secondary, cb_bar):
+            efforts = numpy.dot(model.model[:2].transpose(), [ -secondary, cb_bar ])
+            d = copy.copy(data)
+            d.lift_effort_avg = efforts[:efforts.size // 2].reshape(shape)
+            d.flex_effort_avg = efforts[efforts.size // 2:].reshape(shape)
+            return d
+
+        day = 24 * 3600.0
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive = FleetArchive(os.path.join(tmp_dir, 'archive'))
+            for i in range(4):
+                # pr1001 secondary spring drifts 0.01 turns/day
+                archive.append(run(0.01 * 30 * i, 0.1), 'pr1001', 'right', 30 * i * day)
+                archive.append(run(0.5, -0.2), 'pr1002', 'right', 30 * i * day)
+            archive.append(run(0.5, 0.0), 'pr1002', 'left', 0.0)
+            archive.append(run(0.0, 0.0), '', 'left', 0.0)
+
+            results = analyze_drift(archive, model, 90.0, 2.0, 0.8)
+            self.assertEqual([ (d.robot, d.side, d.num_runs) for d in results ],
+                             [ ('pr1001', 'right', 4), ('pr1002', 'left', 1), ('pr1002', 'right', 4) ])
+
+            drifting, single, steady = results
+            self.assert_(numpy.allclose(drifting.turns, (0.9, 0.1)))
+            self.assert_(numpy.allclose(drifting.rate, (0.01, 0.0)))
+            self.assert_(numpy.allclose(drifting.projected, (1.8, 0.1)))
+            self.assertAlmostEqual(drifting.last_time, 90 * day)
+            self.assert_(drifting.grid_change > 0)
+            self.assertFalse(drifting.flagged)
+
+            self.assert_(numpy.allclose(steady.rate, (0.0, 0.0)))
+            self.assertAlmostEqual(steady.grid_change, 0.0)
+            self.assertFalse(steady.flagged)
+
+            self.assert_(numpy.isnan(single.rate[0]))
+            self.assert_(numpy.isnan(single.grid_change))
+            self.assert_(numpy.allclose(single.projected, (0.5, 0.0)))
+
+            # Secondary passes 2 turns before a check 120 days out
+            drifting, = analyze_drift(archive, model, 120.0, 2.0, 0.8, robot = 'pr1001')
+            self.assert_(drifting.flagged)
+
+            small = CounterbalanceModel(model.model[:, :4])
+            self.assertRaises(ValueError, analyze_drift, archive, small)
+
+            # pr1003 was adjusted after its flagged run, only runs since then are fit
+            archive.append(run(3.0, 0.0), 'pr1003', 'right', 0.0, result = 'PASS')
+            archive.append(run(2.5, 0.0), 'pr1003', 'right', 30 * day, result = 'HUMAN_REQUIRED')
+            archive.append(run(0.0, 0.2), 'pr1003', 'right', 40 * day, result = 'PASS')
+            archive.append(run(0.1, 0.2), 'pr1003', 'right', 50 * day, result = 'PASS')
+            adjusted, = analyze_drift(archive, model, 90.0, 2.0, 0.8, robot = 'pr1003')
+            self.assertEqual(adjusted.num_runs, 2)
+            self.assert_(numpy.allclose(adjusted.rate, (0.01, 0.0)))
+            self.assert_(numpy.allclose(adjusted.projected, (1.0, 0.2)))
+            self.assertFalse(adjusted.flagged)
+
+            # Grid change is from previous run since the adjustment
+            archive.append(run(0.1, 0.2), 'pr1003', 'right', 60 * day, result = 'FAIL')
+            archive.append(run(0.0, 0.0), 'pr1003', 'right', 70 * day, result = 'PASS')
+            adjusted, = analyze_drift(archive, model, 90.0, 2.0, 0.8, robot = 'pr1003')
+            self.assertEqual(adjusted.num_runs, 1)
+            self.assert_(numpy.isnan(adjusted.grid_change))
+            self.assert_(numpy.allclose(adjusted.projected, (0.0, 0.0)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_reduced_grid(self):
+        self.assertEqual(progressions(3), [ [0], [1], [2], [0, 1], [1, 2], [0, 2], [0, 1, 2] ])
+
+        lifts = grid_positions(-0.2, 1.21, 0.2)
+        flexes = grid_positions(-1.8, -0.19, 0.2)
+        rs = numpy.random.RandomState(3)
+        model = CounterbalanceModel(rs.randn(3, 2 * len(lifts) * len(flexes)), lifts, flexes)
+
+        # Runs in span of model are predicted by any grid
+        turns = rs.randn(20, 2) * [ 1.0, -1.0 ]
+        efforts = numpy.dot(turns, model.model[:2])
+        reduced = find_reduced_grid(model, efforts, 0.1, 0.1)
+        self.assertEqual(reduced.num_holds, 4)
+        self.assert_(reduced.error.max() < 1e-6)
+
+        small = reduce_model(model, reduced.lift_indices, reduced.flex_indices)
+        self.assertEqual(small.num_efforts, 8)
+        lift_efforts = efforts[:, :efforts.shape[1] // 2].reshape(-1, len(lifts), len(flexes))
+        flex_efforts = efforts[:, efforts.shape[1] // 2:].reshape(-1, len(lifts), len(flexes))
+        ix = numpy.ix_(range(len(efforts)), reduced.lift_indices, reduced.flex_indices)
+        small_efforts = numpy.hstack((lift_efforts[ix].reshape(len(efforts), -1),
+                                      flex_efforts[ix].reshape(len(efforts), -1)))
+        self.assert_(numpy.allclose(small.solve_batch(small_efforts), model.solve_batch(efforts)))
+
+        # Noise needs more holds, and none are within a tiny tolerance
+        noisy = efforts + 0.3 * rs.randn(*efforts.shape)
+        self.assert_(find_reduced_grid(model, noisy, 0.1, 0.05).num_holds > 4)
+        self.assertEqual(find_reduced_grid(model, noisy, 1e-4, 1e-4), None)
+
+        # Controller steps through the reduced positions
+        lift = { 'min': -0.2, 'max': 1.21, 'delta': 0.2, 'mse': 3.0, 'avg_abs': 2.0 }
+        flex = { 'min': -1.8, 'max': -0.19, 'delta': 0.2, 'mse': 3.0, 'avg_abs': 2.0 }
+        config = { 'lift': lift, 'flex': flex, 'cb_check_controller': { 'settle_time': 2.0 },
+                   'cb_right_controller': { 'settle_time': 2.0, 'lift': dict(lift), 'flex': dict(flex) } }
+        reduced_cfg = reduced_config(config, reduced, 0.2, 0.2)
+        for joint, positions in (('lift', reduced.lift_positions), ('flex', reduced.flex_positions)):
+            p = reduced_cfg['cb_right_controller'][joint]
+            self.assert_(numpy.allclose(grid_positions(p['min'], p['max'], p['delta']), positions))
+        self.assertEqual(config['cb_right_controller']['lift']['max'], 1.21)
+
+        # Entries that were only anchors of controllers are dropped
+        self.assertEqual(list(reduced_cfg.keys()), [ 'cb_right_controller' ])
+
+        # Effort limits scale with the reduced grid's efforts
+        archive_efforts = numpy.transpose(efforts.reshape(len(efforts), 2, len(lifts), len(flexes)), (0, 2, 3, 1))
+        self.assertEqual(config_limits(config), { 'lift': { 'mse': 3.0, 'avg_abs': 2.0 },
+                                                  'flex': { 'mse': 3.0, 'avg_abs': 2.0 } })
+        limits, agreement = reduced_limits(archive_efforts, reduced, config_limits(config))
+        for k, joint in enumerate(('lift', 'flex')):
+            full = archive_efforts[..., k]
+            small = full[:, reduced.lift_indices][:, :, reduced.flex_indices]
+            ratio = numpy.median((small ** 2).mean(axis=(1, 2)) / (full ** 2).mean(axis=(1, 2)))
+            self.assertAlmostEqual(limits[joint]['mse'], 3.0 * ratio, 3)
+            self.assert_(0.0 <= agreement[joint]['mse'] <= 1.0)
+        reduced_params = reduced_config(config, reduced, 0.2, 0.2, limits)['cb_right_controller']
+        self.assertEqual(reduced_params['flex']['avg_abs'], limits['flex']['avg_abs'])
+
+    def test_hold_timing(self):
+        x = numpy.arange(24.0).reshape(2, 3, 4)
+        means = window_means(x, [ 0, 1 ], [ 1, 3 ])
+        self.assertEqual(means.shape, (2, 2, 2, 3))
+        self.assert_(numpy.allclose(means[1, 1], x[..., 1:4].mean(axis=-1)))
+
+        msg = generate_msg(self.params, 400)
+        traces = HoldTraces([ msg, msg ])
+        self.assertEqual(traces.effort.shape, (2 * self.params.num_lifts * self.params.num_flexes, 2, 400))
+        self.assertAlmostEqual(traces.dt, 0.001)
+
+        # Settled traces keep the recorded settle time, with fewer samples
+        timing = optimize_hold_timing(traces, 2.0)
+        self.assertAlmostEqual(timing.settle_time, 2.0)
+        self.assert_(timing.dither_points < 400)
+        self.assert_(timing.hold_time < timing.recorded_hold_time)
+        self.assertEqual(timing.effort_settle.max(), 0)
+
+        # Effort transient at start of traces needs a longer settle time
+        for ld in msg.lift_data:
+            for fd in ld.flex_data:
+                for hold in (fd.lift_hold, fd.flex_hold):
+                    hold.effort = [ e + 5.0 * math.exp(-t / 0.02) for e, t in zip(hold.effort, hold.time) ]
+        traces = HoldTraces([ msg ])
+        model = CounterbalanceModel(numpy.random.RandomState(7).randn(3, 2 * traces.effort.shape[0]),
+                                    traces.lift_positions, traces.flex_positions)
+        timing = optimize_hold_timing(traces, 2.0, 0.1, model)
+        self.assert_(timing.settle_time > 2.0)
+        self.assert_(timing.effort_settle.min() > 0)
+        self.assert_(timing.effort_error <= 0.1)
+        self.assert_(timing.turns_error[0] <= 0.2 and timing.turns_error[1] <= 0.08)
+
+        small = CounterbalanceModel(model.model[:, :4])
+        self.assertRaises(ValueError, optimize_hold_timing, traces, 2.0, 0.1, small)
+
     def test_plots(self):
         p_contout_lift = plot_effort_contour(self.params, self.data, True)
         p_contout_flex = plot_effort_contour(self.params, self.data, False)
 
         p_eff = plot_efforts_by_lift_position(self.params, self.data)
 
+        plots = render_plots(self.params, self.data)
+        self.assertEqual([ p.title for p in plots ], [ p_eff.title, p_contout_lift.title, p_contout_flex.title ])
+        for plot, serial in zip(plots, [ p_eff, p_contout_lift, p_contout_flex ]):
+            self.assertEqual(plot.image_format, 'png')
+            self.assertEqual(plot.image.dtype, numpy.int8)
+            self.assertEqual(plot.image.tobytes(), serial.image.tobytes())
+
+        # Signed byte payload is a view of the PNG data
+        png = p_eff.image.tobytes()
+        self.assertEqual(png[:4], b'\x89PNG')
+        self.assertEqual(p_eff.image[0], 0x89 - 256)
+
+    def test_plot_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache = PlotCache(tmp_dir)
+            p_first = plot_effort_contour(self.params, self.data, True, cache = cache)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+            p_cached = plot_effort_contour(self.params, self.data, True, cache = cache)
+            self.assertEqual(p_cached.image.tobytes(), p_first.image.tobytes())
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+            # Lift and flex efforts are equal in test data, so the plots share an entry
+            plot_effort_contour(self.params, self.data, False, cache = cache)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+            # Different plot type or rendering parameters get new entries
+            plot_efforts_by_lift_position(self.params, self.data, cache = cache)
+            plot_effort_contour(self.params, self.data, True, dpi = 40, cache = cache)
+            self.assertEqual(len(os.listdir(tmp_dir)), 3)
+
+            plots = render_plots(self.params, self.data, cache = cache)
+            self.assertEqual(len(os.listdir(tmp_dir)), 3)
+            self.assertEqual(plots[1].image.tobytes(), p_first.image.tobytes())
+
+            # Least recently used entries are evicted over size limit
+            small_cache = PlotCache(tmp_dir, max_bytes = 1000)
+            small_cache.put('a' * 40, b'x' * 600)
+            small_cache.put('b' * 40, b'x' * 600)
+            self.assertEqual(os.listdir(tmp_dir), [ 'b' * 40 ])
+            self.assertEqual(small_cache.get('a' * 40), None)
+
+            # Puts under the size limit don't list the cache
+            evictions = []
+            big_cache = PlotCache(tmp_dir)
+            big_cache.evict = lambda: evictions.append(1)
+            big_cache.put('c' * 40, b'x' * 600)
+            big_cache.put('d' * 40, b'x' * 600)
+            self.assertEqual(evictions, [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_imports(self):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        try:
+            from cb_startup_benchmark import time_import, heavy_imports
+        finally:
+            sys.path.pop(0)
+
+        t, modules = time_import('pr2_counterbalance_check.counterbalance_analysis')
+        self.assertEqual(heavy_imports(modules), [])
+
+        # matplotlib is loaded to render, not to import plots or look up the cache
+        t, modules = time_import('pr2_counterbalance_check.counterbalance_plots')
+        self.assertEqual(heavy_imports(modules), [ 'pr2_self_test_msgs' ])
+
+        cached_lookup = 'import sys; from pr2_counterbalance_check.plot_cache import PlotCache; ' \
+                        'PlotCache(sys.argv[1]).key((\'contour\', (), \'png\', None)); ' \
+                        'print(\'matplotlib\' in sys.modules)'
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join([ p for p in sys.path if p ])
+            out = subprocess.check_output([ sys.executable, '-c', cached_lookup, tmp_dir ], env = env)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(out.decode('utf-8').strip(), 'False')
+
+    def test_compact_plots(self):
+        p_png = plot_effort_contour(self.params, self.data, True)
+        p_small = plot_effort_contour(self.params, self.data, True, dpi = 40)
+        p_svg = plot_effort_contour(self.params, self.data, True, image_format = 'svg')
+
+        self.assertEqual(p_small.image_format, 'png')
+        self.assert_(len(p_small.image) < len(p_png.image), "Reduced DPI plot wasn't smaller")
+        self.assertEqual(p_svg.image_format, 'svg')
+        self.assert_(b'<svg' in p_svg.image.tobytes(), "SVG plot doesn't contain SVG")
+
+        plots = render_plots(self.params, self.data, image_format = 'svg')
+        self.assertEqual([ p.image_format for p in plots ], [ 'svg' ] * 3)
+
 
 if __name__ == '__main__':
     rostest.unitrun(PKG, 'test_cb_analysis', TestCounterbalanceAnalysis)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Benchmarks the counterbalance analysis on synthetic test data
+##
+## Generates CounterbalanceTestData-shaped messages at realistic and stress
+## grid sizes, and times conversion to analysis data, effort analysis, the
+## CB adjustment and plots. Peak memory of each step is traced separately.
+## Results are written as JSON, and can be compared against a baseline run
+## of another commit with --compare.
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+
+import os, sys
+import time
+import json
+import math
+import shutil, tempfile
+import subprocess
+import multiprocessing
+
+import numpy
+
+from optparse import OptionParser
+
+from pr2_counterbalance_check.counterbalance_analysis import *
+from pr2_counterbalance_check.counterbalance_model import CounterbalanceModel, save_model
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2, no peak memory
+
+RESULT_FORMAT = 'pr2_counterbalance_benchmark'
+RESULT_VERSION = 1
+
+# Grid sizes: (num_lifts, num_flexes, dither_points)
+SIZES = { 'realistic': (8, 9, 1000),
+          'dense': (15, 17, 1000),
+          'stress': (22, 25, 2000) }
+
+DEFAULT_SIZES = [ 'realistic', 'dense' ]
+
+ARG_NAMES = [ 'Settle Time', 'Dither Points', 'Timeout',
+              'Lift Min', 'Lift Max', 'Lift Delta', 'Flex Min', 'Flex Max', 'Flex Delta',
+              'Lift MSE', 'Lift Avg Abs', 'Lift Avg Effort',
+              'Flex MSE', 'Flex Avg Abs', 'Flex Avg Effort',
+              'Lift P', 'Lift I', 'Lift D', 'Lift I Clamp',
+              'Flex P', 'Flex I', 'Flex D', 'Flex I Clamp',
+              'Screw Tolerance', 'Bar Tolerance' ]
+
+class SyntheticMsg(object):
+    pass
+
+##\brief Generates a CounterbalanceTestData-shaped message
+##
+## Hold efforts follow a gravity-like torque over the grid, with dither and
+## noise. Arrays are lists, as in deserialized messages.
+##\param seed int : Random seed, same seed gives same data
+def synthetic_msg(num_lifts, num_flexes, dither_points, seed = 0):
+    rand = numpy.random.RandomState(seed)
+
+    lift_min, lift_max = -0.2, 1.2
+    flex_min, flex_max = -1.8, -0.2
+    lift_delta = (lift_max - lift_min) / max(num_lifts - 1, 1)
+    flex_delta = (flex_max - flex_min) / max(num_flexes - 1, 1)
+
+    msg = SyntheticMsg()
+    msg.lift_joint = 'r_shoulder_lift_joint'
+    msg.flex_joint = 'r_elbow_flex_joint'
+    msg.lift_amplitude = 8.0
+    msg.flex_amplitude = 6.0
+    msg.timeout_hit = False
+    msg.flex_test = True
+    msg.arg_name = list(ARG_NAMES)
+    msg.arg_value = [ 2.0, dither_points, 300,
+                      lift_min, lift_max, lift_delta, flex_min, flex_max, flex_delta,
+                      3.0, 2.0, 1.5, 3.0, 2.0, 1.5,
+                      80.0, 8.0, 6.0, 3.0, 70.0, 12.0, 12.0, 2.0,
+                      2.0, 0.8 ]
+
+    t = numpy.arange(dither_points) * 0.001
+    dither = numpy.sin(2 * math.pi * 10 * t)
+
+    msg.lift_data = []
+    for i in range(num_lifts):
+        ld = SyntheticMsg()
+        ld.lift_position = lift_min + lift_delta * i
+        ld.flex_data = []
+        for j in range(num_flexes):
+            fd = SyntheticMsg()
+            fd.flex_position = flex_min + flex_delta * j
+
+            lift_torque = 1.5 * math.cos(ld.lift_position) + 0.5 * math.cos(ld.lift_position + fd.flex_position) - 1.2
+            flex_torque = 0.5 * math.cos(ld.lift_position + fd.flex_position) - 0.2
+            for name, position, torque, amplitude in (('lift_hold', ld.lift_position, lift_torque, msg.lift_amplitude),
+                                                      ('flex_hold', fd.flex_position, flex_torque, msg.flex_amplitude)):
+                hold = SyntheticMsg()
+                hold.time     = t.tolist()
+                hold.position = (position + 0.002 * dither + 0.0005 * rand.randn(dither_points)).tolist()
+                hold.velocity = (0.1 * dither + 0.01 * rand.randn(dither_points)).tolist()
+                hold.effort   = (torque + amplitude * 0.1 * dither + 0.05 * rand.randn(dither_points)).tolist()
+                setattr(fd, name, hold)
+            ld.flex_data.append(fd)
+        msg.lift_data.append(ld)
+
+    return msg
+
+##\brief Writes a random model matching the grid of data
+def synthetic_model(data, model_file, seed = 0):
+    rand = numpy.random.RandomState(seed)
+    num_efforts = 2 * len(data.lift_positions) * len(data.flex_positions)
+    model = CounterbalanceModel(rand.randn(3, num_efforts), data.lift_positions, data.flex_positions)
+    save_model(model_file, model)
+
+# Short benchmarks are looped until each run takes at least this (seconds)
+MIN_RUN_TIME = 0.02
+
+##\brief Times func, after one untimed call to load lazy imports and caches
+##
+##\return ([ float ], int) : Seconds per call of each run, calls per run
+def time_runs(func, repeats):
+    func()
+
+    number = 1
+    while True:
+        start = time.time()
+        for i in range(number):
+            func()
+        if time.time() - start >= MIN_RUN_TIME or number >= 10000:
+            break
+        number *= 10
+
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        for j in range(number):
+            func()
+        times.append((time.time() - start) / number)
+    return times, number
+
+##\return int : Peak bytes allocated by Python during func, or None if untraced
+def peak_memory(func):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+##\brief Runs all benchmarks at one grid size
+##
+##\param pool multiprocessing.Pool : Pool for render_plots
+##\return dict : Benchmark name to timing and memory results
+def run_size(num_lifts, num_flexes, dither_points, repeats, tmp_dir, pool):
+    msg = synthetic_msg(num_lifts, num_flexes, dither_points)
+    data = CounterbalanceAnalysisData(msg)
+    params = CounterbalanceAnalysisParams(msg)
+
+    model_file = os.path.join(tmp_dir, 'model_%dx%d.yaml' % (num_lifts, num_flexes))
+    synthetic_model(data, model_file)
+    calc_cb_adjust(data, model_file) # Load model, so following runs are cached
+
+    benchmarks = [
+        ('analysis_data', lambda: CounterbalanceAnalysisData(msg)),
+        ('analysis_params', lambda: CounterbalanceAnalysisParams(msg)),
+        ('analyze_lift_efforts', lambda: analyze_lift_efforts(params, data)),
+        ('analyze_flex_efforts', lambda: analyze_flex_efforts(params, data)),
+        ('calc_cb_adjust', lambda: calc_cb_adjust(data, model_file)),
+        ('plot_effort_contour', lambda: plot_effort_contour(params, data, True)),
+        ('plot_efforts_by_lift_position', lambda: plot_efforts_by_lift_position(params, data)),
+        ('render_plots', lambda: render_plots(params, data, pool)),
+        ]
+
+    results = {}
+    for name, func in benchmarks:
+        times, number = time_runs(func, repeats)
+        results[name] = { 'min': min(times),
+                          'median': sorted(times)[len(times) // 2],
+                          'repeats': repeats,
+                          'number': number,
+                          'peak_bytes': peak_memory(func) }
+    return results
+
+##\return str : Git commit of source tree, or '' if unknown
+def git_commit():
+    try:
+        out = subprocess.check_output([ 'git', 'rev-parse', 'HEAD' ],
+                                      cwd = os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('utf-8').strip()
+    except Exception:
+        return ''
+
+##\brief Compares best times against baseline results
+##
+##\param threshold float : Ratio of new/baseline time counted as regression
+##\return [ str ] : Regressed benchmarks, as 'size/name'
+def compare(results, baseline, threshold):
+    regressions = []
+    for size, size_results in sorted(results['results'].items()):
+        base_size = baseline['results'].get(size)
+        if base_size is None:
+            continue
+        for name, r in sorted(size_results['benchmarks'].items()):
+            base = base_size['benchmarks'].get(name)
+            if base is None or base['min'] <= 0:
+                continue
+            ratio = r['min'] / base['min']
+            flag = ''
+            if ratio > threshold:
+                flag = 'REGRESSION'
+                regressions.append('%s/%s' % (size, name))
+            print('%-10s %-32s %9.2f ms %9.2f ms %6.2fx %s' % (
+                    size, name, 1000 * base['min'], 1000 * r['min'], ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_benchmark.py [options]")
+    parser.add_option("-s", "--sizes", action="store", dest="sizes", default=','.join(DEFAULT_SIZES),
+                      help="Comma separated grid sizes, from %s (default %s)" % (
+            ', '.join(sorted(SIZES.keys())), ','.join(DEFAULT_SIZES)))
+    parser.add_option("-n", "--repeats", action="store", type="int", dest="repeats", default=5,
+                      help="Runs of each benchmark (default 5)")
+    parser.add_option("-o", "--output", action="store", dest="output", default=None,
+                      help="Write JSON results to this file")
+    parser.add_option("-c", "--compare", action="store", dest="compare", default=None,
+                      help="Compare against JSON results of earlier run")
+    parser.add_option("--threshold", action="store", type="float", dest="threshold", default=1.25,
+                      help="Slowdown ratio counted as regression in comparison (default 1.25)")
+    options, args = parser.parse_args()
+
+    sizes = [ s.strip() for s in options.sizes.split(',') if s.strip() ]
+    for s in sizes:
+        if s not in SIZES:
+            parser.error("Unknown size %s" % s)
+
+    results = { 'format': RESULT_FORMAT,
+                'version': RESULT_VERSION,
+                'commit': git_commit(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': sys.version.split()[0],
+                'numpy': numpy.__version__,
+                'results': {} }
+
+    # Start workers before allocating test data
+    pool = multiprocessing.Pool(3)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for s in sizes:
+            num_lifts, num_flexes, dither_points = SIZES[s]
+            print('Benchmarking %s grid, %dx%d, %d dither points' % (s, num_lifts, num_flexes, dither_points),
+                  file=sys.stderr)
+            results['results'][s] = {
+                'grid': [ num_lifts, num_flexes, dither_points ],
+                'benchmarks': run_size(num_lifts, num_flexes, dither_points, options.repeats, tmp_dir, pool) }
+    finally:
+        shutil.rmtree(tmp_dir)
+        pool.close()
+        pool.join()
+
+    for s in sizes:
+        for name, r in sorted(results['results'][s]['benchmarks'].items()):
+            peak = '' if r['peak_bytes'] is None else '%8.1f KB' % (r['peak_bytes'] / 1024.0)
+            print('%-10s %-32s %9.2f ms %s' % (s, name, 1000 * r['median'], peak))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('format') != RESULT_FORMAT:
+            parser.error("%s is not a benchmark result file" % options.compare)
+        print('\nComparison against %s (commit %s)' % (options.compare, baseline.get('commit', '')[:10]))
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+##\brief Benchmarks import time of the counterbalance analysis
+##
+## Each import is timed in a fresh interpreter. Exits with an error if the
+## numerical core loads matplotlib or pr2_self_test_msgs, or if its median
+## import time is over --max-time.
+
+from __future__ import print_function
+
+import os, sys
+import subprocess
+import json
+
+from optparse import OptionParser
+
+# Modules the numerical core must not load
+HEAVY_MODULES = [ 'matplotlib', 'pr2_self_test_msgs' ]
+
+_TIMER = '''
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({ 'time': elapsed, 'modules': sorted(sys.modules.keys()) }))
+'''
+
+##\brief Imports module in a fresh interpreter
+##
+##\return (float, [ str ]) : Import time in seconds, modules loaded after import
+def time_import(module):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ p for p in sys.path if p ])
+    out = subprocess.check_output([ sys.executable, '-c', _TIMER % module ], env = env)
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return result['time'], result['modules']
+
+##\brief Heavy modules loaded by importing module
+def heavy_imports(modules):
+    return [ h for h in HEAVY_MODULES if h in modules ]
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+if __name__ == '__main__':
+    parser = OptionParser("./cb_startup_benchmark.py [options]")
+    parser.add_option("-n", "--runs", action="store", type="int", dest="runs", default=5,
+                      help="Imports to time of each module (default 5)")
+    parser.add_option("--max-time", action="store", type="float", dest="max_time", default=None,
+                      help="Fail if median import time of analysis core is over this (seconds)")
+    options, args = parser.parse_args()
+
+    ok = True
+    results = {}
+    for module in [ 'numpy',
+                    'pr2_counterbalance_check.counterbalance_analysis',
+                    'pr2_counterbalance_check.counterbalance_plots' ]:
+        runs = [ time_import(module) for i in range(options.runs) ]
+        results[module] = _median([ t for t, modules in runs ])
+        heavy = heavy_imports(runs[0][1])
+        print('%-50s %7.1f ms  %s' % (module, 1000 * results[module], ', '.join(heavy)))
+
+    core = 'pr2_counterbalance_check.counterbalance_analysis'
+    heavy = heavy_imports(time_import(core)[1])
+    if heavy:
+        print('FAIL: %s loads %s' % (core, ', '.join(heavy)), file=sys.stderr)
+        ok = False
+    if options.max_time is not None and results[core] > options.max_time:
+        print('FAIL: %s import took %.3fs, max %.3fs' % (core, results[core], options.max_time), file=sys.stderr)
+        ok = False
+
+    sys.exit(0 if ok else 1)
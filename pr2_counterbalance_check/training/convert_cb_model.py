@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Converts legacy pickled CB model files (.dat) to the YAML header + .npy format
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+from pr2_counterbalance_check.counterbalance_model import CounterbalanceModel, grid_positions, load_legacy_model, save_model
+
+from optparse import OptionParser
+
+import sys, os, time
+
+import numpy
+
+if __name__ == '__main__':
+    parser = OptionParser("./convert_cb_model.py [options] model.dat [model.dat ...]\n\n" +
+                          "Writes model.yaml and model.npy next to each model.dat. Grid defaults are\n" +
+                          "from config/counterbalance_controller.yaml")
+    parser.add_option("--lift-min", type="float", dest="lift_min", default=-0.2)
+    parser.add_option("--lift-max", type="float", dest="lift_max", default=1.21)
+    parser.add_option("--lift-delta", type="float", dest="lift_delta", default=0.2)
+    parser.add_option("--flex-min", type="float", dest="flex_min", default=-1.8)
+    parser.add_option("--flex-max", type="float", dest="flex_max", default=-0.19)
+    parser.add_option("--flex-delta", type="float", dest="flex_delta", default=0.2)
+    parser.add_option("--lift-joint", dest="lift_joint", default="r_shoulder_lift_joint")
+    parser.add_option("--flex-joint", dest="flex_joint", default="r_elbow_flex_joint")
+
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        parser.error("No model files given")
+
+    lifts = grid_positions(options.lift_min, options.lift_max, options.lift_delta)
+    flexes = grid_positions(options.flex_min, options.flex_max, options.flex_delta)
+
+    for model_file in args:
+        if not os.path.exists(model_file):
+            print("Model file %s does not exist" % model_file, file=sys.stderr)
+            sys.exit(1)
+
+        legacy = load_legacy_model(model_file)
+        metadata = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'converted_from': os.path.basename(model_file) }
+        try:
+            model = CounterbalanceModel(legacy.model, lifts, flexes,
+                                        options.lift_joint, options.flex_joint, metadata)
+        except ValueError as e:
+            print("Unable to convert %s: %s. Check grid options" % (model_file, e), file=sys.stderr)
+            sys.exit(1)
+
+        header_file = os.path.splitext(model_file)[0] + '.yaml'
+        save_model(header_file, model)
+        print('Converted %s to %s' % (model_file, header_file))
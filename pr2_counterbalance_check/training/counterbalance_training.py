@@ -38,60 +38,144 @@
 from __future__ import print_function
 
 PKG = 'pr2_counterbalance_check'
-from pr2_counterbalance_check import *
-
-
-from joint_qualification_controllers.msg import CounterbalanceTestData
+from pr2_counterbalance_check.counterbalance_model import load_model, save_model
+from pr2_counterbalance_check.counterbalance_training import *
 
 from optparse import OptionParser
 
-import sys, os
-
-from ros import rosrecord
-
-import numpy
-
-CB_MSG_TYPE = 'joint_qualification_controllers/CounterbalanceTestData'
-
-def get_data(bag):
-    for topic, msg, t in rosrecord.logplayer(bag):
-        return CounterbalanceAnalysisData(msg)
-
-def print_usage(code = 0):
-    print("./counterbalance_training cb_bag1 cb_bag2 cb_bag3 ...")
-    print("Determines counterbalance adjustments necessary to tune CB")
-    print("Bags must have one message of type %s" % CB_MSG_TYPE)
-    sys.exit(code)
-
-if __name__ == '__main__':
-    if len(sys.argv) < 2 or sys.argv[1] == '-h' or sys.argv[1] == '--help':
-        print_usage(1)
-
-    bags = sys.argv[1:]
-
-    adjustments = {}
-    efforts = {}
+import sys, os, time
+import csv
+import multiprocessing
+
+try:
+    input = raw_input
+except NameError:
+    pass
+
+##\brief Reads manifest, exits on error
+def read_manifest_or_exit(manifest):
+    try:
+        entries = read_manifest(manifest)
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    for e in entries:
+        if not os.path.exists(e.bag):
+            print("Bag %s does not exist. Check filename and retry" % e.bag, file=sys.stderr)
+            sys.exit(1)
+    return entries
+
+REPORT_COLUMNS = [ 'bag', 'leverage', 'rms_residual', 'studentized',
+                   'secondary_error', 'cb_bar_error', 'outlier' ]
+
+##\brief Prints leave-one-out validation of each bag
+def print_report(report):
+    print('%-30s %8s %10s %8s %10s %10s' % ('Bag', 'Leverage', 'Residual', 'Student.', 'Secondary', 'CB Bar'))
+    for r in report.rows():
+        print('%-30s %8.3f %10.4f %8.2f %10.3f %10.3f %s' % (
+                r['bag'][-30:], r['leverage'], r['rms_residual'], r['studentized'],
+                r['secondary_error'], r['cb_bar_error'], 'OUTLIER' if r['outlier'] else ''))
+
+    secondary, cb_bar = report.rms_turn_error()
+    print('Leave-one-out RMS turn error: secondary %.3f, CB bar %.3f' % (secondary, cb_bar))
+    outliers = report.outliers()
+    if outliers:
+        print('%d outlier bags: %s. Check their adjustments, or remove them from training' % (
+                len(outliers), ', '.join(outliers)))
+
+##\brief Asks for adjustments of each bag
+##
+##\return [ TrainingEntry ]
+def prompt_adjustments(bags):
+    entries = []
     print('Enter CB adjustments from "zero" in turns CW for each bag')
     for b in bags:
-        if not os.path.exists(b):
-            print("Bag %s does not exist. Check filename and retry" % b, file=sys.stderr)
-            print_usage(1)
-
         #Ask for adjustments when this bag was taken
         try:
-            adj_secondary = float(raw_input("Please enter secondary adjustment (turns CW) for bag %s: "%b))
-            adj_cb_bar = float(raw_input("Please enter CB bar adjustment (turns CW) for bag %s: "%b))
-            adjustments[b] = (adj_secondary, adj_cb_bar, 1)
-        except:
+            adj_secondary = float(input("Please enter secondary adjustment (turns CW) for bag %s: "%b))
+            adj_cb_bar = float(input("Please enter CB bar adjustment (turns CW) for bag %s: "%b))
+        except ValueError:
             print("Invalid input for adjustment.  Floating point values expected.")
             sys.exit(1)
+        entries.append(TrainingEntry(b, adj_secondary, adj_cb_bar))
+    return entries
 
-        data = get_data(b)
-        efforts[b] = get_efforts(data, True) + get_efforts(data, False)
-    
-    B = numpy.array([efforts[b] for b in bags])
-    A = numpy.array([adjustments[b] for b in bags])
-    X = numpy.linalg.lstsq(A, B)
-    model = X[0]
-    model.dump('counterbalance_model.dat')
-    print('\"counterbalance_model.dat\" contains CB adjustment values')
+if __name__ == '__main__':
+    parser = OptionParser("./counterbalance_training.py [options] [cb_bag1 cb_bag2 cb_bag3 ...]\n\n" +
+                          "Determines counterbalance adjustments necessary to tune CB.\n" +
+                          "Bags must have one message of type %s. Without a manifest,\n" % CB_MSG_TYPE +
+                          "adjustments of each bag are entered at the prompt")
+    parser.add_option("-m", "--manifest", action="store", dest="manifest", default=None,
+                      help="CSV (bag,secondary,cb_bar) or YAML file of bags and adjustments")
+    parser.add_option("-u", "--update", action="store", dest="update", default=None,
+                      help="Add bags to this trained model, instead of training a new model")
+    parser.add_option("-r", "--remove", action="store", dest="remove", default=None,
+                      help="Manifest of bags to remove from the model given with --update, listed as in its training manifest. Removed bags aren't read")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=None,
+                      help="Number of processes reading bags (default number of CPUs)")
+    parser.add_option("--report", action="store", dest="report", default=None,
+                      help="Write leave-one-out validation of each bag to this CSV file")
+    parser.add_option("--screw-tol", action="store", type="float", dest="screw_tol", default=2.0,
+                      help="Bags with leave-one-out secondary error over this are outliers (default 2.0 turns)")
+    parser.add_option("--bar-tol", action="store", type="float", dest="bar_tol", default=0.8,
+                      help="Bags with leave-one-out CB bar error over this are outliers (default 0.8 turns)")
+    parser.add_option("--outlier-threshold", action="store", type="float", dest="outlier_threshold", default=2.0,
+                      help="Bags with studentized residual over this are outliers (default 2.0)")
+    parser.add_option("-o", "--output", action="store", dest="output", default=None,
+                      help="Model header file, data is written next to it as .npy (default counterbalance_model.yaml, or the updated model)")
+    options, args = parser.parse_args()
+
+    if options.remove and not options.update:
+        parser.error("--remove needs the model to update, given with --update")
+
+    if options.manifest:
+        if args:
+            parser.error("Give bags in manifest or on command line, not both")
+        entries = read_manifest_or_exit(options.manifest)
+    elif args:
+        for b in args:
+            if not os.path.exists(b):
+                print("Bag %s does not exist. Check filename and retry" % b, file=sys.stderr)
+                sys.exit(1)
+        entries = prompt_adjustments(args)
+    elif options.remove:
+        entries = []
+    else:
+        parser.error("No bags or manifest given")
+
+    remove = read_manifest_or_exit(options.remove) if options.remove else []
+
+    output = options.output or options.update or 'counterbalance_model.yaml'
+    metadata = { 'date': time.strftime('%Y-%m-%d %H:%M:%S') }
+    validate_args = { 'screw_tol': options.screw_tol, 'bar_tol': options.bar_tol,
+                      'outlier_threshold': options.outlier_threshold }
+
+    pool = multiprocessing.Pool(options.jobs)
+    try:
+        if options.update:
+            model = load_model(options.update)
+            stats = TrainingStats.load(stats_file(options.update))
+            model, stats, report = update_model(model, stats, entries, remove, pool, metadata, **validate_args)
+        else:
+            model, stats, report = train_model(entries, pool, metadata, **validate_args)
+    except (IOError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+
+    if report.bags:
+        print_report(report)
+    if options.report:
+        with open(options.report, 'w') as f:
+            writer = csv.DictWriter(f, REPORT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(report.rows())
+
+    save_model(output, model)
+    stats.save(stats_file(output))
+    print('Model trained from %d bags' % stats.count)
+    print('\"%s\" and \"%s\" contain CB adjustment values, \"%s\" training statistics' % (
+            output, os.path.splitext(output)[0] + '.npy', stats_file(output)))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2010, Willow Garage, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of the Willow Garage nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+##\brief Writes a reduced-grid CB test config and model, from the trained model and archived runs
+##
+## Ex: ./reduce_cb_grid.py -m cb_model.yaml -a fleet_archive -o cb_reduced
+## writes cb_reduced_controller.yaml and the model cb_reduced_model.yaml/.npy,
+## for cb_qual_test.py's ~model_file. Lift and flex effort limits of the
+## config are rescaled to the reduced grid on the same archived runs.
+
+from __future__ import print_function
+
+PKG = 'pr2_counterbalance_check'
+from pr2_counterbalance_check.counterbalance_model import load_model, save_model
+from pr2_counterbalance_check.drift_analysis import model_efforts
+from pr2_counterbalance_check.fleet_archive import FleetArchive
+from pr2_counterbalance_check.reduced_grid import config_limits, find_reduced_grid, reduce_model, reduced_config, reduced_limits
+
+from optparse import OptionParser
+
+import sys, os, time
+
+import numpy
+import yaml
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config', 'counterbalance_controller.yaml')
+
+# Controller runs at 1kHz, one dither point per cycle
+def hold_time(config):
+    for params in config.values():
+        if isinstance(params, dict) and 'settle_time' in params:
+            return params['settle_time'] + params['dither_points'] / 1000.0
+    return 0.0
+
+if __name__ == '__main__':
+    parser = OptionParser("./reduce_cb_grid.py [options] -m model.yaml -o output_prefix")
+    parser.add_option("-m", "--model", action="store", dest="model_file", default=None,
+                      help="Full grid CB model file")
+    parser.add_option("-a", "--archive", action="store", dest="archive", default=None,
+                      help="Fleet archive of runs to score grids with (default ~/.ros/pr2_counterbalance_check/fleet_archive)")
+    parser.add_option("-s", "--side", action="store", dest="side", default=None,
+                      help="Only score with runs of this arm side, right or left")
+    parser.add_option("-c", "--config", action="store", dest="config", default=DEFAULT_CONFIG,
+                      help="Controller config of full grid (default config/counterbalance_controller.yaml)")
+    parser.add_option("--screw-error", action="store", type="float", dest="screw_error", default=0.5,
+                      help="Allowed error of secondary spring adjustment, turns (default 0.5)")
+    parser.add_option("--bar-error", action="store", type="float", dest="bar_error", default=0.2,
+                      help="Allowed error of CB bar adjustment, turns (default 0.2)")
+    parser.add_option("--coverage", action="store", type="float", dest="coverage", default=100.0,
+                      help="Percent of runs that must be within allowed error (default 100)")
+    parser.add_option("--min-lifts", action="store", type="int", dest="min_lifts", default=2,
+                      help="Minimum lift positions of reduced grid (default 2)")
+    parser.add_option("--min-flexes", action="store", type="int", dest="min_flexes", default=2,
+                      help="Minimum flex positions of reduced grid (default 2)")
+    parser.add_option("-o", "--output", action="store", dest="output", default=None,
+                      help="Prefix of output config and model files")
+    options, args = parser.parse_args()
+
+    if not options.model_file:
+        parser.error("No model file given")
+    if not os.path.exists(options.model_file):
+        parser.error("Model file %s does not exist" % options.model_file)
+    if not options.output:
+        parser.error("No output prefix given")
+
+    model = load_model(options.model_file)
+    with open(options.config) as f:
+        config = yaml.safe_load(f)
+
+    archive = FleetArchive(options.archive)
+    mismatch = model.grid_mismatch(archive) if archive.grid_shape() else 'Fleet archive is empty'
+    if mismatch:
+        print('Unable to score grids with %s: %s' % (archive.archive_dir, mismatch), file=sys.stderr)
+        sys.exit(1)
+
+    runs = archive.select(side = options.side)
+    if len(runs) == 0:
+        print('No runs in %s match' % archive.archive_dir, file=sys.stderr)
+        sys.exit(1)
+
+    efforts = archive.efforts()[runs]
+    try:
+        reduced = find_reduced_grid(model, model_efforts(efforts),
+                                    options.screw_error, options.bar_error, options.coverage,
+                                    options.min_lifts, options.min_flexes)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    if reduced is None:
+        print('No reduced grid predicts adjustment within %.2f, %.2f turns on %d runs' % (
+                options.screw_error, options.bar_error, len(runs)), file=sys.stderr)
+        sys.exit(1)
+
+    lift_delta = model.lift_positions[1] - model.lift_positions[0] if len(model.lift_positions) > 1 else 0.0
+    flex_delta = model.flex_positions[1] - model.flex_positions[0] if len(model.flex_positions) > 1 else 0.0
+
+    full_limits = config_limits(config)
+    limits, agreement = reduced_limits(efforts, reduced, full_limits)
+
+    config_file = options.output + '_controller.yaml'
+    with open(config_file, 'w') as f:
+        f.write('# Reduced grid of %s, from %s\n' % (os.path.basename(options.config), os.path.basename(options.model_file)))
+        f.write('# Effort limits rescaled to reduced grid on %d archived runs\n' % len(runs))
+        yaml.safe_dump(reduced_config(config, reduced, lift_delta, flex_delta, limits), f, default_flow_style = False)
+
+    model_file = options.output + '_model.yaml'
+    reduced_model = reduce_model(model, reduced.lift_indices, reduced.flex_indices)
+    reduced_model.metadata['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    reduced_model.metadata['reduced_from']['model'] = os.path.basename(options.model_file)
+    save_model(model_file, reduced_model)
+
+    full_holds = len(model.lift_positions) * len(model.flex_positions)
+    seconds = hold_time(config)
+    print('Lift positions: %s' % ', '.join([ '%.2f' % p for p in reduced.lift_positions ]))
+    print('Flex positions: %s' % ', '.join([ '%.2f' % p for p in reduced.flex_positions ]))
+    print('Holds: %d of %d, about %.0fs of %.0fs per arm' % (
+            reduced.num_holds, full_holds, reduced.num_holds * seconds, full_holds * seconds))
+    print('Max error on %d runs: secondary %.3f, CB bar %.3f turns' % (
+            len(runs), reduced.error[:, 0].max(), reduced.error[:, 1].max()))
+    for joint in ('lift', 'flex'):
+        for name in sorted(limits[joint]):
+            print('%s %s limit: %.3f of full grid is %.3f, same verdict on %.0f%% of runs' % (
+                    joint.capitalize(), name, full_limits[joint][name], limits[joint][name],
+                    100.0 * agreement[joint][name]))
+    print('Wrote %s and %s' % (config_file, model_file))
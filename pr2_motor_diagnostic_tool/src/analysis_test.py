@@ -2,101 +2,209 @@
 import roslib; roslib.load_manifest('pr2_motor_diagnostic_tool')
 from pr2_motor_diagnostic_tool.msg import *
 import os
-from yaml import load
 import argparse
+import multiprocessing
 import matplotlib.pyplot as plt 
 import numpy
-from scipy.stats import scoreatpercentile
 import sys
+if sys.version_info[0] < 3:
+  from StringIO import StringIO
+else:
+  from io import StringIO
+import chunked
+from chunked import ChunkedSignal
+from motor_capture import actuator_name as capture_actuator_name, find_captures, is_capture_file, load_capture
 
 #dictionary of actuators and their torque constants
 r_arm_actuators = ['r_wrist_r_motor','r_wrist_l_motor','r_forearm_roll_motor','r_upper_arm_roll_motor', 'r_elbow_flex_motor','r_shoulder_lift_motor','r_shoulder_pan_motor']
 l_arm_actuators = ['l_wrist_r_motor','l_wrist_l_motor','l_forearm_roll_motor','l_upper_arm_roll_motor', 'l_elbow_flex_motor','l_shoulder_lift_motor','l_shoulder_pan_motor']
 
+# Points per plotted signal, long captures are decimated to this
+PLOT_POINTS = 20000
+
+# Spike signals up to this many samples are checked in one array, longer
+# ones chunk by chunk
+IN_MEMORY_SAMPLES = 1 << 22
+
+# Columns of batch analysis table
+BATCH_COLUMNS = ['capture', 'samples', 'result', 'spikes', 'unplugged', 'open', 'outliers',
+                 'outlier_limit_neg', 'outlier_limit_pos', 'zero_velocity', 'zero_voltage',
+                 'mean_velocity', 'mean_voltage', 'error']
+
+def _outlier_limits(num_neg, q_neg, num_pos, q_pos):
+  """Limits 3 IQR beyond the outer quartile of each sign, 0 for a sign with under 2 samples"""
+  outlier_limit_neg = 0
+  outlier_limit_pos = 0
+  if num_neg > 1:
+    outlier_limit_neg = q_neg[0] - (q_neg[1] - q_neg[0]) * 3
+  if num_pos > 1:
+    outlier_limit_pos = q_pos[1] + (q_pos[1] - q_pos[0]) * 3
+  return (outlier_limit_neg, outlier_limit_pos)
+
+def spike_outliers(spikes, in_memory_samples=IN_MEMORY_SAMPLES):
+  """Finds spikes beyond the outlier limits of their sign
+
+  Spikes is an array, memmap or ChunkedSignal. Signals up to
+  in_memory_samples are read into one array and checked with array
+  operations, longer ones chunk by chunk with exact chunked percentiles.
+  Returns (outlier_index, outlier_limit_neg, outlier_limit_pos, mean_neg,
+  mean_pos), means are None for a sign with under 2 samples."""
+  if len(spikes) <= in_memory_samples:
+    values = numpy.concatenate([numpy.zeros(0)] + list(chunked.chunks(spikes)))
+    is_neg = values < 0
+    is_pos = values > 0
+    neg = values[is_neg]
+    pos = values[is_pos]
+    q_neg = numpy.percentile(neg, [25, 75]) if len(neg) > 1 else None
+    q_pos = numpy.percentile(pos, [25, 75]) if len(pos) > 1 else None
+    (outlier_limit_neg, outlier_limit_pos) = _outlier_limits(len(neg), q_neg, len(pos), q_pos)
+    outlier_index = numpy.flatnonzero((is_neg & (values < outlier_limit_neg)) | (is_pos & (values > outlier_limit_pos)))
+    (num_neg, sum_neg, num_pos, sum_pos) = (len(neg), neg.sum(), len(pos), pos.sum())
+  else:
+    is_neg = lambda c: c < 0
+    is_pos = lambda c: c > 0
+    num_neg = chunked.count(spikes, is_neg)
+    num_pos = chunked.count(spikes, is_pos)
+    q_neg = chunked.percentiles(spikes, [25, 75], is_neg) if num_neg > 1 else None
+    q_pos = chunked.percentiles(spikes, [25, 75], is_pos) if num_pos > 1 else None
+    (outlier_limit_neg, outlier_limit_pos) = _outlier_limits(num_neg, q_neg, num_pos, q_pos)
+
+    index = [numpy.zeros(0, dtype=numpy.int64)]
+    sum_neg = 0.0
+    sum_pos = 0.0
+    for s in chunked.chunk_slices(len(spikes)):
+      c = numpy.asarray(spikes[s])
+      sum_neg += c[c < 0].sum()
+      sum_pos += c[c > 0].sum()
+      index.append(numpy.flatnonzero(((c < 0) & (c < outlier_limit_neg)) | ((c > 0) & (c > outlier_limit_pos))) + s.start)
+    outlier_index = numpy.concatenate(index)
+
+  mean_neg = sum_neg / num_neg if num_neg > 1 else None
+  mean_pos = sum_pos / num_pos if num_pos > 1 else None
+  return (outlier_index, outlier_limit_neg, outlier_limit_pos, mean_neg, mean_pos)
+
 class Diagnostic():
   """Main diagnostic class with methods to get acceleration, check for spikes
-     check for unplugged, check for open circuit and plot graphs"""
+     check for unplugged, check for open circuit and plot graphs
+
+     Statistics of the last checks are kept in stats, for batch tables.
+     If quiet, verdicts are only returned, not printed."""
+
+  def __init__(self, quiet=False):
+    self.quiet = quiet
+    self.stats = {}
   
   def show(self):
     print("gello")
 
   def get_acceleration(self, velocity, timestamp):
-    acceleration = (numpy.array(velocity[1:]) - numpy.array(velocity[:-1])) / (numpy.array(timestamp[1:]) - numpy.array(timestamp[:-1]))
-    acceleration = abs(acceleration)
-    if acceleration.max() == 0:
-       return 0 
-    acceleration = acceleration / acceleration.max()
-    return acceleration
+    """Absolute acceleration normalized to its max, as a ChunkedSignal"""
+    def raw(s):
+      v = numpy.asarray(velocity[s.start:s.stop + 1])
+      t = numpy.asarray(timestamp[s.start:s.stop + 1])
+      return abs(numpy.diff(v) / numpy.diff(t))
+
+    n = max(len(velocity) - 1, 0)
+    acc_max = chunked.abs_max(ChunkedSignal(n, raw))
+    if acc_max == 0:
+      return ChunkedSignal(n, lambda s: numpy.zeros(s.stop - s.start))
+    return ChunkedSignal(n, lambda s: raw(s) / acc_max)
 
   def check_for_spikes(self, spikes, actuator_name, debug_info):
-    outlier_limit_neg = 0
-    outlier_limit_pos = 0
-    neg = [val for val in spikes if val < 0]
-    pos = [val for val in spikes if val > 0]
-
-    neg = numpy.sort(neg,kind='mergesort')
-    pos = numpy.sort(pos,kind='mergesort')
-    
-    if (len(neg) > 1):
-      iq_range_neg = scoreatpercentile(neg,-75) - scoreatpercentile(neg,-25)
-      outlier_limit_neg = iq_range_neg * 3 + scoreatpercentile(neg,-75)
-
-    if (len(pos) > 1):
-      iq_range_pos = scoreatpercentile(pos,75) - scoreatpercentile(pos,25)
-      outlier_limit_pos = iq_range_pos * 3 + scoreatpercentile(pos,75)
+    """Returns (spoilt, outlier_limit_neg, outlier_limit_pos, outlier_index)"""
+    (outlier_index, outlier_limit_neg, outlier_limit_pos, mean_neg, mean_pos) = spike_outliers(spikes)
 
     if debug_info:  
-      if (len(neg) > 1):
-        print("neg mean",neg.mean())
+      if mean_neg is not None:
+        print("neg mean",mean_neg)
         print("neg outlier limit",outlier_limit_neg)
       
-      if (len(pos) > 1):
-        print("pos mean",pos.mean())
+      if mean_pos is not None:
+        print("pos mean",mean_pos)
         print("pos outlier limit",outlier_limit_pos)
 
-    outliers_neg = [val for val in neg if val < outlier_limit_neg]
-    outliers_pos = [val for val in pos if val > outlier_limit_pos]
-
     if debug_info: 
-      print("outliers in filtered data", outliers_neg, outliers_pos)
+      outliers = numpy.sort(chunked.take(spikes, outlier_index))
+      print("outliers in filtered data", outliers[outliers < 0].tolist(), outliers[outliers > 0].tolist())
+
+    self.stats.update(outliers=len(outlier_index),
+                      outlier_limit_neg=outlier_limit_neg, outlier_limit_pos=outlier_limit_pos)
 
-    if (len(outliers_neg) + len(outliers_pos)) > 4:
-      print("Encoder could be spoilt for,", actuator_name)
-      return (True, outlier_limit_neg, outlier_limit_pos)
+    if len(outlier_index) > 4:
+      if not self.quiet:
+        print("Encoder could be spoilt for,", actuator_name)
+      return (True, outlier_limit_neg, outlier_limit_pos, outlier_index)
 
-    return (False, outlier_limit_neg, outlier_limit_pos)
+    return (False, outlier_limit_neg, outlier_limit_pos, outlier_index)
 
   def check_for_unplugged(self, velocity, measured_motor_voltage, actuator_name, debug_info):
-    zero_velocity = [val for val in velocity if val == 0]
-    zero_voltage = [val for val in measured_motor_voltage if val == 0]
-    zero_velocity = len(zero_velocity) / (len(velocity) + 0.0)
-    zero_voltage = len(zero_voltage) / (len(measured_motor_voltage) + 0.0)
+    zero_velocity = chunked.count(velocity, lambda c: c == 0)
+    zero_voltage = chunked.count(measured_motor_voltage, lambda c: c == 0)
+    zero_velocity = zero_velocity / (len(velocity) + 0.0)
+    zero_voltage = zero_voltage / (len(measured_motor_voltage) + 0.0)
+    self.stats.update(zero_velocity=zero_velocity, zero_voltage=zero_voltage)
     if debug_info:
       print("percentage of zero velocity is", zero_velocity)
       print("percentage of zero voltage is", zero_voltage)
 
     if zero_velocity > 2 and zero_voltage < 0.5:
-      print("Encoder could be unplugged for, ", actuator_name)
+      if not self.quiet:
+        print("Encoder could be unplugged for, ", actuator_name)
       return True
     return False
 
   def check_for_open(self, velocity, measured_motor_voltage, actuator_name, debug_info):
-    measured_motor_voltage = abs(measured_motor_voltage)
-    velocity = abs(velocity)
-    mean_voltage = measured_motor_voltage.mean()
-    mean_velocity = velocity.mean()
+    mean_voltage = chunked.abs_mean(measured_motor_voltage)
+    mean_velocity = chunked.abs_mean(velocity)
+    self.stats.update(mean_voltage=mean_voltage, mean_velocity=mean_velocity)
     if debug_info:
       print("mean_voltage is ",mean_voltage)
       print("mean_velocity is ",mean_velocity)
 
     if mean_voltage < 0.05:
       if mean_velocity > 0.3:
-        print("Motor wires could be cut causing open circuit, ", actuator_name)
+        if not self.quiet:
+          print("Motor wires could be cut causing open circuit, ", actuator_name)
         return True
     return False
 
+  def analyze(self, capture, actuator_name, debug_info):
+    """Runs all checks on a motor_capture.Capture, returns (result, plot param)
+
+    Signals are worked through in chunks, so memory-mapped captures of any
+    length are analyzed in flat memory."""
+    velocity = capture.velocity
+    measured_motor_voltage = capture.measured_motor_voltage
+
+    acceleration = self.get_acceleration(velocity, capture.timestamp)
+
+    spikes = ChunkedSignal(len(acceleration), lambda s: acceleration[s] * numpy.asarray(velocity[s]))
+
+    (result1, outlier_limit_neg, outlier_limit_pos, outlier_index) = self.check_for_spikes(spikes, actuator_name, debug_info)
+    result2 = self.check_for_unplugged(velocity, measured_motor_voltage, actuator_name, debug_info)
+    result3 = self.check_for_open(velocity, measured_motor_voltage, actuator_name, debug_info)
+    result = result1 or result2 or result3
+
+    param = (actuator_name,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos,outlier_index,capture.supply_voltage,measured_motor_voltage,capture.executed_current,capture.measured_current, result1, result2, result3)
+    return (result, param)
+
+  def plot_series(self, param):
+    """Signals of plot param decimated to PLOT_POINTS, keeping the min and max of each bucket
+
+    The result is small and picklable, so it can be drawn in another process."""
+    (filename,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos,outlier_index,supply_voltage, measured_motor_voltage,executed_current, measured_current, r1, r2, r3) = param
+    signals = [chunked.decimate(signal, PLOT_POINTS) for signal in
+               (velocity, spikes, acceleration, supply_voltage, measured_motor_voltage, executed_current, measured_current)]
+    outliers = (outlier_index, chunked.take(spikes, outlier_index))
+    return (filename, len(velocity), signals, outlier_limit_neg, outlier_limit_pos, outliers, r1, r2, r3)
+
   def plot(self, param):
-    (filename,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos,supply_voltage, measured_motor_voltage,executed_current, measured_current, r1, r2, r3) = param
+    self.draw(self.plot_series(param))
+
+  def draw(self, series):
+    """Draws figures of plot_series() output"""
+    (filename, length, signals, outlier_limit_neg, outlier_limit_pos, outliers, r1, r2, r3) = series
+    (velocity, spikes, acceleration, supply_voltage, measured_motor_voltage, executed_current, measured_current) = signals
     global plot_enabled
     plot_enabled = True
      
@@ -105,22 +213,21 @@ class Diagnostic():
         fig1.suptitle("The encoder might be spoilt", fontsize=14)
 
     plt.subplot(311)
-    plt.plot(velocity,label='velocity')
+    plt.plot(*velocity, label='velocity')
     plt.legend()
 
-    temp_neg = outlier_limit_neg
-    temp_pos = outlier_limit_pos
-    outlier_limit_neg = [temp_neg for val in range(0,len(velocity))]
-    outlier_limit_pos = [temp_pos for val in range(0,len(velocity))]
+    limit_index = [0, max(length - 1, 0)]
 
     plt.subplot(312)
-    plt.plot(spikes,label='acceleration * velocity')
-    plt.plot(outlier_limit_neg,'r')
-    plt.plot(outlier_limit_pos,'r')
+    plt.plot(*spikes, label='acceleration * velocity')
+    plt.plot(limit_index, [outlier_limit_neg] * 2, 'r')
+    plt.plot(limit_index, [outlier_limit_pos] * 2, 'r')
+    if len(outliers[0]):
+      plt.plot(*outliers, color='r', marker='x', linestyle='', label='outliers')
     plt.legend()
 
     plt.subplot(313)
-    plt.plot(acceleration,'g', label='acceleration')
+    plt.plot(*acceleration, color='g', label='acceleration')
     plt.legend()
 
     fig2 = plt.figure(filename + '_2')
@@ -129,18 +236,88 @@ class Diagnostic():
     if r3:
         fig2.suptitle("The motor wires might be cut", fontsize=14)
 
-    plt.plot(supply_voltage,'b',label='supply_voltage')
-    plt.plot(measured_motor_voltage,'g',label='measured_motor_voltage')
-    plt.plot(executed_current,'*y',label='executed_current')
-    plt.plot(measured_current,'m',label='measured_current')
+    plt.plot(*supply_voltage, color='b', label='supply_voltage')
+    plt.plot(*measured_motor_voltage, color='g', label='measured_motor_voltage')
+    plt.plot(*executed_current, color='y', marker='*', linestyle='', label='executed_current')
+    plt.plot(*measured_current, color='m', label='measured_current')
     plt.legend() 
 
+
+def capture_names(filenames):
+  """Display names of captures, actuator names under their directory relative to the common one"""
+  dirs = [os.path.dirname(os.path.abspath(f)) for f in filenames]
+  base = os.path.dirname(os.path.commonprefix([d + os.sep for d in dirs]))
+  return [os.path.normpath(os.path.join(os.path.relpath(d, base), capture_actuator_name(f)))
+          for d, f in zip(dirs, filenames)]
+
+def analyze_capture(args):
+  """Analyzes one capture for a batch, runs in a worker process
+
+  Returns (row, plot series, debug output). Row is keyed by BATCH_COLUMNS,
+  plot series is None unless plot is 'all', or 'bad' and a check failed.
+  Debug output is printed by the parent, so lines of captures don't interleave."""
+  filename, name, plot, debug_info = args
+  row = dict.fromkeys(BATCH_COLUMNS, '')
+  row['capture'] = name
+  row['result'] = 'ERROR'
+  series = None
+  stdout = sys.stdout
+  sys.stdout = output = StringIO()
+  try:
+    if debug_info:
+      print(name)
+    capture = load_capture(filename)
+    diagnostic = Diagnostic(quiet=True)
+    (result, param) = diagnostic.analyze(capture, name, debug_info)
+    row.update(diagnostic.stats)
+    row['samples'] = len(capture)
+    row['result'] = 'BAD' if result else 'OK'
+    row['spikes'], row['unplugged'], row['open'] = param[-3:]
+    if plot == 'all' or (plot == 'bad' and result):
+      series = diagnostic.plot_series(param)
+  except Exception as e:
+    row['error'] = 'Unable to analyze %s: %s' % (filename, e)
+  finally:
+    sys.stdout = stdout
+  return (row, series, output.getvalue())
+
+def analyze_captures(filenames, jobs=None, plot=None, debug_info=False):
+  """Analyzes captures across a process pool, returns [(row, plot series, debug output)] in order of filenames
+
+  With one job, captures are analyzed in this process, without forking."""
+  if not filenames:
+    return []
+  args = [(f, name, plot, debug_info) for f, name in zip(filenames, capture_names(filenames))]
+  if jobs == 1:
+    return [analyze_capture(a) for a in args]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(analyze_capture, args, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+def format_table(rows):
+  """Batch analysis rows as a text table, one line per capture"""
+  def cell(value):
+    if isinstance(value, bool):
+      return 'FAIL' if value else 'ok'
+    if isinstance(value, float):
+      return '%.4g' % value
+    return str(value)
+
+  cells = [BATCH_COLUMNS] + [[cell(row[c]) for c in BATCH_COLUMNS] for row in rows]
+  widths = [max(len(r[i]) for r in cells) for i in range(len(BATCH_COLUMNS))]
+  return '\n'.join('  '.join(c.ljust(w) for c, w in zip(r, widths)).rstrip() for r in cells)
+
     
 if __name__ == '__main__':
   parser = argparse.ArgumentParser("script to analyse diagnostic data for PR2")
   parser.add_argument("files", help="Specify a file name or a folder with files to analyse")
   parser.add_argument("-d","--display", help="display graphs for only bad results", action="store_true")
   parser.add_argument("-v","--verbose",help="print all debug information",action="store_true")
+  parser.add_argument("-b","--batch",help="analyze all captures under the folder in parallel, print a summary table",action="store_true")
+  parser.add_argument("-j","--jobs",help="number of worker processes for batch analysis (default number of CPUs)",type=int,default=None)
   args = parser.parse_args()
   
   positional_args = args.files.split(".")
@@ -149,11 +326,30 @@ if __name__ == '__main__':
   plot_enabled = False
   diagnostic = Diagnostic()
 
-  if (positional_args[-1] == 'yaml'):
+  if args.batch:
+    captures = find_captures([args.files])
+    if not captures:
+      print("No captures found in %s" % args.files)
+      sys.exit(1)
+    results = analyze_captures(captures, args.jobs, 'bad' if args.display else 'all', args.verbose)
+    for row, series, output in results:
+      sys.stdout.write(output)
+    rows = [row for row, series, output in results]
+    print(format_table(rows))
+    num_bad = len([row for row in rows if row['result'] != 'OK'])
+    print("Analyzed %d captures: %d OK, %d BAD or ERROR" % (len(rows), len(rows) - num_bad, num_bad))
+    for row, series, output in results:
+      if series is not None:
+        diagnostic.draw(series)
+    if plot_enabled:
+      plt.show()
+    sys.exit(1 if num_bad else 0)
+
+  if (positional_args[-1] in ('yaml', 'npz', 'capture')):
     filelist.append(".".join(positional_args)) 
   else:
     dirpath = os.getcwd() + '/' + positional_args[0]  
-    filelist = os.listdir(dirpath)
+    filelist = [f for f in sorted(os.listdir(dirpath)) if is_capture_file(f)]
     os.chdir(dirpath)
 
   debug_info = args.verbose
@@ -163,53 +359,18 @@ if __name__ == '__main__':
 
   for filename in filelist:
     print("\n")
-    actuator_name = filename[:-13]
+    actuator_name = capture_actuator_name(filename)
 
     if debug_info:
       print(actuator_name)
 
-    stream = file(filename, 'r')
-    samples = load(stream)
-    velocity = []
-    encoder_position = []
-    supply_voltage = []
-    measured_motor_voltage = []
-    executed_current = []
-    measured_current = []
-    timestamp = []
-
-    for s in samples.sample_buffer:
-      velocity.append(s.velocity)
-      encoder_position.append(s.encoder_position)
-      supply_voltage.append(s.supply_voltage)
-      measured_motor_voltage.append(s.measured_motor_voltage)
-      executed_current.append(s.executed_current)
-      measured_current.append(s.measured_current)
-      timestamp.append(s.timestamp)
-
-    velocity = numpy.array(velocity)
-    encoder_position = numpy.array(encoder_position)
-   
-    supply_voltage = numpy.array(supply_voltage)
-    measured_motor_voltage = numpy.array(measured_motor_voltage)
-    executed_current = numpy.array(executed_current)
-    measured_current = numpy.array(measured_current)
-
-    acceleration = diagnostic.get_acceleration(velocity, timestamp)
-
-    spikes = acceleration * (velocity[:-1])
-
-    (result1, outlier_limit_neg, outlier_limit_pos) = diagnostic.check_for_spikes(spikes, actuator_name, debug_info) 
-    result2 = diagnostic.check_for_unplugged(velocity, measured_motor_voltage, actuator_name, debug_info)
-    result3 = diagnostic.check_for_open(velocity, measured_motor_voltage, actuator_name, debug_info)
-    result = result1 or  result2 or result3
+    capture = load_capture(filename)
+    (result, param) = diagnostic.analyze(capture, actuator_name, debug_info)
 
     if args.display:
       if result:
-        param = (filename,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos, result1, result2, result3)
         diagnostic.plot(param)
     else:
-      param = (filename,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos, result1, result2, result3)
       diagnostic.plot(param)
   
   if plot_enabled:  
@@ -0,0 +1,156 @@
+"""Fixed-size chunk processing of long signals, for flat peak memory.
+
+Signals are arrays, memory-mapped arrays, or ChunkedSignal, which computes a
+derived signal one chunk at a time. Checks only ever hold one chunk of a
+signal, plus small per-chunk results.
+"""
+import numpy
+
+CHUNK_SIZE = 1 << 16
+
+# Order statistics are selected from at most this many values in memory
+_MAX_SELECT = CHUNK_SIZE
+
+_HISTOGRAM_BINS = 1024
+
+
+class ChunkedSignal(object):
+  """Signal computed one chunk at a time, by chunk_fn(slice)"""
+
+  def __init__(self, length, chunk_fn):
+    self.length = length
+    self.chunk_fn = chunk_fn
+
+  def __len__(self):
+    return self.length
+
+  def __getitem__(self, s):
+    start, stop, step = s.indices(self.length)
+    return self.chunk_fn(slice(start, max(start, stop)))
+
+
+def chunk_slices(length, chunk_size=CHUNK_SIZE):
+  for start in range(0, length, chunk_size):
+    yield slice(start, min(start + chunk_size, length))
+
+
+def chunks(signal, chunk_size=CHUNK_SIZE):
+  """Chunks of an array, memmap or ChunkedSignal, as in-memory arrays"""
+  for s in chunk_slices(len(signal), chunk_size):
+    yield numpy.asarray(signal[s])
+
+
+def count(signal, condition, chunk_size=CHUNK_SIZE):
+  """Number of samples where condition(chunk) is True"""
+  return sum(int(numpy.count_nonzero(condition(c))) for c in chunks(signal, chunk_size))
+
+
+def abs_mean(signal, chunk_size=CHUNK_SIZE):
+  if len(signal) == 0:
+    return 0.0
+  return sum(float(abs(c).sum()) for c in chunks(signal, chunk_size)) / len(signal)
+
+
+def abs_max(signal, chunk_size=CHUNK_SIZE):
+  return max([float(abs(c).max()) for c in chunks(signal, chunk_size) if len(c)] or [0.0])
+
+
+def take(signal, index, chunk_size=CHUNK_SIZE):
+  """Values of signal at index, reading only the chunks holding them"""
+  index = numpy.asarray(index, dtype=numpy.int64)
+  values = numpy.zeros(len(index))
+  chunk = index // chunk_size
+  for c in numpy.unique(chunk):
+    at = chunk == c
+    start = int(c) * chunk_size
+    values[at] = numpy.asarray(signal[start:start + chunk_size])[index[at] - start]
+  return values
+
+
+def _order_statistic(signal, select, k, chunk_size):
+  """k-th smallest of the selected samples, exact, in histogram-narrowing passes"""
+  lo, hi = -numpy.inf, numpy.inf
+  below = 0
+  while True:
+    vmin, vmax, inside = numpy.inf, -numpy.inf, 0
+    for c in chunks(signal, chunk_size):
+      v = c[select(c) & (c >= lo) & (c < hi)]
+      if len(v):
+        vmin = min(vmin, v.min())
+        vmax = max(vmax, v.max())
+        inside += len(v)
+
+    if vmin == vmax:
+      return vmin
+
+    if inside <= _MAX_SELECT:
+      values = numpy.concatenate([c[select(c) & (c >= lo) & (c < hi)] for c in chunks(signal, chunk_size)])
+      return numpy.sort(values)[k - below]
+
+    edges = numpy.linspace(vmin, vmax, _HISTOGRAM_BINS + 1)
+    hist = numpy.zeros(_HISTOGRAM_BINS, dtype=numpy.int64)
+    for c in chunks(signal, chunk_size):
+      v = c[select(c) & (c >= lo) & (c < hi)]
+      hist += numpy.histogram(v, edges)[0]
+
+    cum = numpy.cumsum(hist)
+    b = int(numpy.searchsorted(cum, k - below, side='right'))
+    below += int(cum[b - 1]) if b > 0 else 0
+    lo = edges[b]
+    # numpy.histogram's last bin includes vmax
+    hi = edges[b + 1] if b + 1 < _HISTOGRAM_BINS else numpy.nextafter(vmax, numpy.inf)
+
+
+def percentiles(signal, q, select=None, chunk_size=CHUNK_SIZE):
+  """Percentiles of the selected samples, linearly interpolated as numpy.percentile
+
+  select(chunk) is a boolean mask of samples to include, all if None.
+  Returns an array of nan if no samples are selected."""
+  if select is None:
+    select = lambda c: numpy.ones(len(c), dtype=bool)
+  n = count(signal, select, chunk_size)
+  q = numpy.atleast_1d(numpy.asarray(q, dtype=numpy.float64))
+  if n == 0:
+    return numpy.nan * q
+
+  # In-memory signals are small enough to sort directly
+  if n <= _MAX_SELECT:
+    values = numpy.concatenate([c[select(c)] for c in chunks(signal, chunk_size)])
+    return numpy.percentile(values, q)
+
+  results = []
+  for p in q:
+    pos = p / 100.0 * (n - 1)
+    k = int(numpy.floor(pos))
+    low = _order_statistic(signal, select, k, chunk_size)
+    frac = pos - k
+    if frac == 0:
+      results.append(low)
+    else:
+      high = _order_statistic(signal, select, k + 1, chunk_size)
+      results.append(low + frac * (high - low))
+  return numpy.array(results)
+
+
+def decimate(signal, points, chunk_size=CHUNK_SIZE):
+  """Min/max envelope of a signal in about points samples, for plotting
+
+  Returns (index, values)."""
+  n = len(signal)
+  if n <= points:
+    return numpy.arange(n), numpy.asarray(signal[0:n])
+
+  bucket = int(numpy.ceil(2.0 * n / points))
+  # Whole buckets per chunk, so no bucket spans chunks
+  chunk_size = max(bucket, chunk_size - chunk_size % bucket)
+  index = []
+  values = []
+  for s in chunk_slices(n, chunk_size):
+    c = numpy.asarray(signal[s])
+    for start in range(0, len(c), bucket):
+      b = c[start:start + bucket]
+      i_min, i_max = int(b.argmin()), int(b.argmax())
+      for i in sorted(set([i_min, i_max])):
+        index.append(s.start + start + i)
+        values.append(b[i])
+  return numpy.array(index), numpy.array(values)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+from motor_capture import YAML_SUFFIX, capture_filename, actuator_name, convert_yaml_capture
+
+def find_yaml_captures(paths):
+  files = []
+  for path in paths:
+    if os.path.isfile(path):
+      files.append(path)
+      continue
+    for root, dirs, names in os.walk(path):
+      dirs.sort()
+      files.extend([os.path.join(root, f) for f in sorted(names) if f.endswith(YAML_SUFFIX)])
+  return files
+
+def capture_size(path):
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+  return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser("script to convert YAML diagnostic data captures to .npz or memory-mapped captures")
+  parser.add_argument("paths", nargs='+', help="Capture files or folders to search for *" + YAML_SUFFIX)
+  parser.add_argument("-f","--force", help="overwrite existing captures", action="store_true")
+  parser.add_argument("-m","--memmap", help="write memory-mapped capture directories, for long captures", action="store_true")
+  args = parser.parse_args()
+
+  yaml_size = 0
+  total_size = 0
+  failed = 0
+  for yaml_file in find_yaml_captures(args.paths):
+    capture_file = capture_filename(actuator_name(yaml_file), os.path.dirname(yaml_file), args.memmap)
+    if os.path.exists(capture_file) and not args.force:
+      print("%s exists, skipping" % capture_file)
+      continue
+    try:
+      convert_yaml_capture(yaml_file, capture_file)
+    except Exception as e:
+      print("Unable to convert %s: %s" % (yaml_file, e))
+      failed += 1
+      continue
+    yaml_size += os.path.getsize(yaml_file)
+    total_size += capture_size(capture_file)
+    print("%s -> %s" % (yaml_file, capture_file))
+
+  if total_size:
+    print("Converted %.1f kB of YAML to %.1f kB, %.1fx smaller" % (yaml_size / 1024.0, total_size / 1024.0, float(yaml_size) / total_size))
+  if failed:
+    sys.exit(1)
@@ -1,11 +1,11 @@
 import os
+import sys
 import datetime
 from get_diagnostic_data import *
-from analysis_test import Diagnostic
-from yaml import load
+from analysis_test import Diagnostic, analyze_captures, format_table
+from motor_capture import is_capture_file
 import matplotlib.pyplot as plt
 import numpy
-from scipy.stats import scoreatpercentile
 
 from python_qt_binding import loadUi
 from python_qt_binding.QtCore import qWarning, Qt
@@ -165,62 +165,23 @@ class DiagnosticToolWidget(QWidget):
         debug_info = self.debug_info_bool
         bad_results = self.bad_results_bool
 
-        for filename in self.filelist:
-            actuator_name  = os.path.basename(filename) 
-            if debug_info:
-                print("\n" + str(actuator_name))
-            stream = file(filename, 'r')
-            samples = load(stream)
-            velocity = []
-            encoder_position = []
-            supply_voltage = []
-            measured_motor_voltage = []
-            executed_current = []
-            measured_current = []
-            timestamp = []
-
-            for s in samples.sample_buffer:
-                velocity.append(s.velocity)
-                encoder_position.append(s.encoder_position)
-                supply_voltage.append(s.supply_voltage)
-                measured_motor_voltage.append(s.measured_motor_voltage)
-                executed_current.append(s.executed_current)
-                measured_current.append(s.measured_current)
-                timestamp.append(s.timestamp)
-
-            velocity = numpy.array(velocity)
-            encoder_position = numpy.array(encoder_position)
-           
-            supply_voltage = numpy.array(supply_voltage)
-            measured_motor_voltage = numpy.array(measured_motor_voltage)
-            executed_current = numpy.array(executed_current)
-            measured_current = numpy.array(measured_current)
-
-            acceleration = diagnostic.get_acceleration(velocity, timestamp)
-
-            spikes = acceleration * (velocity[:-1])
-
-            (result1, outlier_limit_neg, outlier_limit_pos) = diagnostic.check_for_spikes(spikes, actuator_name, debug_info)
-            result2 = diagnostic.check_for_unplugged(velocity, measured_motor_voltage, actuator_name, debug_info)
-            result3 = diagnostic.check_for_open(velocity, measured_motor_voltage, actuator_name, debug_info)
-            result = result1 or result2 or result3
-
-            if bad_results:
-                if result: 
-                    param = (actuator_name,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos,supply_voltage,measured_motor_voltage,executed_current,measured_current, result1, result2, result3)
-                    self.plots.append(actuator_name +'_1')
-                    self.plots.append(actuator_name +'_2')
-                    diagnostic.plot(param)
-            else:
-                param = (actuator_name,velocity,spikes,acceleration,outlier_limit_neg,outlier_limit_pos,supply_voltage,measured_motor_voltage,executed_current,measured_current, result1, result2, result3)
-                self.plots.append(actuator_name +'_1')
-                self.plots.append(actuator_name +'_2')
-                diagnostic.plot(param)
+        # Forking the Qt process for a pool can deadlock, captures are
+        # analyzed one after another
+        results = analyze_captures(self.filelist, 1, 'bad' if bad_results else 'all', debug_info)
+        for row, series, output in results:
+            sys.stdout.write(output)
+        print(format_table([row for row, series, output in results]))
+
+        for row, series, output in results:
+            if series is not None:
+                self.plots.append(series[0] + '_1')
+                self.plots.append(series[0] + '_2')
+                diagnostic.draw(series)
 
         plt.show()    
 
     def load_file(self):
-        filename = QFileDialog.getOpenFileName(self, self.tr("Open File"), "../", self.tr("Yaml (*.yaml)"))
+        filename = QFileDialog.getOpenFileName(self, self.tr("Open File"), "../", self.tr("Captures (*_results.npz *_results.yaml)"))
         if os.path.basename(filename[0].encode("ascii")) == "":
             return
 
@@ -234,9 +195,10 @@ class DiagnosticToolWidget(QWidget):
         if directory == '': 
             return 
 
-        temp = [f.encode("ascii") for f in os.listdir(directory)]
+        captures = [f for f in sorted(os.listdir(directory)) if is_capture_file(f)]
+        temp = [f.encode("ascii") for f in captures]
         self.filenames.extend(temp)
-        temp = [directory + '/' + filepath for filepath in os.listdir(directory)]
+        temp = [directory + '/' + filepath for filepath in captures]
         self.filelist.extend(temp)
         self.fileLabel.setText('Files: ' + str(self.filenames))
         self.fileLabel.setWordWrap(True)        
@@ -8,7 +8,7 @@ from sensor_msgs.msg import Joy
 import time
 import sys
 import argparse
-from yaml import dump
+from motor_capture import LONG_CAPTURE_SAMPLES, capture_filename, samples_to_capture, save_capture
 
 load_controller = rospy.ServiceProxy('pr2_controller_manager/load_controller', LoadController)
 unload_controller = rospy.ServiceProxy('pr2_controller_manager/unload_controller',UnloadController)
@@ -54,8 +54,8 @@ def get_diag_data(actuator_name):
 
     foo = DiagnosticDataRequest();
     rv = get_data(foo)
-    stream = file(str(actuator_name) + "_results" + '.yaml', 'w')
-    dump(rv,stream)
+    capture = samples_to_capture(str(actuator_name), rv.sample_buffer, {'capture_time': time.time()})
+    save_capture(capture_filename(actuator_name, memmap=len(capture) > LONG_CAPTURE_SAMPLES), capture)
 
     switch_controller([],['diagnostic_controller'], SwitchControllerRequest.STRICT)
     rospy.loginfo("stopped diagnostic_controller")
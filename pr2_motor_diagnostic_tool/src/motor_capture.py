@@ -0,0 +1,360 @@
+"""Columnar capture files of motor diagnostic samples.
+
+A capture holds one array per MotorSample field, plus the actuator name and
+capture metadata, in a compressed .npz file. Loading a capture is a single
+read, with no per-sample Python objects.
+
+Long captures are a directory instead, with a raw file per field and a YAML
+header. Its fields are memory-mapped on load, so checks can work through
+them in chunks with flat memory.
+
+Captures written before this format are YAML dumps of the DiagnosticData
+response. load_yaml_capture() reads those without the message classes, and
+convert_yaml_capture() rewrites them as .npz or a capture directory.
+"""
+import os
+import numpy
+import yaml
+
+from chunked import CHUNK_SIZE, chunk_slices
+
+CAPTURE_VERSION = 1
+
+CAPTURE_SUFFIX = '_results.npz'
+MEMMAP_SUFFIX = '_results.capture'
+YAML_SUFFIX = '_results.yaml'
+CAPTURE_SUFFIXES = (CAPTURE_SUFFIX, MEMMAP_SUFFIX, YAML_SUFFIX)
+
+# Captures with more samples are written as memory-mapped directories
+LONG_CAPTURE_SAMPLES = 1000000
+
+# MotorSample fields, in message order
+SAMPLE_FIELDS = [('timestamp', numpy.float64),
+                 ('enabled', numpy.bool_),
+                 ('supply_voltage', numpy.float64),
+                 ('measured_motor_voltage', numpy.float64),
+                 ('programmed_pwm', numpy.float64),
+                 ('executed_current', numpy.float64),
+                 ('measured_current', numpy.float64),
+                 ('velocity', numpy.float64),
+                 ('encoder_position', numpy.float64),
+                 ('encoder_error_count', numpy.uint64)]
+
+FIELD_NAMES = [name for name, dtype in SAMPLE_FIELDS]
+
+
+class Capture(object):
+  """Samples of one actuator, one array per MotorSample field"""
+
+  def __init__(self, actuator_name, fields, metadata=None):
+    self.actuator_name = actuator_name
+    self.metadata = metadata or {}
+    for name, dtype in SAMPLE_FIELDS:
+      setattr(self, name, numpy.asarray(fields[name], dtype=dtype))
+
+  def __len__(self):
+    return len(self.timestamp)
+
+
+def capture_filename(actuator_name, directory='', memmap=False):
+  suffix = MEMMAP_SUFFIX if memmap else CAPTURE_SUFFIX
+  return os.path.join(directory, str(actuator_name) + suffix)
+
+
+def actuator_name(filename):
+  """Actuator name of a capture file, from its name"""
+  name = os.path.basename(os.path.normpath(filename))
+  for suffix in CAPTURE_SUFFIXES:
+    if name.endswith(suffix):
+      return name[:-len(suffix)]
+  return os.path.splitext(name)[0]
+
+
+def is_capture_file(filename):
+  """Capture file or directory by name, config and other YAML files are not"""
+  return os.path.normpath(filename).endswith(CAPTURE_SUFFIXES)
+
+
+def find_captures(paths):
+  """Captures given, or under given directories, for a tree of capture sessions"""
+  captures = []
+  for path in paths:
+    if os.path.isfile(path) or os.path.normpath(path).endswith(MEMMAP_SUFFIX):
+      captures.append(path)
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      captures.extend([os.path.join(root, d) for d in dirs if d.endswith(MEMMAP_SUFFIX)])
+      dirs[:] = [d for d in dirs if not d.endswith(MEMMAP_SUFFIX)]
+      captures.extend([os.path.join(root, f) for f in sorted(files) if f.endswith(CAPTURE_SUFFIXES)])
+  return captures
+
+
+def samples_to_capture(actuator_name, sample_buffer, metadata=None):
+  """Capture from a list of MotorSample messages"""
+  fields = {}
+  for name, dtype in SAMPLE_FIELDS:
+    fields[name] = numpy.fromiter((getattr(s, name) for s in sample_buffer), dtype=dtype,
+                                  count=len(sample_buffer))
+  return Capture(actuator_name, fields, metadata)
+
+
+def save_capture(filename, capture):
+  """Write capture as .npz, or as a capture directory if filename ends with MEMMAP_SUFFIX"""
+  if os.path.normpath(filename).endswith(MEMMAP_SUFFIX):
+    writer = CaptureWriter(filename, capture.actuator_name, capture.metadata)
+    for s in chunk_slices(len(capture)):
+      writer.append(dict((name, getattr(capture, name)[s]) for name in FIELD_NAMES))
+    return
+
+  arrays = dict((name, getattr(capture, name)) for name in FIELD_NAMES)
+  numpy.savez_compressed(filename,
+                         format_version=numpy.array(CAPTURE_VERSION),
+                         actuator_name=numpy.array(capture.actuator_name),
+                         metadata=numpy.array(yaml.safe_dump(capture.metadata)),
+                         **arrays)
+
+
+def load_capture(filename):
+  """Load capture file, .npz, capture directory or legacy .yaml
+
+  Fields of capture directories are memory-mapped, read only. The header
+  of a capture directory opens the directory."""
+  if os.path.isdir(filename):
+    return open_capture_dir(filename)
+  if filename.endswith(os.path.join(MEMMAP_SUFFIX, 'capture.yaml')):
+    return open_capture_dir(os.path.dirname(filename))
+  if filename.endswith('.yaml'):
+    return load_yaml_capture(filename)
+
+  with numpy.load(filename) as npz:
+    version = int(npz['format_version'])
+    if version > CAPTURE_VERSION:
+      raise ValueError('Capture %s has version %d, only versions up to %d are supported' %
+                       (filename, version, CAPTURE_VERSION))
+    fields = dict((name, npz[name]) for name in FIELD_NAMES)
+    name = str(npz['actuator_name'])
+    metadata = yaml.safe_load(str(npz['metadata'])) or {}
+  return Capture(name, fields, metadata)
+
+
+def _header_file(dirname):
+  return os.path.join(dirname, 'capture.yaml')
+
+
+def _field_file(dirname, name):
+  return os.path.join(dirname, name + '.dat')
+
+
+class CaptureWriter(object):
+  """Appends samples to a capture directory, for captures of any length
+
+  Samples are written before the header count, so readers never see a
+  partly written chunk."""
+
+  def __init__(self, dirname, actuator_name, metadata=None):
+    self.dirname = dirname
+    self.actuator_name = actuator_name
+    self.metadata = metadata or {}
+    self.num_samples = 0
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    for name in FIELD_NAMES:
+      open(_field_file(dirname, name), 'wb').close()
+    self._write_header()
+
+  def _write_header(self):
+    header = {'format_version': CAPTURE_VERSION,
+              'actuator_name': self.actuator_name,
+              'num_samples': self.num_samples,
+              'dtypes': dict((name, numpy.dtype(dtype).newbyteorder('<').str) for name, dtype in SAMPLE_FIELDS),
+              'metadata': self.metadata}
+    tmp = _header_file(self.dirname) + '.tmp'
+    with open(tmp, 'w') as f:
+      yaml.safe_dump(header, f, default_flow_style=False)
+    os.rename(tmp, _header_file(self.dirname))
+
+  def append(self, fields):
+    """Append samples, a dict of arrays by MotorSample field"""
+    num = len(fields[FIELD_NAMES[0]])
+    for name, dtype in SAMPLE_FIELDS:
+      values = numpy.asarray(fields[name], dtype=numpy.dtype(dtype).newbyteorder('<'))
+      if len(values) != num:
+        raise ValueError('Field %s has %d samples, expected %d' % (name, len(values), num))
+      with open(_field_file(self.dirname, name), 'ab') as f:
+        f.write(values.tobytes())
+    self.num_samples += num
+    self._write_header()
+
+
+def open_capture_dir(dirname):
+  """Capture of a capture directory, fields memory-mapped read only"""
+  with open(_header_file(dirname)) as f:
+    header = yaml.safe_load(f)
+  if header.get('format_version', 0) > CAPTURE_VERSION:
+    raise ValueError('Capture %s has version %s, only versions up to %d are supported' %
+                     (dirname, header.get('format_version'), CAPTURE_VERSION))
+
+  num = header['num_samples']
+  fields = {}
+  for name in FIELD_NAMES:
+    dtype = numpy.dtype(header['dtypes'][name])
+    if num == 0:
+      fields[name] = numpy.zeros(0, dtype=dtype)
+    else:
+      fields[name] = numpy.memmap(_field_file(dirname, name), dtype=dtype, mode='r', shape=(num,))
+  return Capture(header['actuator_name'], fields, header.get('metadata'))
+
+
+# Bytes of YAML per sample are at least this, for preallocating arrays
+_MIN_YAML_SAMPLE_BYTES = 100
+
+_YAML_BOOLS = {'true': True, 'false': False, 'yes': True, 'no': False, 'on': True, 'off': False}
+_YAML_FLOATS = {'.inf': float('inf'), '+.inf': float('inf'), '-.inf': float('-inf'), '.nan': float('nan')}
+
+
+def _yaml_scalar(value, dtype):
+  if dtype is numpy.bool_:
+    if value.lower() in _YAML_BOOLS:
+      return _YAML_BOOLS[value.lower()]
+    return bool(int(value))
+  value = value.replace('_', '')
+  if dtype is numpy.uint64:
+    return int(value)
+  if value.lower() in _YAML_FLOATS:
+    return _YAML_FLOATS[value.lower()]
+  return float(value)
+
+
+class _SampleArrays(object):
+  """Per-field arrays, grown by doubling as samples are parsed
+
+  With a writer, full chunks are appended to it instead of growing."""
+
+  def __init__(self, capacity, writer=None):
+    self.writer = writer
+    if writer is not None:
+      capacity = CHUNK_SIZE
+    self.count = 0
+    self.total = 0
+    self.arrays = [numpy.empty(max(capacity, 1), dtype=dtype) for name, dtype in SAMPLE_FIELDS]
+    self.row = [None] * len(SAMPLE_FIELDS)
+
+  def set(self, index, value):
+    self.row[index] = _yaml_scalar(value, SAMPLE_FIELDS[index][1])
+
+  def commit(self):
+    if any(v is None for v in self.row):
+      missing = [FIELD_NAMES[i] for i, v in enumerate(self.row) if v is None]
+      raise ValueError('MotorSample %d is missing %s' % (self.total, ', '.join(missing)))
+    if self.count == len(self.arrays[0]):
+      if self.writer is not None:
+        self.flush()
+      else:
+        self.arrays = [numpy.resize(a, 2 * len(a)) for a in self.arrays]
+    for a, v in zip(self.arrays, self.row):
+      a[self.count] = v
+    self.count += 1
+    self.total += 1
+    self.row = [None] * len(SAMPLE_FIELDS)
+
+  def flush(self):
+    self.writer.append(self.fields())
+    self.count = 0
+
+  def trim(self):
+    """Shrinks arrays to the parsed samples, in place, releasing unused capacity"""
+    for a in self.arrays:
+      a.resize(self.count, refcheck=False)
+
+  def fields(self):
+    return dict((name, a[:self.count]) for name, a in zip(FIELD_NAMES, self.arrays))
+
+
+def _parse_samples(events, samples):
+  """Fills samples from the YAML events of a dumped DiagnosticData response
+
+  Messages are dumped by their __getstate__(), as a mapping with a 'state'
+  list of slot values, or as a mapping of slot names to values. Returns
+  False if there is no DiagnosticData response or sample_buffer."""
+  is_response = False
+  in_sample = False
+  in_state = False
+  key = None
+  index = 0
+  for event in events:
+    if isinstance(event, yaml.MappingStartEvent):
+      if event.tag and event.tag.endswith('MotorSample'):
+        in_sample = True
+        key = None
+      elif event.tag and event.tag.endswith('DiagnosticDataResponse'):
+        is_response = True
+    elif not in_sample:
+      if isinstance(event, yaml.ScalarEvent) and event.value == 'sample_buffer':
+        is_response = True
+      continue
+    elif isinstance(event, yaml.ScalarEvent):
+      if in_state:
+        if index >= len(SAMPLE_FIELDS):
+          raise ValueError('MotorSample %d has more than %d fields' % (samples.total, len(SAMPLE_FIELDS)))
+        samples.set(index, event.value)
+        index += 1
+      elif key is None:
+        key = event.value
+      else:
+        if key in FIELD_NAMES:
+          samples.set(FIELD_NAMES.index(key), event.value)
+        key = None
+    elif isinstance(event, yaml.SequenceStartEvent) and key == 'state':
+      in_state = True
+      index = 0
+    elif isinstance(event, yaml.SequenceEndEvent) and in_state:
+      in_state = False
+      key = None
+    elif isinstance(event, yaml.MappingEndEvent):
+      samples.commit()
+      in_sample = False
+    elif isinstance(event, yaml.AliasEvent):
+      raise ValueError('MotorSample %d has YAML aliases, unable to stream' % samples.total)
+  return is_response
+
+
+def _parse_yaml_capture(filename, samples):
+  loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+  with open(filename) as f:
+    if not _parse_samples(yaml.parse(f, Loader=loader), samples):
+      raise ValueError('%s is not a DiagnosticData capture, it has no sample_buffer' % filename)
+
+
+def load_yaml_capture(filename):
+  """Load legacy YAML dump of a DiagnosticData response
+
+  The YAML event stream is parsed straight into arrays, with the libyaml
+  parser if available. No MotorSample objects are built. Raises
+  ValueError for YAML without a sample_buffer."""
+  samples = _SampleArrays(os.path.getsize(filename) // _MIN_YAML_SAMPLE_BYTES)
+  _parse_yaml_capture(filename, samples)
+  samples.trim()
+  return Capture(actuator_name(filename), samples.fields(), {'converted_from': os.path.basename(filename)})
+
+
+def convert_yaml_capture(yaml_file, capture_file=None, memmap=False):
+  """Rewrite legacy YAML capture as .npz or capture directory, next to it by default
+
+  Capture directories are written in chunks as the YAML is parsed, so
+  memory doesn't grow with capture length. Returns the capture filename."""
+  if capture_file is None:
+    capture_file = capture_filename(actuator_name(yaml_file), os.path.dirname(yaml_file), memmap)
+  metadata = {'converted_from': os.path.basename(yaml_file),
+              'capture_time': os.path.getmtime(yaml_file)}
+
+  if os.path.normpath(capture_file).endswith(MEMMAP_SUFFIX):
+    samples = _SampleArrays(0, CaptureWriter(capture_file, actuator_name(yaml_file), metadata))
+    _parse_yaml_capture(yaml_file, samples)
+    samples.flush()
+    return capture_file
+
+  capture = load_yaml_capture(yaml_file)
+  capture.metadata.update(metadata)
+  save_capture(capture_file, capture)
+  return capture_file
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy
+from analysis_test import spike_outliers
+from chunked import ChunkedSignal
+
+def synthetic_spikes(num_samples, num_spikes=20, seed=0):
+  """Acceleration * velocity of a noisy dithered joint at 1 kHz, with encoder spikes"""
+  rand = numpy.random.RandomState(seed)
+  timestamp = numpy.arange(num_samples + 1) * 0.001
+  velocity = numpy.sin(2 * numpy.pi * 2 * timestamp) + 0.001 * rand.randn(num_samples + 1)
+  spike_at = rand.randint(1, num_samples, num_spikes)
+  velocity[spike_at] += rand.choice([-1, 1], num_spikes) * 5
+  acceleration = abs(numpy.diff(velocity) / numpy.diff(timestamp))
+  return acceleration / acceleration.max() * velocity[:-1]
+
+def legacy_spike_outliers(spikes):
+  """Detector before vectorization: list comprehensions, sorts and per-value scans
+
+  Quartiles are taken as in spike_outliers, the old scoreatpercentile(neg,
+  -75) calls fail on current scipy."""
+  outlier_limit_neg = 0
+  outlier_limit_pos = 0
+  neg = numpy.sort([val for val in spikes if val < 0], kind='mergesort')
+  pos = numpy.sort([val for val in spikes if val > 0], kind='mergesort')
+  if (len(neg) > 1):
+    iq_range_neg = numpy.percentile(neg, 75) - numpy.percentile(neg, 25)
+    outlier_limit_neg = numpy.percentile(neg, 25) - iq_range_neg * 3
+  if (len(pos) > 1):
+    iq_range_pos = numpy.percentile(pos, 75) - numpy.percentile(pos, 25)
+    outlier_limit_pos = iq_range_pos * 3 + numpy.percentile(pos, 75)
+  outlier_index = [i for i, val in enumerate(spikes) if (val < 0 and val < outlier_limit_neg) or (val > 0 and val > outlier_limit_pos)]
+  return (numpy.array(outlier_index, dtype=numpy.int64), outlier_limit_neg, outlier_limit_pos)
+
+def time_runs(func, repeats):
+  times = []
+  for i in range(repeats):
+    start = time.time()
+    result = func()
+    times.append(time.time() - start)
+  return min(times), result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser("benchmark of the spike detector on synthetic multi-million sample signals")
+  parser.add_argument("-n","--samples", help="signal lengths to benchmark", type=int, nargs='+', default=[1000000, 4000000])
+  parser.add_argument("-r","--repeats", help="runs of each detector, best is reported", type=int, default=3)
+  parser.add_argument("--no-legacy", help="skip the slow list comprehension detector", action="store_true")
+  args = parser.parse_args()
+
+  detectors = [('vectorized', lambda s: spike_outliers(s)[:3]),
+               ('chunked', lambda s: spike_outliers(ChunkedSignal(len(s), lambda c: s[c]), in_memory_samples=0)[:3])]
+  if not args.no_legacy:
+    detectors.insert(0, ('legacy', legacy_spike_outliers))
+
+  print("%-10s  %-10s  %10s  %8s  %8s" % ('samples', 'detector', 'seconds', 'speedup', 'outliers'))
+  mismatch = False
+  for num_samples in args.samples:
+    spikes = synthetic_spikes(num_samples)
+    reference = None
+    for name, detector in detectors:
+      seconds, (outlier_index, outlier_limit_neg, outlier_limit_pos) = time_runs(lambda: detector(spikes), args.repeats)
+      if reference is None:
+        reference = (seconds, outlier_index, outlier_limit_neg, outlier_limit_pos)
+      elif not (numpy.array_equal(outlier_index, reference[1]) and
+                numpy.allclose([outlier_limit_neg, outlier_limit_pos], reference[2:], rtol=1e-12, atol=0)):
+        print("%s detector disagrees with %s at %d samples" % (name, detectors[0][0], num_samples))
+        mismatch = True
+      print("%-10d  %-10s  %10.4f  %7.1fx  %8d" % (num_samples, name, seconds, reference[0] / seconds, len(outlier_index)))
+
+  if mismatch:
+    sys.exit(1)
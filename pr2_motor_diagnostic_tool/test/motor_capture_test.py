@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""Unit tests of motor diagnostic capture files"""
+PKG = 'pr2_motor_diagnostic_tool'
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy
+import yaml
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import chunked
+from motor_capture import *
+from motor_capture import _SampleArrays, _parse_samples
+
+from pr2_motor_diagnostic_tool.msg import MotorSample
+from pr2_motor_diagnostic_tool.srv import DiagnosticDataResponse
+
+def random_fields(num_samples, seed=0):
+  """Distinct values for every MotorSample field"""
+  rand = numpy.random.RandomState(seed)
+  fields = {}
+  for name, dtype in SAMPLE_FIELDS:
+    if dtype is numpy.bool_:
+      fields[name] = rand.randint(0, 2, num_samples).astype(bool)
+    elif dtype is numpy.uint64:
+      # Counts past 2**53 aren't exact as floats
+      fields[name] = numpy.uint64(2 ** 62) + rand.randint(0, 1000, num_samples).astype(numpy.uint64)
+    else:
+      fields[name] = rand.randn(num_samples)
+  fields['timestamp'] = numpy.arange(num_samples) * 0.001
+  return fields
+
+def dump_response(filename, fields):
+  """YAML dump of a DiagnosticData response, as captures were saved before .npz"""
+  response = DiagnosticDataResponse()
+  response.sample_buffer = []
+  for i in range(len(fields['timestamp'])):
+    sample = MotorSample()
+    for name, dtype in SAMPLE_FIELDS:
+      value = fields[name][i]
+      setattr(sample, name, bool(value) if dtype is numpy.bool_ else int(value) if dtype is numpy.uint64 else float(value))
+    response.sample_buffer.append(sample)
+  with open(filename, 'w') as f:
+    yaml.dump(response, f)
+
+def motor_fields(num_samples, num_spikes=10, seed=0):
+  """Samples of a dithered joint at 1 kHz, with encoder spikes"""
+  fields = random_fields(num_samples, seed)
+  rand = numpy.random.RandomState(seed)
+  velocity = numpy.sin(2 * numpy.pi * 2 * fields['timestamp']) + 0.001 * rand.randn(num_samples)
+  velocity[rand.randint(1, num_samples, num_spikes)] += 5
+  fields['velocity'] = velocity
+  return fields
+
+class TestMotorCapture(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def assert_fields_equal(self, capture, fields):
+    for name, dtype in SAMPLE_FIELDS:
+      values = getattr(capture, name)
+      self.assertEqual(values.dtype, numpy.dtype(dtype), "Field %s has dtype %s" % (name, values.dtype))
+      self.assertTrue(numpy.array_equal(values, fields[name]), "Field %s doesn't match" % name)
+
+  def test_is_capture_file(self):
+    for f in ['r_wrist_r_motor_results.npz', 'r_wrist_r_motor_results.yaml',
+              'r_wrist_r_motor_results.capture', 'r_wrist_r_motor_results.capture/']:
+      self.assertTrue(is_capture_file(f), "%s isn't a capture" % f)
+    for f in ['config.yaml', 'capture.yaml', 'model.npz', 'r_wrist_r_motor.yaml']:
+      self.assertFalse(is_capture_file(f), "%s is a capture" % f)
+
+  def test_npz_round_trip(self):
+    fields = random_fields(1000)
+    filename = capture_filename('r_wrist_r_motor', self.tmp_dir)
+    save_capture(filename, Capture('r_wrist_r_motor', fields, {'capture_time': 12.5}))
+
+    capture = load_capture(filename)
+    self.assertEqual(len(FIELD_NAMES), 10)
+    self.assert_fields_equal(capture, fields)
+    self.assertEqual(capture.actuator_name, 'r_wrist_r_motor')
+    self.assertEqual(capture.metadata, {'capture_time': 12.5})
+
+  def test_yaml_without_samples(self):
+    config = os.path.join(self.tmp_dir, 'config.yaml')
+    with open(config, 'w') as f:
+      yaml.safe_dump({'actuators': ['r_wrist_r_motor'], 'rate': 1000}, f)
+    self.assertRaises(ValueError, load_yaml_capture, config)
+
+  def test_streaming_yaml(self):
+    fields = random_fields(300, 2)
+    yaml_file = os.path.join(self.tmp_dir, 'r_wrist_r_motor' + YAML_SUFFIX)
+    dump_response(yaml_file, fields)
+
+    # Captures were read by loading the response, then looping over its samples
+    with open(yaml_file) as f:
+      response = yaml.load(f, Loader=getattr(yaml, 'UnsafeLoader', yaml.Loader))
+    old = {}
+    for name, dtype in SAMPLE_FIELDS:
+      old[name] = numpy.array([getattr(sample, name) for sample in response.sample_buffer], dtype=dtype)
+
+    capture = load_yaml_capture(yaml_file)
+    self.assertEqual(len(capture), 300)
+    self.assert_fields_equal(capture, old)
+    # Preallocated arrays are trimmed to the samples
+    for name in FIELD_NAMES:
+      field = getattr(capture, name)
+      self.assertEqual((field if field.base is None else field.base).nbytes, field.nbytes)
+    self.assert_fields_equal(capture, fields)
+
+    # Pure Python parser gives the same samples as libyaml
+    samples = _SampleArrays(0)
+    with open(yaml_file) as f:
+      self.assertTrue(_parse_samples(yaml.parse(f, Loader=yaml.SafeLoader), samples))
+    self.assert_fields_equal(Capture('', samples.fields()), fields)
+
+    # Response without samples is an empty capture
+    empty_file = os.path.join(self.tmp_dir, 'head_pan_motor' + YAML_SUFFIX)
+    dump_response(empty_file, random_fields(0))
+    self.assertEqual(len(load_yaml_capture(empty_file)), 0)
+
+  def test_streaming_yaml_errors(self):
+    # Other messages aren't captures
+    other_file = os.path.join(self.tmp_dir, 'r_wrist_l_motor' + YAML_SUFFIX)
+    with open(other_file, 'w') as f:
+      yaml.dump(MotorSample(), f)
+    self.assertRaises(ValueError, load_yaml_capture, other_file)
+
+    # Capture truncated in the middle of a sample
+    yaml_file = os.path.join(self.tmp_dir, 'r_wrist_r_motor' + YAML_SUFFIX)
+    dump_response(yaml_file, random_fields(300, 3))
+    with open(yaml_file) as f:
+      lines = f.readlines()
+    state = [i for i, line in enumerate(lines) if line.strip() == 'state:']
+    with open(yaml_file, 'w') as f:
+      f.writelines(lines[:state[len(state) // 2] + 5])
+    self.assertRaises(ValueError, load_yaml_capture, yaml_file)
+
+    # Capture cut off mid-line is a YAML error, or a sample missing fields
+    with open(yaml_file, 'w') as f:
+      f.write(''.join(lines)[:len(''.join(lines)) // 2] + '[')
+    self.assertRaises((ValueError, yaml.YAMLError), load_yaml_capture, yaml_file)
+
+  def test_capture_writer(self):
+    fields = random_fields(3 * chunked.CHUNK_SIZE + 10, 4)
+    dirname = capture_filename('r_wrist_r_motor', self.tmp_dir, memmap=True)
+    writer = CaptureWriter(dirname, 'r_wrist_r_motor', {'capture_time': 1.0})
+    self.assertEqual(len(load_capture(dirname)), 0)
+
+    bounds = [0, 1, 1000, chunked.CHUNK_SIZE + 7, len(fields['timestamp'])]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+      writer.append(dict((name, fields[name][start:stop]) for name in FIELD_NAMES))
+      # Readers see every sample appended so far
+      self.assertEqual(len(load_capture(dirname)), stop)
+
+    capture = load_capture(os.path.join(dirname, 'capture.yaml'))
+    self.assertFalse(capture.velocity.flags.owndata, "Capture directory fields aren't memory-mapped")
+    self.assert_fields_equal(capture, fields)
+    self.assertEqual(capture.actuator_name, 'r_wrist_r_motor')
+    self.assertEqual(capture.metadata, {'capture_time': 1.0})
+
+    bad = dict((name, fields[name][:10]) for name in FIELD_NAMES)
+    bad['velocity'] = bad['velocity'][:5]
+    self.assertRaises(ValueError, writer.append, bad)
+
+    # Saved and converted captures of any length are written as directories
+    other = capture_filename('r_wrist_l_motor', self.tmp_dir, memmap=True)
+    save_capture(other, Capture('r_wrist_l_motor', fields))
+    self.assert_fields_equal(load_capture(other), fields)
+
+    yaml_file = os.path.join(self.tmp_dir, 'r_elbow_flex_motor' + YAML_SUFFIX)
+    small = random_fields(200, 5)
+    dump_response(yaml_file, small)
+    self.assert_fields_equal(load_capture(convert_yaml_capture(yaml_file, memmap=True)), small)
+
+  def test_chunk_reader(self):
+    rand = numpy.random.RandomState(6)
+    values = rand.randn(5 * chunked.CHUNK_SIZE + 123)
+    filename = os.path.join(self.tmp_dir, 'values.dat')
+    values.tofile(filename)
+    signal = numpy.memmap(filename, dtype=numpy.float64, mode='r', shape=values.shape)
+
+    self.assertTrue(numpy.array_equal(numpy.concatenate(list(chunked.chunks(signal))), values))
+    self.assertEqual(max(len(c) for c in chunked.chunks(signal)), chunked.CHUNK_SIZE)
+    self.assertEqual(chunked.count(signal, lambda c: c > 0), numpy.count_nonzero(values > 0))
+    self.assertAlmostEqual(chunked.abs_mean(signal), abs(values).mean())
+    self.assertEqual(chunked.abs_max(signal), abs(values).max())
+    index = rand.randint(0, len(values), 50)
+    self.assertTrue(numpy.array_equal(chunked.take(signal, index), values[index]))
+
+    # Exact percentiles, from more values than are selected in memory
+    for select in (None, lambda c: c < 0):
+      selected = values if select is None else values[values < 0]
+      self.assertTrue(numpy.allclose(chunked.percentiles(signal, [0, 25, 50, 75, 100], select),
+                                     numpy.percentile(selected, [0, 25, 50, 75, 100]), rtol=0, atol=1e-12))
+
+    # Derived signals are computed one chunk at a time
+    doubled = chunked.ChunkedSignal(len(values), lambda s: 2 * numpy.asarray(signal[s]))
+    self.assertTrue(numpy.array_equal(doubled[10:20], 2 * values[10:20]))
+    self.assertEqual(chunked.abs_max(doubled), 2 * abs(values).max())
+
+    # Decimated signal keeps the extremes
+    index, decimated = chunked.decimate(signal, 1000)
+    self.assertTrue(len(decimated) <= 1000)
+    self.assertEqual(decimated.max(), values.max())
+    self.assertEqual(decimated.min(), values.min())
+    self.assertTrue(numpy.array_equal(values[index], decimated))
+
+  def test_chunked_analysis(self):
+    import analysis_test
+
+    fields = motor_fields(3 * chunked.CHUNK_SIZE)
+    capture = Capture('r_wrist_r_motor', fields)
+    dirname = capture_filename('r_wrist_r_motor', self.tmp_dir, memmap=True)
+    save_capture(dirname, capture)
+
+    in_memory = analysis_test.Diagnostic(quiet=True)
+    (result, param) = in_memory.analyze(capture, 'r_wrist_r_motor', False)
+    memmapped = analysis_test.Diagnostic(quiet=True)
+    (memmap_result, memmap_param) = memmapped.analyze(load_capture(dirname), 'r_wrist_r_motor', False)
+
+    self.assertEqual(memmap_result, result)
+    self.assertEqual(sorted(memmapped.stats), sorted(in_memory.stats))
+    for key, value in in_memory.stats.items():
+      self.assertAlmostEqual(memmapped.stats[key], value, msg="Stat %s doesn't match" % key)
+    self.assertTrue(numpy.array_equal(memmap_param[6], param[6]))
+    self.assertTrue(in_memory.stats['outliers'] > 0, "Encoder spikes weren't found")
+
+    # Spike check chunk by chunk matches the one array check
+    spikes = param[2]
+    chunk_outliers = analysis_test.spike_outliers(spikes, in_memory_samples=0)
+    array_outliers = analysis_test.spike_outliers(numpy.concatenate(list(chunked.chunks(spikes))))
+    self.assertTrue(numpy.array_equal(chunk_outliers[0], array_outliers[0]))
+    self.assertTrue(numpy.allclose(chunk_outliers[1:], array_outliers[1:], rtol=1e-12, atol=0))
+
+  def test_batch_debug_output(self):
+    import analysis_test
+
+    filename = capture_filename('r_wrist_r_motor', self.tmp_dir)
+    save_capture(filename, Capture('r_wrist_r_motor', motor_fields(5000)))
+    (row, series, output) = analysis_test.analyze_capture((filename, 'r_wrist_r_motor', None, True))
+    self.assertEqual(row['result'], 'BAD', row['error'])
+    self.assertTrue(series is None)
+    # Worker debug lines are returned for the parent to print, not printed
+    self.assertTrue(output.startswith('r_wrist_r_motor\n'), output)
+    self.assertTrue('mean_voltage is' in output, output)
+    (row, series, output) = analysis_test.analyze_capture((filename, 'r_wrist_r_motor', None, False))
+    self.assertEqual(output, '')
+
+  def test_batch_analysis(self):
+    import analysis_test
+
+    good = os.path.join(self.tmp_dir, 'good')
+    os.makedirs(good)
+    save_capture(capture_filename('r_wrist_l_motor', good), Capture('r_wrist_l_motor', motor_fields(5000, 0)))
+    save_capture(capture_filename('r_wrist_r_motor', self.tmp_dir), Capture('r_wrist_r_motor', motor_fields(5000)))
+    filenames = find_captures([self.tmp_dir])
+
+    # In process analysis matches the pool
+    rows = [row for row, series, output in analysis_test.analyze_captures(filenames, 1)]
+    self.assertEqual(rows, [row for row, series, output in analysis_test.analyze_captures(filenames, 2)])
+    self.assertEqual(sorted(row['result'] for row in rows), ['BAD', 'OK'])
+
+    # Exit status tells a sweep with bad captures from a clean one
+    env = dict(os.environ, MPLBACKEND='Agg')
+    script = os.path.join(SRC_DIR, 'analysis_test.py')
+    with open(os.devnull, 'w') as devnull:
+      self.assertEqual(subprocess.call([sys.executable, script, '-b', '-d', self.tmp_dir],
+                                       stdout=devnull, stderr=devnull, env=env), 1)
+      self.assertEqual(subprocess.call([sys.executable, script, '-b', '-d', good],
+                                       stdout=devnull, stderr=devnull, env=env), 0)
+
+  def test_convert_captures(self):
+    fields = random_fields(500, 1)
+    yaml_file = os.path.join(self.tmp_dir, 'r_elbow_flex_motor' + YAML_SUFFIX)
+    dump_response(yaml_file, fields)
+    with open(os.path.join(self.tmp_dir, 'config.yaml'), 'w') as f:
+      f.write('rate: 1000\n')
+
+    subprocess.check_call([sys.executable, os.path.join(SRC_DIR, 'convert_captures.py'), self.tmp_dir],
+                          stdout=open(os.devnull, 'w'))
+    self.assertEqual(sorted(f for f in os.listdir(self.tmp_dir) if f.endswith('.npz')),
+                     ['r_elbow_flex_motor' + CAPTURE_SUFFIX])
+
+    capture = load_capture(capture_filename('r_elbow_flex_motor', self.tmp_dir))
+    self.assert_fields_equal(capture, fields)
+    self.assertEqual(capture.actuator_name, 'r_elbow_flex_motor')
+    self.assertEqual(capture.metadata['converted_from'], os.path.basename(yaml_file))
+
+
+if __name__ == '__main__':
+  import rosunit
+  rosunit.unitrun(PKG, 'test_motor_capture', TestMotorCapture)